@@ -33,18 +33,41 @@ MCP23017_I2C_ADDRESS_DEFAULT = 0x20
 
 class PhaseShifter(object):
 
-    def __init__(self, address=MCP23017_I2C_ADDRESS_DEFAULT, busnum=-1):
-        self.i2c = Adafruit_I2C(address=address, busnum=busnum)
+    def __init__(self, address=MCP23017_I2C_ADDRESS_DEFAULT, busnum=-1, i2c=None):
+        # i2c may be passed in to drive something other than the real bus
+        self.i2c = i2c if i2c is not None else Adafruit_I2C(address=address, busnum=busnum)
         self.address = address
+        # last value written to each register, writes that would not change it are skipped
+        self.shadow = {}
+        self.write_count = 0
+        self.writes_skipped = 0
+        self.write_errors = 0    # writes the device may not have received
         # Configure as all outputs
         self.i2c.write8(MCP23017_IODIRA, 0x00)  # all outputs on port A
         self.i2c.write8(MCP23017_IODIRB, 0x00)  # all outputs on port B
 
+    def write_register(self, register, value):
+        if self.shadow.get(register) == value:
+            self.writes_skipped += 1
+            return
+        # Adafruit_I2C reports bus errors by returning -1 rather than raising
+        try:
+            result = self.i2c.write8(register, value)
+        except Exception:
+            result = -1
+        if result == -1:
+            # the register may hold anything now, never skip its next write
+            self.shadow.pop(register, None)
+            self.write_errors += 1
+            return
+        self.shadow[register] = value
+        self.write_count += 1
+
     def set_a(self, value):
-        self.i2c.write8(MCP23017_GPIOA, value & 0xFF)
+        self.write_register(MCP23017_GPIOA, value & 0xFF)
 
     def set_b(self, value):
-        self.i2c.write8(MCP23017_GPIOB, value & 0xFF)
+        self.write_register(MCP23017_GPIOB, value & 0xFF)
 
     def set_phase_count240(self, phase_offset):
         # Phase shift the output clock signal relative to Clk0.
@@ -13,6 +13,11 @@
 #    selectRdiv(self, targetFrequency)
 #    invertOutput(inverted, clock)
 #
+# Register writes go through a shadow copy of the device registers so writes
+# that would not change anything are skipped, and the PLLs are only reset
+# when a frequency actually changed.  A failed write is dropped from the
+# shadow, so the next write of that register reaches the device.
+#
 # MIT Open Source License
 # https://opensource.org/licenses/MIT
 
@@ -102,7 +107,7 @@ class Si5351(object):
     CLK1 = 1
     CLK2 = 2
 
-    def __init__(self, address = SI5351_I2C_ADDRESS_DEFAULT, busnum=-1):
+    def __init__(self, address = SI5351_I2C_ADDRESS_DEFAULT, busnum=-1, i2c=None):
 
         self.crystalFreq     = SI5351_CRYSTAL_FREQ_25MHZ
         self.crystalLoad     = SI5351_CRYSTAL_LOAD_10PF
@@ -110,23 +115,68 @@ class Si5351(object):
         self.plla_freq       = 0
         self.pllb_freq       = 0
 
-        self.i2c = Adafruit_I2C(address=address, busnum=busnum)
+        # i2c may be passed in to drive something other than the real bus
+        self.i2c = i2c if i2c is not None else Adafruit_I2C(address=address, busnum=busnum)
         self.address = address
 
+        # last value written to each register
+        self.shadow = {}
+        self.writeCount = 0      # register writes sent to the device
+        self.writesSkipped = 0   # writes skipped because the register already held the value
+        self.writeErrors = 0     # writes the device may not have received
+        self.pllResets = 0
+
         # Disable all outputs setting CLKx_DIS high
-        self.i2c.write8(SI5351_REGISTER_3_OUTPUT_ENABLE_CONTROL, 0xFF)
+        self.writeRegister(SI5351_REGISTER_3_OUTPUT_ENABLE_CONTROL, 0xFF)
         # OEB pin does not control enable/disable state of CLKx output
-        self.i2c.write8(SI5351_REGISTER_9_OEB_PIN_ENABLE_CONTROL, 0xFF)
+        self.writeRegister(SI5351_REGISTER_9_OEB_PIN_ENABLE_CONTROL, 0xFF)
         # PLL input source = XTAL
-        self.i2c.write8(SI5351_REGISTER_15_PLL_INPUT_SOURCE, 0)
+        self.writeRegister(SI5351_REGISTER_15_PLL_INPUT_SOURCE, 0)
 
         # Power down all output drivers
-        self.i2c.write8(SI5351_REGISTER_16_CLK0_CONTROL, 0x80)
-        self.i2c.write8(SI5351_REGISTER_17_CLK1_CONTROL, 0x80)
-        self.i2c.write8(SI5351_REGISTER_18_CLK2_CONTROL, 0x80)
+        self.writeRegister(SI5351_REGISTER_16_CLK0_CONTROL, 0x80)
+        self.writeRegister(SI5351_REGISTER_17_CLK1_CONTROL, 0x80)
+        self.writeRegister(SI5351_REGISTER_18_CLK2_CONTROL, 0x80)
 
         # Set the load capacitance for the XTAL
-        self.i2c.write8(SI5351_REGISTER_183_CRYSTAL_INTERNAL_LOAD_CAPACITANCE, self.crystalLoad)
+        self.writeRegister(SI5351_REGISTER_183_CRYSTAL_INTERNAL_LOAD_CAPACITANCE, self.crystalLoad)
+
+    def writeRegister(self, register, value):
+        # Write through the shadow copy, returns True if the register changed
+        if self.shadow.get(register) == value:
+            self.writesSkipped += 1
+            return False
+        # Adafruit_I2C reports bus errors by returning -1 rather than raising
+        try:
+            result = self.i2c.write8(register, value)
+        except Exception:
+            result = -1
+        if result == -1:
+            # the register may hold anything now, never skip its next write
+            self.shadow.pop(register, None)
+            self.writeErrors += 1
+            return True
+        self.shadow[register] = value
+        self.writeCount += 1
+        return True
+
+    def writeRegisters(self, registers):
+        # registers is a list of (register, value), returns True if any changed
+        changed = False
+        for register, value in registers:
+            if self.writeRegister(register, value):
+                changed = True
+        return changed
+
+    def resetPLLs(self):
+        # Reset both PLLs (self clearing, never shadowed)
+        self.i2c.write8(SI5351_REGISTER_177_PLL_RESET, (1<<7) | (1<<5))
+        self.writeCount += 1
+        self.pllResets += 1
+
+    def writeSummary(self):
+        return "Si5351 writes:%d skipped:%d errors:%d pll resets:%d" % (
+            self.writeCount, self.writesSkipped, self.writeErrors, self.pllResets)
 
 
     def setupPLL(self, pll, mult, num=0, denom=1):
@@ -156,6 +206,15 @@ class Si5351(object):
         # P2[19:0] = 128 * num - denom * floor(128*(num/denom))
         # P3[19:0] = denom
 
+        self.writeRegisters(self.pllRegisters(pll, mult, num, denom))
+
+        # Reset both PLLs
+        self.resetPLLs()
+
+        self.storePLLFrequency(pll, mult, num, denom)
+
+    def pllRegisters(self, pll, mult, num=0, denom=1):
+        # PLL register values for setupPLL, returns a list of (register, value)
         # Set the main PLL config registers
         P1 = int(128 * mult) + int(128.0 * num / denom) - 512
         P2 = 128 * num - denom * int(128.0 * num / denom)
@@ -165,18 +224,16 @@ class Si5351(object):
         baseaddr = 26 if pll == self.PLL_A else 34
 
         # The datasheet is a nightmare of typos and inconsistencies here!
-        self.i2c.write8(baseaddr,   (P3 & 0x0000FF00) >> 8)
-        self.i2c.write8(baseaddr + 1, (P3 & 0x000000FF))
-        self.i2c.write8(baseaddr + 2, (P1 & 0x00030000) >> 16)
-        self.i2c.write8(baseaddr + 3, (P1 & 0x0000FF00) >> 8)
-        self.i2c.write8(baseaddr + 4, (P1 & 0x000000FF))
-        self.i2c.write8(baseaddr + 5, ((P3 & 0x000F0000) >> 12) | ((P2 & 0x000F0000) >> 16) )
-        self.i2c.write8(baseaddr + 6, (P2 & 0x0000FF00) >> 8)
-        self.i2c.write8(baseaddr + 7, (P2 & 0x000000FF))
-
-        # Reset both PLLs
-        self.i2c.write8(SI5351_REGISTER_177_PLL_RESET, (1<<7) | (1<<5))
-
+        return [(baseaddr,   (P3 & 0x0000FF00) >> 8),
+                (baseaddr + 1, (P3 & 0x000000FF)),
+                (baseaddr + 2, (P1 & 0x00030000) >> 16),
+                (baseaddr + 3, (P1 & 0x0000FF00) >> 8),
+                (baseaddr + 4, (P1 & 0x000000FF)),
+                (baseaddr + 5, ((P3 & 0x000F0000) >> 12) | ((P2 & 0x000F0000) >> 16) ),
+                (baseaddr + 6, (P2 & 0x0000FF00) >> 8),
+                (baseaddr + 7, (P2 & 0x000000FF))]
+
+    def storePLLFrequency(self, pll, mult, num=0, denom=1):
         # Store the frequency settings for use with the Multisynth helper
         fvco = int(self.crystalFreq * (mult + float(num) / denom))
         if pll == self.PLL_A:
@@ -238,6 +295,13 @@ class Si5351(object):
         # P2[19:0] = 128 * b - c * floor(128*(b/c))
         # P3[19:0] = c
 
+        msRegisters, control = self.multisynthRegisters(output, pll, div, num, denom, rDiv)
+        self.writeRegisters(msRegisters)
+        self.writeRegister(*control)
+
+    def multisynthRegisters(self, output, pll, div, num=0, denom=1, rDiv=0):
+        # Multisynth register values for setupMultisynth.
+        # Returns (list of (register, value), (clock control register, value))
         # Set the main PLL config registers
         P1 = 128 * div + int(128.0 * num / denom) - 512
         P2 = 128 * num - denom * int(128.0 * num / denom)
@@ -249,24 +313,22 @@ class Si5351(object):
         if output == 2: baseaddr = SI5351_REGISTER_58_MULTISYNTH2_PARAMETERS_1
 
         # Set the MSx config registers
-        self.i2c.write8(baseaddr,   (P3 & 0x0000FF00) >> 8)
-        self.i2c.write8(baseaddr + 1, (P3 & 0x000000FF))
         ms_p1 = (P1 & 0x00030000) >> 16 # MS0_P1[17:16]
         r_div = (rDiv & 0x07) << 4      # R0_DIV[2:0]
-        self.i2c.write8(baseaddr + 2, (ms_p1 | r_div))	# ToDo: Add DIVBY4 (>150MHz) later
-        self.i2c.write8(baseaddr + 3, (P1 & 0x0000FF00) >> 8)
-        self.i2c.write8(baseaddr + 4, (P1 & 0x000000FF))
-        self.i2c.write8(baseaddr + 5, ((P3 & 0x000F0000) >> 12) | ((P2 & 0x000F0000) >> 16) )
-        self.i2c.write8(baseaddr + 6, (P2 & 0x0000FF00) >> 8)
-        self.i2c.write8(baseaddr + 7, (P2 & 0x000000FF))
+        msRegisters = [(baseaddr,   (P3 & 0x0000FF00) >> 8),
+                       (baseaddr + 1, (P3 & 0x000000FF)),
+                       (baseaddr + 2, (ms_p1 | r_div)),	# ToDo: Add DIVBY4 (>150MHz) later
+                       (baseaddr + 3, (P1 & 0x0000FF00) >> 8),
+                       (baseaddr + 4, (P1 & 0x000000FF)),
+                       (baseaddr + 5, ((P3 & 0x000F0000) >> 12) | ((P2 & 0x000F0000) >> 16) ),
+                       (baseaddr + 6, (P2 & 0x0000FF00) >> 8),
+                       (baseaddr + 7, (P2 & 0x000000FF))]
 
         # Configure the clk control and enable the output
         clkControlReg = 0x0F                              # 8mA drive strength, MS0 as CLK0 source, Clock not inverted, powered up
         if pll == self.PLL_B: clkControlReg |= (1 << 5)   # Uses PLLB 
         if num == 0: clkControlReg |= (1 << 6)            # Integer mode
-        if output == 0: self.i2c.write8(SI5351_REGISTER_16_CLK0_CONTROL, clkControlReg)
-        if output == 1: self.i2c.write8(SI5351_REGISTER_17_CLK1_CONTROL, clkControlReg)
-        if output == 2: self.i2c.write8(SI5351_REGISTER_18_CLK2_CONTROL, clkControlReg)
+        return (msRegisters, (SI5351_REGISTER_16_CLK0_CONTROL + output, clkControlReg))
 
     def selectRdiv(self, targetFrequency):
         if targetFrequency < SI5351_SYNTH_OUT_MIN_FREQ/64: return R_DIV_128
@@ -281,31 +343,24 @@ class Si5351(object):
     def enableOutputs(self, enabled):
         # Enabled desired outputs (see Register 3)
         val = 0x00 if enabled else 0xFF
-        self.i2c.write8(SI5351_REGISTER_3_OUTPUT_ENABLE_CONTROL, val)
+        self.writeRegister(SI5351_REGISTER_3_OUTPUT_ENABLE_CONTROL, val)
 
     def disableOutput(self, channel):
         # Power down corresponding channel
-        if (channel == 0): self.i2c.write8(SI5351_REGISTER_16_CLK0_CONTROL, 0x80)
-        elif (channel == 1): self.i2c.write8(SI5351_REGISTER_17_CLK1_CONTROL, 0x80)
-        elif (channel == 2): self.i2c.write8(SI5351_REGISTER_18_CLK2_CONTROL, 0x80)
+        if (channel == 0): self.writeRegister(SI5351_REGISTER_16_CLK0_CONTROL, 0x80)
+        elif (channel == 1): self.writeRegister(SI5351_REGISTER_17_CLK1_CONTROL, 0x80)
+        elif (channel == 2): self.writeRegister(SI5351_REGISTER_18_CLK2_CONTROL, 0x80)
 
     def invertOutput(self, invert, channel):
         # Invert desired output
-        if (channel == 0):
-            value = self.i2c.readU8(SI5351_REGISTER_16_CLK0_CONTROL)
-            if invert: value |= 0b00010000
-            else: value &= ~0b00010000
-            self.i2c.write8(SI5351_REGISTER_16_CLK0_CONTROL, value)
-        elif (channel == 1):
-            value = self.i2c.readU8(SI5351_REGISTER_17_CLK1_CONTROL)
-            if invert: value |= 0b00010000
-            else: value &= ~0b00010000
-            self.i2c.write8(SI5351_REGISTER_17_CLK1_CONTROL, value)          
-        elif (channel == 2):
-            value = self.i2c.readU8(SI5351_REGISTER_18_CLK2_CONTROL)
-            if invert: value |= 0b00010000
-            else: value &= ~0b00010000
-            self.i2c.write8(SI5351_REGISTER_18_CLK2_CONTROL, value)
+        if channel not in (0, 1, 2): return
+        register = SI5351_REGISTER_16_CLK0_CONTROL + channel
+        # use the value we last wrote rather than reading it back
+        value = self.shadow.get(register)
+        if value is None: value = self.i2c.readU8(register)
+        if invert: value |= 0b00010000
+        else: value &= ~0b00010000
+        self.writeRegister(register, value)
 
     def reduceFraction(self, num=0, denom=1, debug=False):
         # Reduces fraction to workable values; return array [num, denom]
@@ -346,7 +401,7 @@ class Si5351(object):
         # fVCO must be between 600 and 900 MHz.  We'll use 800 Mhz as our initial target.
         # calculate VCO divider needed to produce desired multisynth output frequency.
         msIntegerPart = int(math.floor(800e6 / msFreq))
-        remainder = long( 800e6 - (msFreq * msIntegerPart) )
+        remainder = int( 800e6 - (msFreq * msIntegerPart) )
         if (debug): print("800MHz / msFreq remainder = {:,d}".format(remainder) )
         # convert remainder to a 20-bit fraction
         fractionArray = self.reduceFraction(remainder, msFreq, debug)
@@ -365,7 +420,7 @@ class Si5351(object):
         # fVCO = 25 MHz * (a + b / c)
         # find a, b, and c for VCO
         vcoIntegerPart = math.floor(vcoFreq / 25000000)
-        remainder = long( vcoFreq - (vcoIntegerPart * 25000000) )
+        remainder = int( vcoFreq - (vcoIntegerPart * 25000000) )
         if (debug): print("VCO freq / 25Mhz crystal remainder = %d" %remainder)
         # convert remainder of divide by 25 MHz to a 20-bit fraction
         fractionArray = self.reduceFraction(remainder, 25000000, debug)
@@ -374,8 +429,14 @@ class Si5351(object):
         if (debug):
             crystalMultiplier = vcoIntegerPart + float(vcoNum)/float(vcoDenom)
             print("Crystal multiplier %f" %crystalMultiplier)
-        self.setupPLL(pll, vcoIntegerPart, vcoNum, vcoDenom)
-        self.setupMultisynth(clock, pll, msIntegerPart, msNum, msDenom, rDiv)
+        # Only registers that differ from the current settings are written,
+        # and the PLLs are only reset if the PLL or Multisynth changed.
+        pllChanged = self.writeRegisters(self.pllRegisters(pll, vcoIntegerPart, vcoNum, vcoDenom))
+        self.storePLLFrequency(pll, vcoIntegerPart, vcoNum, vcoDenom)
+        msRegisters, control = self.multisynthRegisters(clock, pll, msIntegerPart, msNum, msDenom, rDiv)
+        msChanged = self.writeRegisters(msRegisters)
+        if pllChanged or msChanged:
+            self.resetPLLs()
         # Explanation:
         # We are multiplying 25 Mhz by a fraction with resolution of 1 part per million (20-bits)
         # The fVCO can be set in 25 Hz increments, and is then divided by msDiv.
@@ -389,7 +450,10 @@ class Si5351(object):
             print("Multisynth output frequency %d" %msOutFreq)
             outFreq = msOutFreq / (2 ** rDiv)
             print("Calculated clock %d output frequency = %d" %(clock, outFreq))
-        self.invertOutput(invert, clock)
+        # clock control including the invert bit in a single write
+        controlReg, controlValue = control
+        if invert: controlValue |= 0b00010000
+        self.writeRegister(controlReg, controlValue)
         self.enableOutputs(enableOutput)
 
 if __name__ == '__main__':
@@ -0,0 +1,164 @@
+#!/usr/bin/python
+#
+# Summary:
+# Adaptive burst support for mag_scan.
+# While the magnets are off we keep a running baseline of the field on each axis.
+# During a burst every sensor reading is fed to a sequential probability ratio
+# test (Wald SPRT) against that baseline, so the burst can end as soon as the
+# point is clearly null (no change) or clearly anomalous.
+# After a burst the readings are watched until the field has decayed back to
+# the baseline, so the pause before the next burst need not be a fixed length.
+# A pause that never settles, e.g. after a step in the ambient field, rebuilds
+# the baseline from its late readings.
+#
+# MIT Open Source License
+# https://opensource.org/licenses/MIT
+#
+
+import math
+
+DECISION_NONE = None
+DECISION_NULL = 'null'
+DECISION_ANOMALY = 'anomaly'
+
+
+class RunningStats(object):
+    """Running mean and variance of a stream of readings (Welford's method)"""
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    def variance(self):
+        if self.count < 2:
+            return 0.0
+        return self.m2 / (self.count - 1)
+
+    def std(self):
+        return math.sqrt(self.variance())
+
+
+class BaselineTracker(object):
+    """Magnets-off reference field for each axis.
+    Uses an exponentially weighted mean and variance so slow drift is followed
+    over a long scan.  The first min_samples readings are averaged equally.
+    """
+    def __init__(self, alpha=0.02, min_samples=20, min_std=1.0):
+        self.alpha = alpha              # weight of each new reading once warmed up
+        self.min_samples = min_samples  # readings needed before baseline is usable
+        self.min_std = min_std          # sensor quantization floor (counts)
+        self.count = 0
+        self.mean = [0.0, 0.0, 0.0]
+        self.var = [0.0, 0.0, 0.0]
+
+    def add(self, x, y, z):
+        self.count += 1
+        # equal weighting while warming up, then exponential
+        weight = max(self.alpha, 1.0 / self.count)
+        for axis, value in enumerate((x, y, z)):
+            delta = value - self.mean[axis]
+            self.mean[axis] += weight * delta
+            self.var[axis] = (1.0 - weight) * (self.var[axis] + weight * delta * delta)
+
+    def reset(self):
+        """Forget every reading, e.g. after a step in the ambient field"""
+        self.count = 0
+        self.mean = [0.0, 0.0, 0.0]
+        self.var = [0.0, 0.0, 0.0]
+
+    def ready(self):
+        return self.count >= self.min_samples
+
+    def std(self, axis):
+        return max(math.sqrt(self.var[axis]), self.min_std)
+
+
+class SequentialTest(object):
+    """Two sided Wald SPRT on each axis against the magnets-off baseline.
+    H0: the burst reading equals the baseline mean.
+    H1: the burst reading differs from the baseline by at least `effect` counts.
+    The point is anomalous as soon as any axis accepts H1, and null once
+    every axis has accepted H0 in both directions.
+    """
+    def __init__(self, baseline, effect=4.0, alpha=0.001, beta=0.01):
+        self.effect = float(effect)
+        self.upper = math.log((1.0 - beta) / alpha)   # accept H1
+        self.lower = math.log(beta / (1.0 - alpha))   # accept H0
+        self.mean = list(baseline.mean)
+        self.var = [baseline.std(axis) ** 2 for axis in range(3)]
+        # log likelihood ratio for a positive and negative shift on each axis
+        self.llr = [[0.0, 0.0] for _axis in range(3)]
+        self.accepted_null = [[False, False] for _axis in range(3)]
+        self.stats = [RunningStats(), RunningStats(), RunningStats()]
+        self.decision = DECISION_NONE
+
+    def add(self, x, y, z):
+        """Add one burst reading, returns the current decision"""
+        for axis, value in enumerate((x, y, z)):
+            self.stats[axis].add(value)
+            if self.decision is not DECISION_NONE:
+                continue
+            scale = self.effect / self.var[axis]
+            deviation = value - self.mean[axis]
+            for side, sign in enumerate((1.0, -1.0)):
+                if self.accepted_null[axis][side]:
+                    continue
+                self.llr[axis][side] += scale * (sign * deviation - self.effect / 2.0)
+                if self.llr[axis][side] >= self.upper:
+                    self.decision = DECISION_ANOMALY
+                elif self.llr[axis][side] <= self.lower:
+                    self.accepted_null[axis][side] = True
+        if self.decision is DECISION_NONE and all(all(sides) for sides in self.accepted_null):
+            self.decision = DECISION_NULL
+        return self.decision
+
+    def count(self):
+        return self.stats[0].count
+
+    def means(self):
+        return tuple(stats.mean for stats in self.stats)
+
+    def deviation(self):
+        """Largest difference of an axis mean from the baseline, in baseline standard deviations"""
+        return max(abs(stats.mean - mean) / math.sqrt(var) for stats, mean, var in zip(self.stats, self.mean, self.var))
+
+
+class DecayMonitor(object):
+    """Watches magnets-off readings after a burst until the field is back at the baseline.
+    Settled once settle_count readings in a row are within tolerance standard
+    deviations of the baseline mean on every axis.
+    The readings are kept until then, so a pause that never settles can
+    rebuild the baseline from its late readings (see late_readings).
+    """
+    def __init__(self, baseline, tolerance=3.0, settle_count=3):
+        self.mean = list(baseline.mean)
+        self.limit = [tolerance * baseline.std(axis) for axis in range(3)]
+        self.settle_count = settle_count
+        self.in_tolerance = 0   # consecutive readings within tolerance
+        self.count = 0
+        self.settled = False
+        self.readings = []      # (x, y, z) until settled
+
+    def add(self, x, y, z):
+        """Add one reading, returns True once the field has settled"""
+        self.count += 1
+        if not self.settled:
+            self.readings.append((x, y, z))
+            if all(abs(value - self.mean[axis]) <= self.limit[axis] for axis, value in enumerate((x, y, z))):
+                self.in_tolerance += 1
+            else:
+                self.in_tolerance = 0
+            self.settled = self.in_tolerance >= self.settle_count
+            if self.settled:
+                self.readings = []
+        return self.settled
+
+    def late_readings(self):
+        """Second half of the readings of a pause that has not settled, after most of the decay"""
+        return self.readings[len(self.readings) // 2:]
@@ -0,0 +1,322 @@
+#!/usr/bin/python
+#
+# Summary:
+# Response maps from recorded scans.
+# Streams a result file (mag_profile.csv, a columnar mag_profile.col or a
+# chunked mag_profile.chk) in chunks, groups the valid readings of one
+# sensor by up to three keys, by default (freq_x, freq_z, clock1_phase),
+# and computes for every cell the count, mean and standard deviation of |B|
+# and of each axis, with the axis means given as deltas from a baseline.
+# The result is a dense grid, 2-D or 3-D depending on the number of keys,
+# saved with NumPy as .npz, and optionally a CSV with one line per cell.
+#
+# Each chunk is reduced to per cell sums (count, sum and sum of squares) in
+# a worker process, so only those partial sums travel back and are merged;
+# the file itself is never loaded whole.  A CSV is split into byte ranges
+# on line boundaries, columnar files into row ranges and chunked files by
+# chunk.
+#
+# Group keys are result columns (freq_x, freq_y, freq_z, clock1_phase,
+# clock2_phase) or ratio, freq_z / freq_x.  --bin coarsens a key, e.g.
+# --bin freq_z=10 puts 10 Hz of offset frequency in each cell.
+#
+# Usage:
+#   python mag_aggregate.py mag_profile.csv --out response.npz --cells cells.csv
+#   python mag_aggregate.py mag_profile.col --group freq_x ratio --bin ratio=0.01 --workers 4
+#
+# MIT Open Source License
+# https://opensource.org/licenses/MIT
+#
+
+import argparse
+import concurrent.futures
+import os
+import time
+
+import numpy
+
+from mag_chunked import COLUMN_NUMBER, FILE_MAGIC, ChunkedData, read_chunk
+from mag_columnar import INVALID_FIELD, ColumnarData
+from mag_scan_info import CSV_HEADER
+
+KEY_COLUMNS = ['freq_x', 'freq_y', 'freq_z', 'clock1_phase', 'clock2_phase']
+RATIO = 'ratio'
+FIELD_COLUMNS = ['mag_x', 'mag_y', 'mag_z']
+# per cell sums, in this order
+SUMS = ['count', 'b', 'b2', 'x', 'x2', 'y', 'y2', 'z', 'z2']
+CSV_COLUMNS = CSV_HEADER.split(',')
+
+
+# = Reading chunks, in the worker processes
+def csv_tasks(path, chunk_bytes):
+    size = os.path.getsize(path)
+    fh = open(path, 'rb')
+    header_end = len(fh.readline())
+    fh.close()
+    return [('csv', path, start, min(start + chunk_bytes, size)) for start in range(header_end, size, chunk_bytes)]
+
+
+def read_csv_range(path, start, end, sensor):
+    # lines that start within start..end-1, parsed into columns
+    wanted = KEY_COLUMNS + FIELD_COLUMNS
+    numbers = [CSV_COLUMNS.index(name) for name in wanted]
+    sensor_column = CSV_COLUMNS.index('sensor')
+    rows = []
+    fh = open(path, 'rb')
+    fh.seek(start - 1)
+    fh.readline()   # to the first line starting at or after start
+    position = fh.tell()
+    while position < end:
+        line = fh.readline()
+        if not line:
+            break
+        position += len(line)
+        values = line.decode('ascii').rstrip('\r\n').split(',')
+        if values[5] == '' or values[sensor_column] != sensor:
+            continue    # failed read, or another sensor
+        rows.append([int(values[number]) for number in numbers])
+    fh.close()
+    data = numpy.array(rows, dtype=numpy.int64).reshape(-1, len(wanted))
+    return dict((name, data[:, i]) for i, name in enumerate(wanted))
+
+
+def columnar_tasks(path, chunk_rows):
+    rows = ColumnarData(path).rows
+    return [('columnar', path, start, min(start + chunk_rows, rows)) for start in range(0, rows, chunk_rows)]
+
+
+def read_columnar_range(path, start, stop, sensor):
+    data = ColumnarData(path)
+    columns = dict((name, numpy.asarray(data.column(name)[start:stop], dtype=numpy.int64))
+                   for name in KEY_COLUMNS + FIELD_COLUMNS)
+    sensors = data.header['sensors']
+    code = sensors.index(sensor) if sensor in sensors else -1
+    keep = (numpy.asarray(data.column('sensor')[start:stop]) == code) & (columns['mag_x'] != INVALID_FIELD)
+    return dict((name, values[keep]) for name, values in columns.items())
+
+
+def chunked_tasks(path, chunks_per_task):
+    data = ChunkedData(path)
+    chunks = len(data.chunks)
+    data.close()
+    return [('chunked', path, first, min(first + chunks_per_task, chunks)) for first in range(0, chunks, chunks_per_task)]
+
+
+def read_chunked_range(path, first, stop, sensor):
+    data = ChunkedData(path)
+    parts = []
+    for chunk in data.chunks[first:stop]:
+        columns, sensors = read_chunk(data.fh, chunk)
+        part = dict((name, numpy.asarray(columns[COLUMN_NUMBER[name]], dtype=numpy.int64))
+                    for name in KEY_COLUMNS + FIELD_COLUMNS)
+        code = sensors.index(sensor) if sensor in sensors else -1
+        keep = (numpy.asarray(columns[COLUMN_NUMBER['sensor']]) == code) & (part['mag_x'] != INVALID_FIELD)
+        parts.append(dict((name, values[keep]) for name, values in part.items()))
+    data.close()
+    return dict((name, numpy.concatenate([part[name] for part in parts])) for name in KEY_COLUMNS + FIELD_COLUMNS)
+
+
+READERS = {'csv': read_csv_range, 'columnar': read_columnar_range, 'chunked': read_chunked_range}
+
+
+# = Grouping
+def group_keys(columns, group, bins):
+    # one column per group key, binned, as float64 so ratio and integer keys mix
+    keys = []
+    for name in group:
+        if name == RATIO:
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                values = columns['freq_z'] / numpy.where(columns['freq_x'] == 0, numpy.nan, columns['freq_x'])
+        else:
+            values = columns[name].astype(numpy.float64)
+        step = bins.get(name)
+        if step:
+            values = numpy.floor(values / step + 1e-9) * step
+        keys.append(values)
+    return numpy.column_stack(keys) if keys else numpy.zeros((0, len(group)))
+
+
+def reduce_sums(keys, sums):
+    """Add up rows of sums that share a key, returns (unique keys, summed sums)"""
+    if not len(keys):
+        return keys, sums
+    # factorize each key column, then the combined integer code, much faster than unique rows
+    code = numpy.zeros(len(keys), dtype=numpy.int64)
+    for i in range(keys.shape[1]):
+        column_values, column_codes = numpy.unique(keys[:, i], return_inverse=True)
+        code = code * len(column_values) + column_codes.reshape(-1)
+    codes, first, inverse = numpy.unique(code, return_index=True, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    unique = keys[first]
+    totals = numpy.zeros((len(unique), sums.shape[1]))
+    for i in range(sums.shape[1]):
+        totals[:, i] = numpy.bincount(inverse, weights=sums[:, i], minlength=len(unique))
+    return unique, totals
+
+
+def aggregate_task(task, group, bins, sensor):
+    """Worker: per cell sums for one range of a result file"""
+    kind, path, start, stop = task
+    columns = READERS[kind](path, start, stop, sensor)
+    keys = group_keys(columns, group, bins)
+    x, y, z = [columns[name].astype(numpy.float64) for name in FIELD_COLUMNS]
+    b = numpy.sqrt(x * x + y * y + z * z)
+    sums = numpy.column_stack([numpy.ones_like(b), b, b * b, x, x * x, y, y * y, z, z * z])
+    finite = numpy.all(numpy.isfinite(keys), axis=1)
+    unique, totals = reduce_sums(keys[finite], sums[finite])
+    return unique, totals, len(b)
+
+
+class ResponseMap(object):
+    """Merged per cell sums and the statistics derived from them"""
+    def __init__(self, group):
+        self.group = group
+        self.keys = numpy.zeros((0, len(group)))
+        self.sums = numpy.zeros((0, len(SUMS)))
+        self.rows = 0
+        self.pending = []   # partial results not merged yet
+
+    def add(self, keys, sums, rows):
+        self.pending.append((keys, sums))
+        self.rows += rows
+        if len(self.pending) >= 16:
+            self.merge()
+
+    def merge(self):
+        if self.pending:
+            keys = numpy.concatenate([self.keys] + [keys for keys, sums in self.pending])
+            sums = numpy.concatenate([self.sums] + [sums for keys, sums in self.pending])
+            self.keys, self.sums = reduce_sums(keys, sums)
+            self.pending = []
+
+    def statistics(self, baseline=None):
+        """Per cell statistics, a dict of arrays.  baseline is (x, y, z), default the mean over all cells"""
+        self.merge()
+        s = dict((name, self.sums[:, i]) for i, name in enumerate(SUMS))
+        n = s['count']
+        total = n.sum()
+        if baseline is None:
+            baseline = [s[axis].sum() / total if total else 0.0 for axis in 'xyz']
+        stats = {'count': n}
+        stats['b_mean'] = s['b'] / n
+        stats['b_std'] = numpy.sqrt(numpy.maximum(s['b2'] / n - stats['b_mean'] ** 2, 0.0))
+        for axis, base in zip('xyz', baseline):
+            mean = s[axis] / n
+            stats['d%s_mean' % axis] = mean - base
+            stats['%s_std' % axis] = numpy.sqrt(numpy.maximum(s[axis + '2'] / n - mean ** 2, 0.0))
+        return stats, baseline
+
+    def grid(self, stats):
+        """Axis values and dense grids (NaN where no reading) of every statistic"""
+        axes = [numpy.unique(self.keys[:, i]) for i in range(len(self.group))]
+        index = tuple(numpy.searchsorted(axis, self.keys[:, i]) for i, axis in enumerate(axes))
+        shape = tuple(len(axis) for axis in axes)
+        grids = {}
+        for name, values in stats.items():
+            grid = numpy.full(shape, 0 if name == 'count' else numpy.nan)
+            grid[index] = values
+            grids[name] = grid
+        return axes, grids
+
+
+def is_chunked(path):
+    fh = open(path, 'rb')
+    magic = fh.read(len(FILE_MAGIC))
+    fh.close()
+    return magic == FILE_MAGIC
+
+
+def aggregate(path, group, bins=None, sensor='', workers=None, chunk_rows=1 << 20, chunk_bytes=64 << 20,
+              progress=None):
+    """ResponseMap for the result file at path"""
+    bins = bins or {}
+    workers = workers or os.cpu_count() or 1
+    if os.path.isdir(path):
+        tasks = columnar_tasks(path, chunk_rows)
+    elif is_chunked(path):
+        data = ChunkedData(path)
+        chunks_per_task = max(1, chunk_rows // data.header['chunk_rows'])
+        data.close()
+        tasks = chunked_tasks(path, chunks_per_task)
+    else:
+        tasks = csv_tasks(path, chunk_bytes)
+    response = ResponseMap(group)
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+    try:
+        # a bounded number of tasks in flight keeps memory flat
+        in_flight = set()
+        queue = list(reversed(tasks))
+        limit = 2 * workers
+        done_tasks = 0
+        while queue or in_flight:
+            while queue and len(in_flight) < limit:
+                in_flight.add(executor.submit(aggregate_task, queue.pop(), group, bins, sensor))
+            done, in_flight = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                response.add(*future.result())
+                done_tasks += 1
+                if progress is not None:
+                    progress(done_tasks, len(tasks), response.rows)
+    finally:
+        executor.shutdown()
+    response.merge()
+    return response
+
+
+def write_cells(path, group, keys, stats):
+    names = ['count', 'b_mean', 'b_std', 'dx_mean', 'x_std', 'dy_mean', 'y_std', 'dz_mean', 'z_std']
+    fh = open(path, 'w')
+    fh.write(','.join(group + names) + '\n')
+    for i in range(len(keys)):
+        fh.write(','.join(['%g' % value for value in keys[i]] + ['%d' % stats['count'][i]] +
+                          ['%.3f' % stats[name][i] for name in names[1:]]) + '\n')
+    fh.close()
+
+
+def parse_bins(values):
+    bins = {}
+    for value in values or []:
+        name, step = value.split('=')
+        bins[name] = float(step)
+    return bins
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Aggregate a scan into response grids over frequency and phase')
+    parser.add_argument('path', help='mag_profile.csv, a columnar directory or a chunked file')
+    parser.add_argument('--group', nargs='+', default=['freq_x', 'freq_z', 'clock1_phase'],
+                        choices=KEY_COLUMNS + [RATIO], help='up to three group keys')
+    parser.add_argument('--bin', nargs='*', metavar='KEY=STEP', help='cell size of a group key')
+    parser.add_argument('--sensor', default='', help='sensor array position (default the main sensor)')
+    parser.add_argument('--baseline', nargs=3, type=float, metavar=('X', 'Y', 'Z'),
+                        help='field the axis deltas are taken from (default the mean of all readings)')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes (default one per CPU)')
+    parser.add_argument('--chunk-rows', type=int, default=1 << 20)
+    parser.add_argument('--out', default='response.npz', help='grids, axes and statistics')
+    parser.add_argument('--cells', help='also write one CSV line per cell')
+    args = parser.parse_args()
+    if len(args.group) > 3:
+        parser.error('at most three group keys')
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    start = time.time()
+
+    def report(done, total, rows):
+        print('%d/%d chunks, %d rows, %.1f s' % (done, total, rows, time.time() - start))
+
+    response = aggregate(args.path, args.group, parse_bins(args.bin), args.sensor, args.workers, args.chunk_rows,
+                         progress=report)
+    stats, baseline = response.statistics(args.baseline)
+    axes, grids = response.grid(stats)
+    arrays = dict(('grid_' + name, grid) for name, grid in grids.items())
+    arrays.update(('axis_%s' % name, axis) for name, axis in zip(args.group, axes))
+    numpy.savez(args.out, group=numpy.array(args.group), baseline=numpy.array(baseline), **arrays)
+    if args.cells:
+        write_cells(args.cells, args.group, response.keys, stats)
+    elapsed = time.time() - start
+    print('%d rows in %d cells, grid %s, baseline %.1f %.1f %.1f, %.1f s (%.0f rows/s)' % (
+        response.rows, len(response.keys), 'x'.join(str(len(axis)) for axis in axes),
+        baseline[0], baseline[1], baseline[2], elapsed, response.rows / elapsed if elapsed else 0))
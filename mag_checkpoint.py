@@ -0,0 +1,114 @@
+#!/usr/bin/python
+#
+# Summary:
+# Crash safe checkpoints for long scans.
+# After each batch of samples is appended (and fsync'd) to mag_profile.csv we
+# atomically replace a small JSON checkpoint recording the next scan point,
+# the data file length that goes with it, and the adaptive/drift/RNG state
+# and the points waiting to be measured again (mag_retest.py).
+# On resume the data file is truncated back to that length, so rows written
+# after the last checkpoint are dropped and re-measured rather than duplicated.
+#
+# MIT Open Source License
+# https://opensource.org/licenses/MIT
+#
+
+import copy
+import json
+import os
+import random
+
+CHECKPOINT_VERSION = 1
+
+
+def write_checkpoint(path, state):
+    """Atomically replace the checkpoint at path with state (a JSON-able dict)"""
+    temp_path = path + '.tmp'
+    fh = open(temp_path, 'w')
+    json.dump(state, fh)
+    fh.flush()
+    os.fsync(fh.fileno())
+    fh.close()
+    os.replace(temp_path, path)
+    # make the rename itself durable
+    dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+def read_checkpoint(path):
+    """Returns the checkpoint state, or None if there is no checkpoint"""
+    if not os.path.isfile(path):
+        return None
+    fh = open(path)
+    state = json.load(fh)
+    fh.close()
+    if state.get('version') != CHECKPOINT_VERSION:
+        raise ValueError('%s: unsupported checkpoint version %r' % (path, state.get('version')))
+    return state
+
+
+def remove_checkpoint(path):
+    if os.path.isfile(path):
+        os.remove(path)
+
+
+def checkpoint_state(scan_info):
+    """Snapshot of everything needed to continue the scan at scan_info.scan_index"""
+    rng_version, rng_internal, rng_gauss = random.getstate()
+    state = {
+        'version': CHECKPOINT_VERSION,
+        'scan_index': scan_info.scan_index,
+        'cycle_count': scan_info.cycle_count,
+        'scan_points': len(scan_info.scan_space) if scan_info.scan_space is not None else None,
+        'optimize_order': scan_info.optimize_order,
+        'result_format': scan_info.result_format,
+        'random': [rng_version, list(rng_internal), rng_gauss],
+        'baseline': None,
+        'drift_model': None,
+        'retest': None,
+    }
+    # deep copies: the writer thread saves the state while the scan keeps updating these
+    if scan_info.baseline is not None:
+        state['baseline'] = copy.deepcopy(scan_info.baseline.__dict__)
+    if scan_info.drift_model is not None:
+        state['drift_model'] = copy.deepcopy(scan_info.drift_model.__dict__)
+    if scan_info.retest is not None:
+        state['retest'] = scan_info.retest.state()
+    else:
+        # closed before the interrupted samples are saved, or not open in this run
+        state['retest'] = scan_info.retest_state
+    return state
+
+
+def restore_state(scan_info, state):
+    """Continue from a checkpoint, scan_info must describe the same scan"""
+    if scan_info.scan_space is not None and state['scan_points'] != len(scan_info.scan_space):
+        raise ValueError('checkpoint is for a scan of %s points, this scan has %d' % (
+            state['scan_points'], len(scan_info.scan_space)))
+    if state.get('optimize_order', False) != scan_info.optimize_order:
+        raise ValueError('checkpoint was taken with optimize_order %s, scan_index would refer to a different point'
+                         % state.get('optimize_order', False))
+    scan_info.result_format = state.get('result_format', 'csv')
+    scan_info.scan_index = state['scan_index']
+    scan_info.scan_start_index = scan_info.scan_index
+    scan_info.cycle_count = state['cycle_count']
+    rng_version, rng_internal, rng_gauss = state['random']
+    random.setstate((rng_version, tuple(rng_internal), rng_gauss))
+    if state['baseline'] is not None and scan_info.baseline is not None:
+        scan_info.baseline.__dict__.update(state['baseline'])
+    if state['drift_model'] is not None and scan_info.drift_model is not None:
+        scan_info.drift_model.__dict__.update(state['drift_model'])
+    # the RetestQueue is only opened by run_scan, it picks this up then
+    scan_info.retest_state = state.get('retest')
+
+
+def truncate_data(path, length):
+    """Drop anything appended to the data file after the checkpoint"""
+    fh = open(path, 'r+b')
+    fh.truncate(length)
+    fh.flush()
+    os.fsync(fh.fileno())
+    fh.close()
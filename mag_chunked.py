@@ -0,0 +1,487 @@
+#!/usr/bin/python
+#
+# Summary:
+# Chunked, compressed scan results with a chunk index.
+# Results are stored in one append only file, mag_profile.chk, as a file
+# header followed by chunks of up to chunk_rows rows.  Each chunk holds the
+# columns of mag_columnar.py; integer columns are delta encoded (frequencies,
+# phases, field values and timestamps change little from row to row) and
+# the whole chunk is zlib compressed.  The chunk header carries the row
+# count, a CRC32 of the chunk and the min/max of the frequency, phase, time
+# and point columns, so a reader can find the chunks a query touches by
+# reading the headers only and decompress just those.
+#
+# Standard library only, so results can be checked anywhere:
+#   python mag_chunked.py verify mag_profile.chk
+#   python mag_chunked.py info mag_profile.chk
+#   python mag_chunked.py export mag_profile.chk out.csv --freq-y 20000 20100
+#   python mag_chunked.py import mag_profile.csv mag_profile.chk
+#
+# While a scan runs, each commit appends the rows not yet in the file as a
+# small chunk, and once chunk_rows rows have collected they are appended
+# again as one full chunk.  Each chunk header carries the row number of its
+# first row; a chunk replaces the chunks before it that start at or after
+# that row, so the full chunk supersedes the small ones.  Bytes a checkpoint
+# covers are never rewritten: truncating the file to a checkpoint's
+# data_length always leaves every row the checkpoint counts as done.  The
+# superseded small chunks stay in the file until it is compacted:
+#   python mag_chunked.py compact mag_profile.chk compacted.chk
+#
+# MIT Open Source License
+# https://opensource.org/licenses/MIT
+#
+
+import argparse
+import array
+import itertools
+import json
+import os
+import struct
+import sys
+import time
+import zlib
+
+from mag_columnar import COLUMNS, DECISIONS, INVALID_FIELD, column_samples, parse_csv_row, sample_columns
+from mag_scan_info import CSV_HEADER, csv_row
+
+CHUNKED_VERSION = 2
+FILE_MAGIC = b'MAGCHUNK'
+CHUNK_MAGIC = b'CHNK'
+FILE_HEADER = struct.Struct('<8sII')      # magic, version, header JSON length
+CHUNK_HEADER = struct.Struct('<4sQIIII')  # magic, first row, rows, names JSON length, payload length, CRC32
+INDEX_COLUMNS = ['freq_x', 'freq_y', 'freq_z', 'clock1_phase', 'clock2_phase', 'burst_start_ns', 'point']
+INDEX = struct.Struct('<' + 'qq' * len(INDEX_COLUMNS))   # min, max of each index column
+
+# integer columns stored as differences from the previous row, in a type wide enough for any difference
+DELTA_TYPES = {'I': 'q', 'h': 'i', 'q': 'q'}
+BIG_ENDIAN = sys.byteorder == 'big'
+COLUMN_NUMBER = dict((name, number) for number, (name, typecode, attribute) in enumerate(COLUMNS))
+
+
+def encode_column(values):
+    typecode = DELTA_TYPES.get(values.typecode)
+    if typecode is None:
+        encoded = array.array(values.typecode, values)
+    else:
+        previous = 0
+        encoded = array.array(typecode)
+        for value in values:
+            encoded.append(value - previous)
+            previous = value
+    if BIG_ENDIAN:
+        encoded.byteswap()
+    return encoded.tobytes()
+
+
+def decode_column(data, typecode):
+    stored = array.array(DELTA_TYPES.get(typecode, typecode))
+    stored.frombytes(data)
+    if BIG_ENDIAN:
+        stored.byteswap()
+    if typecode not in DELTA_TYPES:
+        return stored
+    return array.array(typecode, itertools.accumulate(stored))
+
+
+def stored_width(typecode):
+    return array.array(DELTA_TYPES.get(typecode, typecode)).itemsize
+
+
+class ChunkInfo(object):
+    """Where a chunk is and the range of its indexed columns"""
+    def __init__(self, offset, first_row, rows, names_length, payload_length, crc, bounds):
+        self.offset = offset
+        self.first_row = first_row  # row number of the chunk's first row in the whole file
+        self.rows = rows
+        self.names_length = names_length
+        self.payload_length = payload_length
+        self.crc = crc
+        self.bounds = bounds    # index column -> (min, max)
+
+    def size(self):
+        return CHUNK_HEADER.size + INDEX.size + self.names_length + self.payload_length
+
+    def end(self):
+        return self.offset + self.size()
+
+    def overlaps(self, ranges):
+        """True if the chunk may hold rows with every ranges column within (lo, hi)"""
+        for name, (lo, hi) in ranges.items():
+            low, high = self.bounds[name]
+            if high < lo or low > hi:
+                return False
+        return True
+
+
+def encode_chunk(columns, sensors, first_row, level=6):
+    # columns in COLUMNS order, sensors the names the sensor column codes refer to
+    rows = len(columns[0])
+    names = json.dumps(sensors).encode('utf-8')
+    payload = zlib.compress(b''.join(encode_column(values) for values in columns), level)
+    bounds = []
+    for name in INDEX_COLUMNS:
+        values = columns[COLUMN_NUMBER[name]]
+        bounds.extend((min(values), max(values)) if rows else (0, 0))
+    index = INDEX.pack(*bounds)
+    crc = zlib.crc32(payload, zlib.crc32(names, zlib.crc32(index)))
+    header = CHUNK_HEADER.pack(CHUNK_MAGIC, first_row, rows, len(names), len(payload), crc)
+    return header + index + names + payload
+
+
+def read_file_header(fh, path):
+    magic, version, length = FILE_HEADER.unpack(fh.read(FILE_HEADER.size))
+    if magic != FILE_MAGIC or version != CHUNKED_VERSION:
+        raise ValueError('%s: not a version %d chunked result file' % (path, CHUNKED_VERSION))
+    return json.loads(fh.read(length).decode('utf-8'))
+
+
+def create_chunked(path, chunk_rows=4096):
+    """Start a new, empty result file at path, replacing any old one"""
+    header = {
+        'columns': [{'name': name, 'typecode': typecode, 'delta': typecode in DELTA_TYPES}
+                    for name, typecode, attribute in COLUMNS],
+        'index': INDEX_COLUMNS,
+        'chunk_rows': chunk_rows,
+        'decisions': DECISIONS,
+        'invalid_field': INVALID_FIELD,
+        'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+    }
+    data = json.dumps(header).encode('utf-8')
+    fh = open(path, 'wb')
+    fh.write(FILE_HEADER.pack(FILE_MAGIC, CHUNKED_VERSION, len(data)) + data)
+    fh.flush()
+    os.fsync(fh.fileno())
+    fh.close()
+
+
+def scan_chunks(fh):
+    # chunk headers from the current position to the end of the file, reads no payload
+    # includes superseded chunks, see live_chunks
+    chunks = []
+    while True:
+        offset = fh.tell()
+        data = fh.read(CHUNK_HEADER.size + INDEX.size)
+        if len(data) < CHUNK_HEADER.size + INDEX.size:
+            break
+        magic, first_row, rows, names_length, payload_length, crc = CHUNK_HEADER.unpack(data[:CHUNK_HEADER.size])
+        if magic != CHUNK_MAGIC:
+            raise ValueError('bad chunk at offset %d' % offset)
+        values = INDEX.unpack(data[CHUNK_HEADER.size:])
+        bounds = dict((name, (values[2 * i], values[2 * i + 1])) for i, name in enumerate(INDEX_COLUMNS))
+        chunk = ChunkInfo(offset, first_row, rows, names_length, payload_length, crc, bounds)
+        if os.fstat(fh.fileno()).st_size < chunk.end():
+            break   # cut short by a crash, ignored
+        fh.seek(chunk.end())
+        chunks.append(chunk)
+    return chunks
+
+
+def live_chunks(chunks):
+    """The chunks holding the file's rows, in row order: a chunk replaces those
+    before it that start at or after its first row
+    """
+    live = []
+    for chunk in chunks:
+        while live and live[-1].first_row >= chunk.first_row:
+            live.pop()
+        live.append(chunk)
+    return live
+
+
+def read_chunk(fh, chunk, verify=True):
+    """Columns (in COLUMNS order) and sensor names of a chunk"""
+    fh.seek(chunk.offset + CHUNK_HEADER.size)
+    index = fh.read(INDEX.size)
+    names = fh.read(chunk.names_length)
+    payload = fh.read(chunk.payload_length)
+    if verify and zlib.crc32(payload, zlib.crc32(names, zlib.crc32(index))) != chunk.crc:
+        raise ValueError('chunk at offset %d: CRC mismatch' % chunk.offset)
+    data = zlib.decompress(payload)
+    columns = []
+    position = 0
+    for name, typecode, attribute in COLUMNS:
+        length = chunk.rows * stored_width(typecode)
+        columns.append(decode_column(data[position:position + length], typecode))
+        position += length
+    if position != len(data):
+        raise ValueError('chunk at offset %d: %d bytes of data for %d rows' % (chunk.offset, len(data), chunk.rows))
+    return columns, json.loads(names.decode('utf-8'))
+
+
+class ChunkedStore(object):
+    """Appends samples to a chunked result file, a store for SampleWriter"""
+    def __init__(self, path, chunk_rows=None, level=6):
+        self.path = path
+        self.level = level    # zlib compression level
+        if not os.path.isfile(path):
+            create_chunked(path, chunk_rows or 4096)
+        self.fh = open(path, 'r+b')
+        self.header = read_file_header(self.fh, path)
+        self.chunk_rows = chunk_rows or self.header['chunk_rows']
+        chunks = scan_chunks(self.fh)
+        # anything after the last complete chunk was cut short
+        self.fh.truncate(chunks[-1].end() if chunks else self.fh.tell())
+        self.fh.seek(0, os.SEEK_END)
+        self.first_row = 0      # row number of the first pending row, the rows before it are in full chunks
+        self.pending = [array.array(typecode) for name, typecode, attribute in COLUMNS]
+        self.written = 0        # pending rows already in the file as small chunks
+        # sensor names only ever grow, every chunk carries the whole table
+        self.sensors = ['']
+        live = live_chunks(chunks)
+        full = 0
+        while full < len(live) and live[full].rows >= self.chunk_rows:
+            full += 1
+        if full:
+            self.first_row = live[full - 1].first_row + live[full - 1].rows
+            columns, self.sensors = read_chunk(self.fh, live[full - 1])
+        for chunk in live[full:]:
+            # small chunks after the last full one are collected again
+            columns, self.sensors = read_chunk(self.fh, chunk)
+            for pending, values in zip(self.pending, columns):
+                pending.extend(values)
+            self.written += chunk.rows
+        self.sensor_codes = dict((name, code) for code, name in enumerate(self.sensors))
+        self.dirty = False
+
+    def sensor_code(self, name):
+        code = self.sensor_codes.get(name)
+        if code is None:
+            code = len(self.sensors)
+            if code > 255:
+                raise ValueError('too many sensor names for the sensor column')
+            self.sensors.append(name)
+            self.sensor_codes[name] = code
+        return code
+
+    def append(self, samples):
+        for pending, values in zip(self.pending, sample_columns(samples, self.sensor_code)):
+            pending.extend(values)
+        self.dirty = True
+        while len(self.pending[0]) >= self.chunk_rows:
+            # supersedes the small chunks of these rows, and of any after them
+            self.write_chunk([values[:self.chunk_rows] for values in self.pending], self.first_row)
+            self.pending = [values[self.chunk_rows:] for values in self.pending]
+            self.first_row += self.chunk_rows
+            self.written = 0
+
+    def write_chunk(self, columns, first_row):
+        # always appended, bytes a checkpoint may cover are never rewritten
+        self.fh.write(encode_chunk(columns, self.sensors, first_row, self.level))
+
+    def sync(self):
+        """Write the rows collected so far and flush, returns the file length a checkpoint should record"""
+        if self.dirty and self.written < len(self.pending[0]):
+            self.write_chunk([values[self.written:] for values in self.pending], self.first_row + self.written)
+            self.written = len(self.pending[0])
+        self.dirty = False
+        self.fh.flush()
+        os.fsync(self.fh.fileno())
+        return os.fstat(self.fh.fileno()).st_size
+
+    def close(self):
+        self.sync()
+        self.fh.close()
+
+
+class ChunkedData(object):
+    """Read access to a chunked result file.  ranges arguments map index
+    column names to inclusive (lo, hi) bounds, e.g. {'freq_y': (20000, 20100)}.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.fh = open(path, 'rb')
+        self.header = read_file_header(self.fh, path)
+        self.stored_chunks = scan_chunks(self.fh)    # including superseded ones
+        self.chunks = live_chunks(self.stored_chunks)
+        self.rows = sum(chunk.rows for chunk in self.chunks)
+
+    def select(self, ranges):
+        """Chunks that may hold rows within ranges, found from the chunk headers alone"""
+        for name in ranges:
+            if name not in INDEX_COLUMNS:
+                raise ValueError('%s is not indexed, use one of %s' % (name, ', '.join(INDEX_COLUMNS)))
+        return [chunk for chunk in self.chunks if chunk.overlaps(ranges)]
+
+    def samples(self, ranges=None):
+        """MagSample objects for the rows within ranges, decompressing only the chunks that may hold them"""
+        ranges = ranges or {}
+        for chunk in self.select(ranges):
+            columns, sensors = read_chunk(self.fh, chunk)
+            keep = None
+            for name, (lo, hi) in ranges.items():
+                values = columns[COLUMN_NUMBER[name]]
+                if lo <= chunk.bounds[name][0] and chunk.bounds[name][1] <= hi:
+                    continue    # the whole chunk is inside
+                inside = [lo <= value <= hi for value in values]
+                keep = inside if keep is None else [a and b for a, b in zip(keep, inside)]
+            samples = column_samples(columns, sensors, self.header['decisions'], self.header['invalid_field'])
+            if keep is None:
+                for sample in samples:
+                    yield sample
+            else:
+                for sample, wanted in zip(samples, keep):
+                    if wanted:
+                        yield sample
+
+    def verify(self):
+        """Problems found checking every chunk, an empty list if the file is sound"""
+        problems = []
+        size = os.fstat(self.fh.fileno()).st_size
+        end = self.stored_chunks[-1].end() if self.stored_chunks else None
+        if end is not None and end != size:
+            problems.append('%d bytes after the last complete chunk' % (size - end))
+        for number, chunk in enumerate(self.chunks):
+            try:
+                columns, sensors = read_chunk(self.fh, chunk)
+            except (ValueError, zlib.error) as error:
+                problems.append('chunk %d: %s' % (number, error))
+                continue
+            if len(columns[0]) != chunk.rows:
+                problems.append('chunk %d: %d rows, header says %d' % (number, len(columns[0]), chunk.rows))
+            for name in INDEX_COLUMNS:
+                values = columns[COLUMN_NUMBER[name]]
+                if chunk.rows and (min(values), max(values)) != chunk.bounds[name]:
+                    problems.append('chunk %d: %s index %s does not match the data %s' % (
+                        number, name, chunk.bounds[name], (min(values), max(values))))
+            if max(columns[COLUMN_NUMBER['sensor']] or [0]) >= len(sensors):
+                problems.append('chunk %d: sensor code without a name' % number)
+            first_row = sum(previous.rows for previous in self.chunks[:number])
+            if chunk.first_row != first_row:
+                problems.append('chunk %d: starts at row %d, the chunks before it hold %d' % (
+                    number, chunk.first_row, first_row))
+            if (number < len(self.chunks) - 1 and chunk.rows != self.header['chunk_rows']
+                    and self.chunks[number + 1].rows == self.header['chunk_rows']):
+                problems.append('chunk %d: %d rows, only chunks after the last full one may be partial' % (
+                    number, chunk.rows))
+        return problems
+
+    def close(self):
+        self.fh.close()
+
+
+def truncate_chunked(path, length):
+    """Drop anything appended after a checkpoint, length is the checkpoint's data_length"""
+    fh = open(path, 'r+b')
+    fh.truncate(length)
+    fh.flush()
+    os.fsync(fh.fileno())
+    fh.close()
+
+
+def compact(path, out_path):
+    """Copy the rows of path to a new file without superseded chunks, returns the number of rows"""
+    data = ChunkedData(path)
+    create_chunked(out_path, data.header['chunk_rows'])
+    store = ChunkedStore(out_path)
+    rows = 0
+    for chunk in data.chunks:
+        columns, sensors = read_chunk(data.fh, chunk)
+        store.append(column_samples(columns, sensors, data.header['decisions'], data.header['invalid_field']))
+        rows += chunk.rows
+    store.close()
+    data.close()
+    return rows
+
+
+def import_csv(csv_path, path, chunk_rows=4096, batch_rows=65536):
+    """Convert a mag_profile.csv to a new chunked file, returns the number of rows"""
+    fh = open(csv_path)
+    if fh.readline().strip() != CSV_HEADER:
+        raise ValueError('%s: unexpected columns, expected %s' % (csv_path, CSV_HEADER))
+    create_chunked(path, chunk_rows)
+    store = ChunkedStore(path)
+    rows = 0
+    batch = []
+    for line in fh:
+        batch.append(parse_csv_row(line))
+        if len(batch) >= batch_rows:
+            store.append(batch)
+            rows += len(batch)
+            batch = []
+    store.append(batch)
+    rows += len(batch)
+    store.close()
+    fh.close()
+    return rows
+
+
+def export_csv(path, csv_path, ranges=None):
+    """Write the rows within ranges as mag_profile.csv, returns the number of rows"""
+    data = ChunkedData(path)
+    out = open(csv_path, 'w', buffering=1 << 16)
+    out.write(CSV_HEADER + '\n')
+    rows = 0
+    for sample in data.samples(ranges):
+        out.write(csv_row(sample) + '\n')
+        rows += 1
+    out.close()
+    data.close()
+    return rows
+
+
+def info(path):
+    data = ChunkedData(path)
+    size = os.path.getsize(path)
+    raw = data.rows * sum(array.array(typecode).itemsize for name, typecode, attribute in COLUMNS)
+    lines = ['%s: %d rows in %d chunks of %d, %d bytes (%.1f per row, %.1fx smaller than uncompressed columns)' % (
+        path, data.rows, len(data.chunks), data.header['chunk_rows'], size,
+        float(size) / data.rows if data.rows else 0.0, float(raw) / size if size else 0.0)]
+    superseded = [chunk for chunk in data.stored_chunks if chunk not in data.chunks]
+    if superseded:
+        lines.append('  %d superseded chunks, %d bytes (compact to remove them)' % (
+            len(superseded), sum(chunk.size() for chunk in superseded)))
+    for name in INDEX_COLUMNS:
+        if data.chunks:
+            lines.append('  %-15s %d .. %d' % (name, min(chunk.bounds[name][0] for chunk in data.chunks),
+                                               max(chunk.bounds[name][1] for chunk in data.chunks)))
+    data.close()
+    return '\n'.join(lines)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Chunked compressed scan results')
+    commands = parser.add_subparsers(dest='command')
+    command = commands.add_parser('info', help='describe a result file')
+    command.add_argument('path')
+    command = commands.add_parser('verify', help='check every chunk against its CRC and index')
+    command.add_argument('path')
+    command = commands.add_parser('export', help='write rows as CSV, optionally only those within ranges')
+    command.add_argument('path')
+    command.add_argument('csv')
+    for name in INDEX_COLUMNS:
+        command.add_argument('--' + name.replace('_', '-'), nargs=2, type=int, metavar=('LO', 'HI'), dest=name)
+    command = commands.add_parser('compact', help='copy to a new file without superseded chunks')
+    command.add_argument('path')
+    command.add_argument('out')
+    command = commands.add_parser('import', help='convert a mag_profile.csv')
+    command.add_argument('csv')
+    command.add_argument('path')
+    command.add_argument('--chunk-rows', type=int, default=4096)
+    args = parser.parse_args()
+    if args.command is None:
+        parser.error('a command is required')
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    start = time.time()
+    if args.command == 'info':
+        print(info(args.path))
+    elif args.command == 'verify':
+        data = ChunkedData(args.path)
+        problems = data.verify()
+        for problem in problems:
+            print(problem)
+        print('%s: %d chunks, %d rows, %s' % (args.path, len(data.chunks), data.rows,
+                                              '%d problems' % len(problems) if problems else 'OK'))
+        sys.exit(1 if problems else 0)
+    elif args.command == 'export':
+        ranges = dict((name, tuple(getattr(args, name))) for name in INDEX_COLUMNS if getattr(args, name))
+        print('%d rows exported in %.1f s' % (export_csv(args.path, args.csv, ranges), time.time() - start))
+    elif args.command == 'compact':
+        rows = compact(args.path, args.out)
+        print('%d rows compacted in %.1f s' % (rows, time.time() - start))
+    elif args.command == 'import':
+        rows = import_csv(args.csv, args.path, args.chunk_rows)
+        print('%d rows imported in %.1f s' % (rows, time.time() - start))
@@ -0,0 +1,454 @@
+#!/usr/bin/python
+#
+# Summary:
+# Binary columnar scan results, an alternative to mag_profile.csv.
+# A result set is a directory holding header.json and one file per column.
+# Every column is a raw little endian array of fixed width values, so
+# appending a batch of samples is one write per column and a finished scan
+# can be memory mapped as NumPy arrays without parsing anything.
+# header.json describes the columns (name, NumPy dtype, file), the sensor
+# names and adaptive dwell decisions the small integer codes stand for, and
+# the value used for field readings that failed.  The number of rows is the
+# shortest column file, so rows half written by a crash are ignored, and
+# truncate_columnar cuts them off on resume.
+#
+# The scan collects its samples in a SampleBatch, the same columns held in
+# memory, so a batch is appended to a store without converting sample by
+# sample.
+#
+# Usage:
+#   python mag_columnar.py info mag_profile.col
+#   python mag_columnar.py export mag_profile.col mag_profile.csv
+#   python mag_columnar.py import mag_profile.csv mag_profile.col
+#
+# Reading in NumPy:
+#   data = ColumnarData('mag_profile.col')
+#   x = data.column('mag_x')    # numpy.memmap, nothing is read until used
+#
+# MIT Open Source License
+# https://opensource.org/licenses/MIT
+#
+
+import argparse
+import array
+import json
+import os
+import shutil
+import sys
+import time
+
+from mag_checkpoint import write_checkpoint
+from mag_scan_info import CSV_HEADER, MagSample, csv_row
+
+try:
+    import numpy
+except ImportError:
+    numpy = None    # reading falls back to array.array
+
+COLUMNAR_VERSION = 1
+HEADER_FILE = 'header.json'
+INVALID_FIELD = -32768          # mag_x, mag_y, mag_z when the sensor could not be read
+DECISIONS = ['', 'null', 'anomaly']
+
+# name, array typecode, MagSample attribute, in mag_profile.csv column order
+COLUMNS = [
+    ('freq_x', 'I', 'f0'),
+    ('freq_y', 'I', 'f1'),
+    ('freq_z', 'I', 'f2'),
+    ('clock1_phase', 'h', 'clock1_phase_offset'),
+    ('clock2_phase', 'h', 'clock2_phase_offset'),
+    ('mag_x', 'h', 'x'),
+    ('mag_y', 'h', 'y'),
+    ('mag_z', 'h', 'z'),
+    ('duration', 'f', 'duration'),
+    ('pause', 'f', 'pause'),
+    ('decision', 'b', 'decision'),
+    ('temperature', 'b', 'temperature'),
+    ('sensor', 'B', 'sensor'),
+    ('burst_start_ns', 'q', 'burst_start_ns'),
+    ('burst_end_ns', 'q', 'burst_end_ns'),
+    ('ready_ns', 'q', 'ready_ns'),
+    ('read_ns', 'q', 'read_ns'),
+    ('point', 'q', 'point'),
+]
+
+# NumPy dtype for each array typecode, checked against the platform below
+DTYPES = {'I': '<u4', 'h': '<i2', 'f': '<f4', 'b': 'i1', 'B': 'u1', 'q': '<i8'}
+for typecode, dtype in DTYPES.items():
+    if array.array(typecode).itemsize != int(dtype[-1]):
+        raise ImportError('array typecode %s is not %s bytes on this platform' % (typecode, dtype[-1]))
+BIG_ENDIAN = sys.byteorder == 'big'
+COLUMN_SENSOR = [name for name, typecode, attribute in COLUMNS].index('sensor')
+COLUMN_POINT = [name for name, typecode, attribute in COLUMNS].index('point')
+COLUMN_BURST_START = [name for name, typecode, attribute in COLUMNS].index('burst_start_ns')
+COLUMN_BURST_END = [name for name, typecode, attribute in COLUMNS].index('burst_end_ns')
+
+
+def sample_columns(samples, sensor_code):
+    """One array.array per entry of COLUMNS, sensor_code(name) gives the sensor column code"""
+    if isinstance(samples, SampleBatch):
+        return samples.store_columns(sensor_code)
+    columns = [array.array(typecode) for name, typecode, attribute in COLUMNS]
+    (freq_x, freq_y, freq_z, clock1_phase, clock2_phase, mag_x, mag_y, mag_z, duration, pause,
+     decision, temperature, sensor, burst_start_ns, burst_end_ns, ready_ns, read_ns, point) = columns
+    for sample in samples:
+        freq_x.append(sample.f0)
+        freq_y.append(sample.f1)
+        freq_z.append(sample.f2)
+        clock1_phase.append(sample.clock1_phase_offset)
+        clock2_phase.append(sample.clock2_phase_offset)
+        if sample.valid:
+            mag_x.append(sample.x)
+            mag_y.append(sample.y)
+            mag_z.append(sample.z)
+        else:
+            mag_x.append(INVALID_FIELD)
+            mag_y.append(INVALID_FIELD)
+            mag_z.append(INVALID_FIELD)
+        duration.append(sample.duration)
+        pause.append(sample.pause)
+        decision.append(DECISIONS.index(sample.decision or ''))
+        temperature.append(sample.temperature)
+        sensor.append(sensor_code(sample.sensor))
+        burst_start_ns.append(sample.burst_start_ns)
+        burst_end_ns.append(sample.burst_end_ns)
+        ready_ns.append(sample.ready_ns)
+        read_ns.append(sample.read_ns)
+        point.append(sample.point)
+    return columns
+
+
+def column_samples(columns, sensors, decisions=DECISIONS, invalid=INVALID_FIELD):
+    """MagSample objects from columns in COLUMNS order, the inverse of sample_columns"""
+    for values in zip(*columns):
+        sample = MagSample(None, None, None)
+        for (name, typecode, attribute), value in zip(COLUMNS, values):
+            setattr(sample, attribute, value)
+        sample.decision = decisions[sample.decision] or None
+        sample.sensor = sensors[sample.sensor]
+        if sample.x == invalid:
+            sample.valid = False
+        yield sample
+
+
+class SampleBatch(object):
+    """Samples held as columns in COLUMNS order, in arrays preallocated for capacity rows.
+    append copies a MagSample into the next row by index, so a waiting sample
+    takes the width of one row (73 bytes) rather than an object, and stores
+    take the columns in bulk through sample_columns.  Iterating gives
+    MagSample objects again, len() the number of rows.
+    """
+    def __init__(self, capacity=64):
+        self.columns = [array.array(typecode, bytes(array.array(typecode).itemsize * capacity))
+                        for name, typecode, attribute in COLUMNS]
+        self.rows = 0
+        self.sensors = ['']         # sensor column code -> name, for this batch only
+        self.sensor_codes = {'': 0}
+
+    def __len__(self):
+        return self.rows
+
+    def __iter__(self):
+        return column_samples(self.trimmed(), self.sensors)
+
+    def grow(self):
+        # double the capacity
+        for column in self.columns:
+            column.frombytes(bytes(column.itemsize * max(len(column), 16)))
+
+    def sensor_code(self, name):
+        code = self.sensor_codes.get(name)
+        if code is None:
+            code = self.sensor_codes[name] = len(self.sensors)
+            self.sensors.append(name)
+        return code
+
+    def append(self, sample):
+        row = self.rows
+        if row == len(self.columns[0]):
+            self.grow()
+        (freq_x, freq_y, freq_z, clock1_phase, clock2_phase, mag_x, mag_y, mag_z, duration, pause,
+         decision, temperature, sensor, burst_start_ns, burst_end_ns, ready_ns, read_ns, point) = self.columns
+        freq_x[row] = sample.f0
+        freq_y[row] = sample.f1
+        freq_z[row] = sample.f2
+        clock1_phase[row] = sample.clock1_phase_offset
+        clock2_phase[row] = sample.clock2_phase_offset
+        if sample.valid:
+            mag_x[row] = sample.x
+            mag_y[row] = sample.y
+            mag_z[row] = sample.z
+        else:
+            mag_x[row] = mag_y[row] = mag_z[row] = INVALID_FIELD
+        duration[row] = sample.duration
+        pause[row] = sample.pause
+        decision[row] = DECISIONS.index(sample.decision or '')
+        temperature[row] = sample.temperature
+        sensor[row] = self.sensor_code(sample.sensor)
+        burst_start_ns[row] = sample.burst_start_ns
+        burst_end_ns[row] = sample.burst_end_ns
+        ready_ns[row] = sample.ready_ns
+        read_ns[row] = sample.read_ns
+        point[row] = sample.point
+        self.rows = row + 1
+
+    def fill_burst_end(self, burst_start_ns, burst_end_ns):
+        """Set burst_end_ns on the trailing rows of the burst that started at
+        burst_start_ns which were read while its field was still on
+        """
+        starts = self.columns[COLUMN_BURST_START]
+        ends = self.columns[COLUMN_BURST_END]
+        row = self.rows - 1
+        while row >= 0 and starts[row] == burst_start_ns:
+            if ends[row] <= burst_start_ns:
+                ends[row] = burst_end_ns
+            row -= 1
+
+    def trimmed(self):
+        """Copies of the filled part of the columns"""
+        return [column[:self.rows] for column in self.columns]
+
+    def store_columns(self, sensor_code):
+        # the columns with sensor codes translated to those of a store
+        columns = self.trimmed()
+        codes = [sensor_code(name) for name in self.sensors]
+        if codes != list(range(len(codes))):
+            columns[COLUMN_SENSOR] = array.array('B', [codes[code] for code in columns[COLUMN_SENSOR]])
+        return columns
+
+    def before_point(self, point):
+        """A new batch with the rows of points before point"""
+        points = self.columns[COLUMN_POINT]
+        keep = [row for row in range(self.rows) if points[row] < point]
+        batch = SampleBatch(len(keep))
+        batch.sensors = list(self.sensors)
+        batch.sensor_codes = dict(self.sensor_codes)
+        for column, kept in zip(self.columns, batch.columns):
+            for i, row in enumerate(keep):
+                kept[i] = column[row]
+        batch.rows = len(keep)
+        return batch
+
+
+def column_file(name):
+    return name + '.bin'
+
+
+def read_header(path):
+    fh = open(os.path.join(path, HEADER_FILE))
+    header = json.load(fh)
+    fh.close()
+    if header.get('format') != 'mag_columnar' or header.get('version') != COLUMNAR_VERSION:
+        raise ValueError('%s: not a version %d columnar result set' % (path, COLUMNAR_VERSION))
+    return header
+
+
+def create_columnar(path, sensors=()):
+    """Start a new, empty result set at path (a directory), replacing any old one"""
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.makedirs(path)
+    header = {
+        'format': 'mag_columnar',
+        'version': COLUMNAR_VERSION,
+        'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'columns': [{'name': name, 'dtype': DTYPES[typecode], 'file': column_file(name)}
+                    for name, typecode, attribute in COLUMNS],
+        'sensors': [''] + [name for name in sensors if name],   # sensor column codes, 0 is the main sensor
+        'decisions': DECISIONS,                                  # decision column codes
+        'invalid_field': INVALID_FIELD,
+    }
+    for name, typecode, attribute in COLUMNS:
+        open(os.path.join(path, column_file(name)), 'wb').close()
+    write_checkpoint(os.path.join(path, HEADER_FILE), header)
+
+
+def column_rows(path):
+    # complete rows: the shortest column decides
+    rows = None
+    for name, typecode, attribute in COLUMNS:
+        size = os.path.getsize(os.path.join(path, column_file(name)))
+        count = size // array.array(typecode).itemsize
+        rows = count if rows is None else min(rows, count)
+    return rows or 0
+
+
+def truncate_columnar(path, rows):
+    """Drop rows appended after a checkpoint, rows is the checkpoint's data_length"""
+    for name, typecode, attribute in COLUMNS:
+        fh = open(os.path.join(path, column_file(name)), 'r+b')
+        fh.truncate(rows * array.array(typecode).itemsize)
+        fh.flush()
+        os.fsync(fh.fileno())
+        fh.close()
+
+
+class ColumnarStore(object):
+    """Appends samples to a columnar result set, a store for SampleWriter"""
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isfile(os.path.join(path, HEADER_FILE)):
+            create_columnar(path)
+        self.header = read_header(path)
+        self.sensor_codes = dict((name, code) for code, name in enumerate(self.header['sensors']))
+        self.files = [open(os.path.join(path, column_file(name)), 'ab') for name, typecode, attribute in COLUMNS]
+
+    def sensor_code(self, name):
+        code = self.sensor_codes.get(name)
+        if code is None:
+            # first reading from a new array position, record its name
+            code = len(self.header['sensors'])
+            if code > 255:
+                raise ValueError('too many sensor names for the sensor column')
+            self.header['sensors'].append(name)
+            self.sensor_codes[name] = code
+            write_checkpoint(os.path.join(self.path, HEADER_FILE), self.header)
+        return code
+
+    def append(self, samples):
+        for fh, values in zip(self.files, sample_columns(samples, self.sensor_code)):
+            if BIG_ENDIAN:
+                values.byteswap()
+            values.tofile(fh)
+
+    def sync(self):
+        """Flush to disk, returns the row count a checkpoint should record"""
+        for fh in self.files:
+            fh.flush()
+            os.fsync(fh.fileno())
+        return column_rows(self.path)
+
+    def close(self):
+        for fh in self.files:
+            fh.close()
+
+
+class ColumnarData(object):
+    """Read access to a columnar result set"""
+    def __init__(self, path):
+        self.path = path
+        self.header = read_header(path)
+        self.rows = column_rows(path)
+        self.dtypes = dict((column['name'], column['dtype']) for column in self.header['columns'])
+
+    def column(self, name):
+        """The whole column, a read only numpy.memmap (array.array without NumPy)"""
+        file_name = os.path.join(self.path, column_file(name))
+        if numpy is not None:
+            if not self.rows:
+                return numpy.zeros(0, dtype=self.dtypes[name])
+            return numpy.memmap(file_name, dtype=self.dtypes[name], mode='r', shape=(self.rows,))
+        return self.read(name, 0, self.rows)
+
+    def read(self, name, start, stop):
+        """Rows start..stop-1 of a column as an array.array"""
+        typecode = [typecode for column, typecode, attribute in COLUMNS if column == name][0]
+        values = array.array(typecode)
+        fh = open(os.path.join(self.path, column_file(name)), 'rb')
+        fh.seek(start * values.itemsize)
+        values.fromfile(fh, stop - start)
+        fh.close()
+        if BIG_ENDIAN:
+            values.byteswap()
+        return values
+
+    def samples(self, start=0, stop=None, chunk_rows=65536):
+        """MagSample objects for rows start..stop-1, read a chunk at a time"""
+        stop = self.rows if stop is None else min(stop, self.rows)
+        sensors = self.header['sensors']
+        decisions = self.header['decisions']
+        invalid = self.header['invalid_field']
+        for chunk_start in range(start, stop, chunk_rows):
+            chunk_stop = min(chunk_start + chunk_rows, stop)
+            columns = [self.read(name, chunk_start, chunk_stop) for name, typecode, attribute in COLUMNS]
+            for sample in column_samples(columns, sensors, decisions, invalid):
+                yield sample
+
+
+def export_csv(path, csv_path):
+    """Write a result set as mag_profile.csv, returns the number of rows"""
+    data = ColumnarData(path)
+    fh = open(csv_path, 'w', buffering=1 << 16)
+    fh.write(CSV_HEADER + '\n')
+    for sample in data.samples():
+        fh.write(csv_row(sample) + '\n')
+    fh.close()
+    return data.rows
+
+
+def parse_csv_row(line):
+    # inverse of csv_row
+    values = line.rstrip('\n').split(',')
+    if values[5] == '':
+        sample = MagSample(None, None, None)
+        sample.valid = False
+    else:
+        sample = MagSample(int(values[5]), int(values[6]), int(values[7]))
+    sample.f0, sample.f1, sample.f2 = int(values[0]), int(values[1]), int(values[2])
+    sample.clock1_phase_offset, sample.clock2_phase_offset = int(values[3]), int(values[4])
+    sample.duration, sample.pause = float(values[8]), float(values[9])
+    sample.decision = values[10] or None
+    sample.temperature = int(values[11])
+    sample.sensor = values[12]
+    sample.burst_start_ns, sample.burst_end_ns, sample.ready_ns, sample.read_ns, sample.point = [
+        int(value) for value in values[13:18]]
+    return sample
+
+
+def import_csv(csv_path, path, batch_rows=65536):
+    """Convert a mag_profile.csv to a new result set, returns the number of rows"""
+    fh = open(csv_path)
+    if fh.readline().strip() != CSV_HEADER:
+        raise ValueError('%s: unexpected columns, expected %s' % (csv_path, CSV_HEADER))
+    create_columnar(path)
+    store = ColumnarStore(path)
+    batch = []
+    for line in fh:
+        batch.append(parse_csv_row(line))
+        if len(batch) >= batch_rows:
+            store.append(batch)
+            batch = []
+    store.append(batch)
+    rows = store.sync()
+    store.close()
+    fh.close()
+    return rows
+
+
+def info(path):
+    data = ColumnarData(path)
+    size = sum(os.path.getsize(os.path.join(path, column['file'])) for column in data.header['columns'])
+    lines = ['%s: %d rows, %d bytes (%.1f per row), created %s' % (
+        path, data.rows, size, float(size) / data.rows if data.rows else 0.0, data.header['created'])]
+    for column in data.header['columns']:
+        lines.append('  %-15s %s' % (column['name'], column['dtype']))
+    lines.append('  sensors: %s' % ', '.join(name or '(main)' for name in data.header['sensors']))
+    return '\n'.join(lines)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Columnar scan results')
+    commands = parser.add_subparsers(dest='command')
+    command = commands.add_parser('info', help='describe a result set')
+    command.add_argument('path')
+    command = commands.add_parser('export', help='write a result set as CSV')
+    command.add_argument('path')
+    command.add_argument('csv')
+    command = commands.add_parser('import', help='convert a mag_profile.csv to a result set')
+    command.add_argument('csv')
+    command.add_argument('path')
+    args = parser.parse_args()
+    if args.command is None:
+        parser.error('a command is required')
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    start = time.time()
+    if args.command == 'info':
+        print(info(args.path))
+    elif args.command == 'export':
+        print('%d rows exported in %.1f s' % (export_csv(args.path, args.csv), time.time() - start))
+    elif args.command == 'import':
+        print('%d rows imported in %.1f s' % (import_csv(args.csv, args.path), time.time() - start))
@@ -0,0 +1,174 @@
+#!/usr/bin/python
+#
+# Summary:
+# Online anomaly detection for mag_scan.
+# Every valid reading is checked as it arrives against a rolling baseline
+# of the readings before it, on each axis and for each sensor separately.
+# The baseline is an exponentially weighted mean and variance whose update
+# is winsorized: a reading is clipped to clip standard deviations before it
+# moves the baseline, so a strong response does not drag the baseline along
+# with it.  Two alarms are raised against it:
+#   zscore  a single reading more than z_limit standard deviations away
+#   cusum   a two sided CUSUM of the standardized readings passes
+#           cusum_limit, catching smaller shifts that persist
+# Each reading costs a fixed handful of arithmetic per axis, so detection
+# cannot slow the scan however long it runs.
+#
+# Alarms are reported as DetectorEvent objects carrying the scan point,
+# drive frequencies and phases, so a response can be acted on while the rig
+# is still configured for it.  Listeners are called on the thread that
+# added the reading; EventLog writes events as JSON lines.
+#
+# MIT Open Source License
+# https://opensource.org/licenses/MIT
+#
+
+import collections
+import json
+import math
+
+ALARM_ZSCORE = 'zscore'
+ALARM_CUSUM = 'cusum'
+AXES = 'xyz'
+
+
+class AxisDetector(object):
+    """Winsorized EWMA baseline with z-score and CUSUM alarms for one axis"""
+    def __init__(self, alpha=0.01, warmup=50, min_std=1.0, clip=3.0, z_limit=6.0, cusum_drift=0.5,
+                 cusum_limit=10.0):
+        self.alpha = alpha              # weight of each new reading once warmed up
+        self.warmup = warmup            # readings averaged equally before any alarm
+        self.min_std = min_std          # sensor quantization floor (counts)
+        self.clip = clip                # standard deviations a reading may move the baseline
+        self.z_limit = z_limit
+        self.cusum_drift = cusum_drift  # standardized shift ignored by the CUSUM (k)
+        self.cusum_limit = cusum_limit  # CUSUM alarm threshold (h)
+        self.count = 0
+        self.mean = 0.0
+        self.var = 0.0
+        self.cusum_high = 0.0
+        self.cusum_low = 0.0
+
+    def std(self):
+        return max(math.sqrt(self.var), self.min_std)
+
+    def add(self, value):
+        """Add one reading, returns (alarm, z, statistic) or None"""
+        self.count += 1
+        weight = max(self.alpha, 1.0 / self.count)
+        if self.count <= self.warmup:
+            # plain running mean and variance while warming up
+            delta = value - self.mean
+            self.mean += weight * delta
+            self.var = (1.0 - weight) * (self.var + weight * delta * delta)
+            return None
+        std = self.std()
+        deviation = value - self.mean
+        z = deviation / std
+        limit = self.clip * std
+        clipped = min(max(deviation, -limit), limit)
+        self.mean += weight * clipped
+        self.var = (1.0 - weight) * (self.var + weight * clipped * clipped)
+        self.cusum_high = max(0.0, self.cusum_high + z - self.cusum_drift)
+        self.cusum_low = max(0.0, self.cusum_low - z - self.cusum_drift)
+        if abs(z) >= self.z_limit:
+            # a z-score alarm also accounts for the shift the CUSUM was building up
+            self.cusum_high = self.cusum_low = 0.0
+            return ALARM_ZSCORE, z, z
+        if self.cusum_high >= self.cusum_limit or self.cusum_low >= self.cusum_limit:
+            statistic = self.cusum_high if self.cusum_high >= self.cusum_limit else -self.cusum_low
+            self.cusum_high = self.cusum_low = 0.0
+            return ALARM_CUSUM, z, statistic
+        return None
+
+
+class DetectorEvent(object):
+    """An alarm on one axis of one reading"""
+    def __init__(self, sample, axis, alarm, value, baseline, std, z, statistic):
+        self.point = sample.point
+        self.sensor = sample.sensor
+        self.f0 = sample.f0
+        self.f1 = sample.f1
+        self.f2 = sample.f2
+        self.clock1_phase_offset = sample.clock1_phase_offset
+        self.clock2_phase_offset = sample.clock2_phase_offset
+        self.ready_ns = sample.ready_ns
+        self.read_ns = sample.read_ns
+        self.axis = axis            # 'x', 'y' or 'z'
+        self.alarm = alarm          # ALARM_ZSCORE or ALARM_CUSUM
+        self.value = value          # reading on that axis (counts)
+        self.baseline = baseline    # baseline mean before the reading
+        self.std = std              # baseline standard deviation
+        self.z = z                  # (value - baseline) / std
+        self.statistic = statistic  # z for zscore, the signed CUSUM for cusum
+
+    def as_dict(self):
+        return dict(self.__dict__)
+
+    def __str__(self):
+        return '%s %s point:%d fx:%d, fy:%d, fz:%d, clock1_phase:%d, clock2_phase:%d, mag%s:%d baseline:%.1f z:%.1f%s' % (
+            self.alarm.upper(), self.sensor or 'main', self.point, self.f0, self.f1, self.f2,
+            self.clock1_phase_offset, self.clock2_phase_offset, self.axis.upper(), self.value, self.baseline, self.z,
+            ' cusum:%.1f' % self.statistic if self.alarm == ALARM_CUSUM else '')
+
+
+class OnlineDetector(object):
+    """AxisDetectors for every axis of every sensor, created as sensors appear.
+    At most one event per axis and alarm is reported for each scan point.
+    """
+    def __init__(self, recent=100, **settings):
+        self.settings = settings    # AxisDetector arguments
+        self.sensors = {}           # sensor name -> [x, y, z] AxisDetector
+        self.listeners = []         # called with each DetectorEvent
+        self.recent = collections.deque(maxlen=recent)
+        self.readings = 0
+        self.event_count = 0
+        self.reported = set()       # (sensor, axis, alarm) already reported for reported_point
+        self.reported_point = None
+
+    def add(self, sample):
+        """Check one valid MagSample, returns the events it raised"""
+        detectors = self.sensors.get(sample.sensor)
+        if detectors is None:
+            detectors = self.sensors[sample.sensor] = [AxisDetector(**self.settings) for _axis in AXES]
+        self.readings += 1
+        events = []
+        for axis, detector, value in zip(AXES, detectors, (sample.x, sample.y, sample.z)):
+            baseline = detector.mean
+            std = detector.std()
+            alarm = detector.add(value)
+            if alarm is None:
+                continue
+            if sample.point != self.reported_point:
+                self.reported_point = sample.point
+                self.reported.clear()
+            key = (sample.sensor, axis, alarm[0])
+            if key in self.reported:
+                continue
+            self.reported.add(key)
+            events.append(DetectorEvent(sample, axis, alarm[0], value, baseline, std, alarm[1], alarm[2]))
+        for event in events:
+            self.event_count += 1
+            self.recent.append(event)
+            for listener in self.listeners:
+                listener(event)
+        return events
+
+    def summary(self):
+        return 'Detector readings:%d events:%d sensors:%d' % (self.readings, self.event_count, len(self.sensors))
+
+
+class EventLog(object):
+    """Appends DetectorEvents to a file as JSON lines, a detector listener"""
+    def __init__(self, path, echo=True):
+        self.fh = open(path, 'a')
+        self.echo = echo    # also print each event
+
+    def write(self, event):
+        self.fh.write(json.dumps(event.as_dict(), sort_keys=True) + '\n')
+        self.fh.flush()
+        if self.echo:
+            print(event)
+
+    def close(self):
+        self.fh.close()
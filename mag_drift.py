@@ -0,0 +1,73 @@
+#!/usr/bin/python
+#
+# Summary:
+# Online temperature drift compensation for the MAG3110.
+# Coil heating over a multi-hour scan shows up as a slow offset drift in the
+# sensor readings.  We fit field = offset + slope * die_temperature on each
+# axis from magnets-off readings taken during the run, and subtract the
+# temperature dependent part from every sample.
+#
+# MIT Open Source License
+# https://opensource.org/licenses/MIT
+#
+
+
+class TemperatureDriftModel(object):
+    """Per axis linear fit of field against die temperature.
+    Sums are exponentially weighted (forget) so the fit follows the most
+    recent part of the run.  Until the temperature has varied enough to give
+    a meaningful slope no correction is applied.
+    """
+    def __init__(self, forget=0.9995, min_samples=200, min_temp_var=0.25):
+        self.forget = forget              # weight kept by older readings per new reading
+        self.min_samples = min_samples    # readings needed before correcting
+        self.min_temp_var = min_temp_var  # temperature variance needed for a slope (C^2)
+        self.count = 0
+        self.reference_temperature = None  # corrected samples are referred to this temperature
+        self.sum_w = 0.0
+        self.sum_t = 0.0
+        self.sum_tt = 0.0
+        self.sum_f = [0.0, 0.0, 0.0]
+        self.sum_tf = [0.0, 0.0, 0.0]
+
+    def add(self, x, y, z, temperature):
+        """Add a magnets-off reading"""
+        if self.reference_temperature is None:
+            self.reference_temperature = temperature
+        self.count += 1
+        # center on the reference temperature to keep the sums well conditioned
+        t = temperature - self.reference_temperature
+        k = self.forget
+        self.sum_w = k * self.sum_w + 1.0
+        self.sum_t = k * self.sum_t + t
+        self.sum_tt = k * self.sum_tt + t * t
+        for axis, value in enumerate((x, y, z)):
+            self.sum_f[axis] = k * self.sum_f[axis] + value
+            self.sum_tf[axis] = k * self.sum_tf[axis] + t * value
+
+    def temperature_variance(self):
+        if self.sum_w == 0.0:
+            return 0.0
+        mean_t = self.sum_t / self.sum_w
+        return self.sum_tt / self.sum_w - mean_t * mean_t
+
+    def ready(self):
+        return self.count >= self.min_samples and self.temperature_variance() >= self.min_temp_var
+
+    def slope(self, axis):
+        """Field change per degree C on axis (counts / C)"""
+        if not self.ready():
+            return 0.0
+        mean_t = self.sum_t / self.sum_w
+        mean_f = self.sum_f[axis] / self.sum_w
+        covariance = self.sum_tf[axis] / self.sum_w - mean_t * mean_f
+        return covariance / self.temperature_variance()
+
+    def correct(self, x, y, z, temperature):
+        """Return (x, y, z) referred to the reference temperature"""
+        if not self.ready():
+            return (x, y, z)
+        dt = temperature - self.reference_temperature
+        return (x - self.slope(0) * dt,
+                y - self.slope(1) * dt,
+                z - self.slope(2) * dt)
@@ -0,0 +1,330 @@
+#!/usr/bin/python
+#
+# Summary:
+# Range queries over columnar scan results (see mag_columnar.py).
+# For each indexed column a sorted secondary index is kept next to the
+# columns, in mag_profile.col/index: the column values in sorted order and
+# the row each value came from.  Queries memory map the index and the
+# columns and binary search them, so only the rows asked for are touched.
+#
+# The index is updated incrementally: rows appended since the last update
+# are sorted into a new run, and runs are merged whenever a run is at least
+# half the size of the one before it, which keeps the number of runs
+# logarithmic in the number of rows.  A query searches every run.  During a
+# scan IndexedStore updates the index after each commit, on the writer
+# thread; a result set cut back on resume is re-indexed from scratch.
+#
+# Usage:
+#   python mag_query.py mag_profile.col --freq-x 31000 31050 --clock1-phase 60 60
+#   python mag_query.py mag_profile.col --freq-y 45000 45000 --count
+#
+# MIT Open Source License
+# https://opensource.org/licenses/MIT
+#
+
+import argparse
+import array
+import bisect
+import json
+import mmap
+import os
+import sys
+import time
+
+from mag_checkpoint import write_checkpoint
+from mag_columnar import COLUMNS, ColumnarData, column_file, column_rows, column_samples, read_header
+from mag_scan_info import CSV_HEADER, csv_row
+
+try:
+    import numpy
+except ImportError:
+    numpy = None    # sorting falls back to the standard library
+
+INDEX_DIR = 'index'
+INDEX_FILE = 'index.json'
+INDEX_COLUMNS = ['freq_x', 'freq_y', 'freq_z', 'clock1_phase', 'clock2_phase']
+ROW_TYPE = 'q'
+TYPECODES = dict((name, typecode) for name, typecode, attribute in COLUMNS)
+
+if sys.byteorder == 'big':
+    raise ImportError('mag_query maps little endian files directly and needs a little endian machine')
+
+
+class MappedArray(object):
+    """A read only file of fixed width values, memory mapped.
+    Supports len() and indexing, so bisect works on it without reading the file.
+    """
+    def __init__(self, path, typecode, count=None):
+        self.fh = open(path, 'rb')
+        size = os.fstat(self.fh.fileno()).st_size
+        itemsize = array.array(typecode).itemsize
+        count = size // itemsize if count is None else count
+        self.map = None
+        self.view = memoryview(b'').cast(typecode)
+        if count:
+            self.map = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+            self.view = memoryview(self.map)[:count * itemsize].cast(typecode)
+
+    def __len__(self):
+        return len(self.view)
+
+    def __getitem__(self, i):
+        return self.view[i]
+
+    def close(self):
+        self.view.release()
+        if self.map is not None:
+            self.map.close()
+        self.fh.close()
+
+
+def sort_rows(values, first_row):
+    # (sorted values, their row numbers) for values starting at row first_row
+    if numpy is not None:
+        keys = numpy.frombuffer(values, dtype=values.typecode)
+        order = numpy.argsort(keys, kind='stable')
+        return (array.array(values.typecode, keys[order].tobytes()),
+                array.array(ROW_TYPE, (order + first_row).astype('<i8').tobytes()))
+    order = sorted(range(len(values)), key=values.__getitem__)
+    return (array.array(values.typecode, [values[i] for i in order]),
+            array.array(ROW_TYPE, [i + first_row for i in order]))
+
+
+def merge_runs(a_keys, a_rows, b_keys, b_rows):
+    # merge two sorted runs, a before b for equal keys
+    if numpy is not None:
+        keys = numpy.concatenate((numpy.frombuffer(a_keys, dtype=a_keys.typecode),
+                                  numpy.frombuffer(b_keys, dtype=b_keys.typecode)))
+        rows = numpy.concatenate((numpy.frombuffer(a_rows, dtype='<i8'), numpy.frombuffer(b_rows, dtype='<i8')))
+        order = numpy.argsort(keys, kind='stable')
+        return array.array(a_keys.typecode, keys[order].tobytes()), array.array(ROW_TYPE, rows[order].tobytes())
+    keys = array.array(a_keys.typecode)
+    rows = array.array(ROW_TYPE)
+    i = j = 0
+    while i < len(a_keys) and j < len(b_keys):
+        if b_keys[j] < a_keys[i]:
+            keys.append(b_keys[j])
+            rows.append(b_rows[j])
+            j += 1
+        else:
+            keys.append(a_keys[i])
+            rows.append(a_rows[i])
+            i += 1
+    keys.extend(a_keys[i:])
+    rows.extend(a_rows[i:])
+    keys.extend(b_keys[j:])
+    rows.extend(b_rows[j:])
+    return keys, rows
+
+
+def read_array(path, typecode):
+    values = array.array(typecode)
+    fh = open(path, 'rb')
+    values.frombytes(fh.read())
+    fh.close()
+    return values
+
+
+def write_array(path, values):
+    fh = open(path, 'wb')
+    values.tofile(fh)
+    fh.flush()
+    os.fsync(fh.fileno())
+    fh.close()
+
+
+class ScanIndex(object):
+    """Sorted secondary indexes for a columnar result set"""
+    def __init__(self, path, columns=INDEX_COLUMNS):
+        self.path = path
+        self.index_path = os.path.join(path, INDEX_DIR)
+        self.columns = columns
+        self.state = None
+        state_file = os.path.join(self.index_path, INDEX_FILE)
+        if os.path.isfile(state_file):
+            fh = open(state_file)
+            self.state = json.load(fh)
+            fh.close()
+            if self.state.get('columns') != columns:
+                self.state = None   # indexes a different set of columns, rebuilt by update
+        if self.state is None:
+            self.state = {'columns': columns, 'indexed_rows': 0, 'next_run': 0,
+                          'runs': dict((name, []) for name in columns)}
+
+    def run_files(self, name, number):
+        base = os.path.join(self.index_path, '%s.%d' % (name, number))
+        return base + '.keys', base + '.rows'
+
+    def update(self):
+        """Index rows appended since the last update, returns the number of new rows"""
+        rows = column_rows(self.path)
+        indexed = self.state['indexed_rows']
+        obsolete = []   # (column, run) removed once the new state is written
+        if rows < indexed:
+            # the result set was cut back (resume), start again
+            for name in self.columns:
+                obsolete.extend((name, run) for run in self.state['runs'][name])
+                self.state['runs'][name] = []
+            indexed = 0
+        if rows == indexed:
+            self.save(obsolete)
+            return 0
+        if not os.path.isdir(self.index_path):
+            os.makedirs(self.index_path)
+        data = ColumnarData(self.path)
+        for name in self.columns:
+            keys, row_numbers = sort_rows(data.read(name, indexed, rows), indexed)
+            runs = self.state['runs'][name]
+            runs.append(self.write_run(name, keys, row_numbers))
+            # merge while the newest run is at least half the size of the one before
+            while len(runs) >= 2 and 2 * runs[-1]['rows'] >= runs[-2]['rows']:
+                newer = runs.pop()
+                older = runs.pop()
+                keys, row_numbers = merge_runs(*(self.read_run(name, older) + self.read_run(name, newer)))
+                runs.append(self.write_run(name, keys, row_numbers))
+                obsolete.extend([(name, older), (name, newer)])
+        self.state['indexed_rows'] = rows
+        self.save(obsolete)
+        return rows - indexed
+
+    def save(self, obsolete=()):
+        # the state never refers to a removed run, even after a crash
+        if os.path.isdir(self.index_path):
+            write_checkpoint(os.path.join(self.index_path, INDEX_FILE), self.state)
+        for name, run in obsolete:
+            self.remove_run(name, run)
+
+    def write_run(self, name, keys, row_numbers):
+        number = self.state['next_run']
+        self.state['next_run'] += 1
+        keys_file, rows_file = self.run_files(name, number)
+        write_array(keys_file, keys)
+        write_array(rows_file, row_numbers)
+        return {'number': number, 'rows': len(keys)}
+
+    def read_run(self, name, run):
+        keys_file, rows_file = self.run_files(name, run['number'])
+        return read_array(keys_file, TYPECODES[name]), read_array(rows_file, ROW_TYPE)
+
+    def remove_run(self, name, run):
+        for run_file in self.run_files(name, run['number']):
+            os.remove(run_file)
+
+
+class IndexedStore(object):
+    """Wraps a ColumnarStore so the index follows every commit"""
+    def __init__(self, store, columns=INDEX_COLUMNS):
+        self.store = store
+        self.index = ScanIndex(store.path, columns)
+        # catch up now, before rows cut off by a resume are written again
+        self.index.update()
+
+    def append(self, samples):
+        self.store.append(samples)
+
+    def sync(self):
+        rows = self.store.sync()
+        self.index.update()
+        return rows
+
+    def close(self):
+        self.store.close()
+
+
+class ScanQuery(object):
+    """Range queries against a columnar result set and its index"""
+    def __init__(self, path, update=True):
+        self.path = path
+        self.header = read_header(path)
+        self.index = ScanIndex(path)
+        if update:
+            self.index.update()
+        self.rows = self.index.state['indexed_rows']
+        self.runs = {}
+        for name in self.index.columns:
+            self.runs[name] = []
+            for run in self.index.state['runs'][name]:
+                keys_file, rows_file = self.index.run_files(name, run['number'])
+                self.runs[name].append((MappedArray(keys_file, TYPECODES[name], run['rows']),
+                                        MappedArray(rows_file, ROW_TYPE, run['rows'])))
+        self.columns = {}
+
+    def column(self, name):
+        # memory mapped column, opened on first use
+        if name not in self.columns:
+            self.columns[name] = MappedArray(os.path.join(self.path, column_file(name)), TYPECODES[name], self.rows)
+        return self.columns[name]
+
+    def spans(self, name, lo, hi):
+        # (run keys, run rows, start, stop) of the index entries with lo <= value <= hi
+        spans = []
+        for keys, rows in self.runs[name]:
+            start = bisect.bisect_left(keys, lo)
+            stop = bisect.bisect_right(keys, hi)
+            if stop > start:
+                spans.append((rows, start, stop))
+        return spans
+
+    def count(self, name, lo, hi):
+        """Rows with lo <= name <= hi, from the index alone"""
+        return sum(stop - start for rows, start, stop in self.spans(name, lo, hi))
+
+    def find(self, ranges):
+        """Sorted row numbers matching every (lo, hi) in ranges, a dict of column name to inclusive bounds.
+        The most selective indexed column is searched, the others are checked row by row.
+        """
+        indexed = [name for name in ranges if name in self.runs]
+        if not indexed:
+            raise ValueError('at least one of %s is needed' % ', '.join(self.index.columns))
+        best = min(indexed, key=lambda name: self.count(name, *ranges[name]))
+        found = array.array(ROW_TYPE)
+        for rows, start, stop in self.spans(best, *ranges[best]):
+            found.extend(rows.view[start:stop])
+        found = sorted(found)
+        for name, (lo, hi) in ranges.items():
+            if name == best:
+                continue
+            column = self.column(name)
+            found = [row for row in found if lo <= column[row] <= hi]
+        return found
+
+    def samples(self, row_numbers):
+        """MagSample objects for row numbers"""
+        columns = [[self.column(name)[row] for row in row_numbers] for name, typecode, attribute in COLUMNS]
+        return column_samples(columns, self.header['sensors'], self.header['decisions'], self.header['invalid_field'])
+
+    def close(self):
+        for name in self.runs:
+            for keys, rows in self.runs[name]:
+                keys.close()
+                rows.close()
+        for column in self.columns.values():
+            column.close()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Query a columnar result set by frequency and phase')
+    parser.add_argument('path', help='columnar result set, e.g. mag_profile.col')
+    for name in INDEX_COLUMNS:
+        parser.add_argument('--' + name.replace('_', '-'), nargs=2, type=int, metavar=('LO', 'HI'), dest=name)
+    parser.add_argument('--count', action='store_true', help='only count the matching rows')
+    parser.add_argument('--limit', type=int, default=20, help='rows to print (0 for all)')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    ranges = dict((name, tuple(getattr(args, name))) for name in INDEX_COLUMNS if getattr(args, name))
+    start = time.time()
+    query = ScanQuery(args.path)
+    opened = time.time()
+    found = query.find(ranges) if ranges else list(range(query.rows))
+    searched = time.time()
+    if not args.count:
+        print(CSV_HEADER)
+        shown = found if not args.limit else found[:args.limit]
+        for sample in query.samples(shown):
+            print(csv_row(sample))
+    print('%d of %d rows match, index update %.1f ms, query %.1f ms' % (
+        len(found), query.rows, (opened - start) * 1e3, (searched - opened) * 1e3))
+    query.close()
@@ -0,0 +1,244 @@
+#!/usr/bin/python
+#
+# Summary:
+# Measure anomalous scan points again while the rig is still set up.
+# Points flagged by the online detector (mag_detect.py) or by an adaptive
+# burst decided 'anomaly' go into a priority queue, strongest evidence
+# first.  Before the scan moves on, each flagged point is measured again:
+# replicate bursts at the point's parameters alternate with magnets-off
+# control bursts of the same timing (outputs left disabled), so slow drift
+# affects both alike.  The replicate bursts are then compared with the
+# controls on each axis:
+#   confirmed     some axis differs by at least effect counts with a Welch
+#                 t statistic of at least t_limit
+#   rejected      no axis does
+#   inconclusive  fewer than two replicate or control bursts could be read
+# Outcomes are appended to mag_retest.csv.  Replicate and control readings
+# are not added to the scan results and are not seen by the detector, and
+# every point is measured again at most once.  At most max_share of the
+# bursts go to re-tests; when points are flagged faster than that, the
+# queue keeps the strongest max_queue of them.  Whatever is still queued
+# when the scan ends is measured before it stops.
+# Checkpoints keep the queued points and the points already seen, so a
+# resumed scan measures the queue and does not flag those points again.  A
+# re-test in progress at the checkpoint starts over, and an outcome written
+# after the last checkpoint can appear twice in mag_retest.csv.
+#
+# MIT Open Source License
+# https://opensource.org/licenses/MIT
+#
+
+import heapq
+import math
+import os
+import threading
+import time
+
+ROLE_REPLICATE = 'replicate'
+ROLE_CONTROL = 'control'
+OUTCOME_CONFIRMED = 'confirmed'
+OUTCOME_REJECTED = 'rejected'
+OUTCOME_INCONCLUSIVE = 'inconclusive'
+
+RETEST_HEADER = ('point,sensor,reason,priority,freq_x,freq_y,freq_z,clock1_phase,clock2_phase,replicates,controls,'
+                 'diff_x,diff_y,diff_z,t_x,t_y,t_z,outcome,flagged_ns,done_ns')
+
+
+class Retest(object):
+    """Replicate and control bursts of one flagged point"""
+    def __init__(self, point, priority, reason, sensor, replicates):
+        self.point = point          # scan_space index
+        self.priority = priority    # deviation that flagged it, in standard deviations
+        self.reason = reason        # detector alarm or 'adaptive'
+        self.sensor = sensor        # sensor whose readings are compared
+        self.flagged_ns = time.monotonic_ns()
+        self.roles = [ROLE_REPLICATE, ROLE_CONTROL] * replicates
+        self.step = -1              # index into roles of the burst in progress
+        self.samples = []           # valid samples of the burst in progress
+        self.bursts = {ROLE_REPLICATE: [], ROLE_CONTROL: []}   # (x, y, z) mean of each burst read
+        self.frequencies = None     # (f0, f1, f2, clock1_phase, clock2_phase) of a replicate burst
+
+    def role(self):
+        return self.roles[self.step]
+
+    def add(self, sample):
+        if sample.valid and sample.sensor == self.sensor:
+            self.samples.append(sample)
+
+    def end_step(self):
+        samples, self.samples = self.samples, []
+        if not samples:
+            return
+        count = float(len(samples))
+        self.bursts[self.role()].append((sum(s.x for s in samples) / count, sum(s.y for s in samples) / count,
+                                         sum(s.z for s in samples) / count))
+        if self.role() == ROLE_REPLICATE and self.frequencies is None:
+            sample = samples[0]
+            self.frequencies = (sample.f0, sample.f1, sample.f2,
+                                sample.clock1_phase_offset, sample.clock2_phase_offset)
+
+    def next_role(self):
+        """Role of the next burst, or None once every burst has run"""
+        if self.step >= 0:
+            self.end_step()
+        self.step += 1
+        if self.step >= len(self.roles):
+            return None
+        return self.role()
+
+
+def mean_std(values, min_std):
+    # mean and sample standard deviation, not below min_std
+    n = len(values)
+    mean = sum(values) / n
+    var = sum((v - mean) ** 2 for v in values) / (n - 1)
+    return mean, max(math.sqrt(var), min_std)
+
+
+class RetestQueue(object):
+    """Flagged points of scan_space, measured again in order of priority.
+    flag and on_event may be called from any thread, the rest from the thread stepping the scan.
+    """
+    def __init__(self, space, path, replicates=3, effect=4.0, t_limit=4.0, min_std=1.0, max_queue=20, max_share=0.25,
+                 report=print):
+        self.space = space              # ScanSpace the flagged point indexes refer to
+        self.replicates = replicates    # replicate bursts, and as many control bursts
+        self.effect = effect            # smallest difference from the controls that counts (sensor counts)
+        self.t_limit = t_limit
+        self.min_std = min_std          # sensor quantization floor (counts)
+        self.max_queue = max_queue      # waiting points, the weakest is dropped beyond this
+        self.max_share = max_share      # largest fraction of all bursts spent on re-tests
+        self.report = report            # called with a line for each outcome
+        self.lock = threading.Lock()
+        self.heap = []                  # (-priority, sequence, Retest)
+        self.sequence = 0
+        self.seen = set()               # points queued or measured again, never queued twice
+        self.current = None             # Retest in progress
+        self.scan_finished = False      # the scan's own points were done when re-testing started
+        self.bursts = 0                 # bursts set up so far, scan and re-test
+        self.retest_bursts = 0
+        self.counts = {'flagged': 0, 'dropped': 0, OUTCOME_CONFIRMED: 0, OUTCOME_REJECTED: 0,
+                       OUTCOME_INCONCLUSIVE: 0}
+        new_file = not os.path.isfile(path)
+        self.fh = open(path, 'a')
+        if new_file:
+            self.fh.write(RETEST_HEADER + '\n')
+            self.fh.flush()
+
+    def flag(self, point, priority, reason, sensor=''):
+        """Queue point to be measured again, unless it already has been"""
+        with self.lock:
+            if point in self.seen:
+                return
+            self.seen.add(point)
+            self.counts['flagged'] += 1
+            self.sequence += 1
+            heapq.heappush(self.heap, (-priority, self.sequence, Retest(point, priority, reason, sensor,
+                                                                         self.replicates)))
+            if len(self.heap) > self.max_queue:
+                # forget the weakest, it counts as seen
+                self.heap.remove(max(self.heap))
+                heapq.heapify(self.heap)
+                self.counts['dropped'] += 1
+
+    def on_event(self, event):
+        # a detector listener
+        self.flag(event.point, abs(event.z), event.alarm, event.sensor)
+
+    def pending(self):
+        return len(self.heap)
+
+    def state(self):
+        """JSON-able queue for a checkpoint, see restore"""
+        with self.lock:
+            retests = [retest for priority, sequence, retest in sorted(self.heap)]
+            seen = sorted(self.seen)
+        if self.current is not None:
+            retests.insert(0, self.current)     # measured again from the start
+        return {'pending': [[retest.point, retest.priority, retest.reason, retest.sensor] for retest in retests],
+                'seen': seen}
+
+    def restore(self, state):
+        """Continue with the queue of a checkpoint's state()"""
+        with self.lock:
+            self.seen.update(state['seen'])
+            for point, priority, reason, sensor in state['pending']:
+                self.sequence += 1
+                heapq.heappush(self.heap, (-priority, self.sequence, Retest(point, priority, reason, sensor,
+                                                                             self.replicates)))
+
+    def active(self):
+        """True while the burst in progress is a replicate or control burst"""
+        return self.current is not None
+
+    def add(self, sample):
+        # a sample from the current replicate or control burst
+        self.current.add(sample)
+
+    def next_step(self, scan_info):
+        """Set scan_info up for the next replicate or control burst.
+        Returns False when nothing is left to measure again.
+        """
+        self.bursts += 1
+        while True:
+            if self.current is None:
+                if not self.scan_finished and self.retest_bursts >= self.max_share * self.bursts:
+                    return False    # over budget, flagged points wait their turn
+                with self.lock:
+                    if not self.heap:
+                        return False
+                    self.current = heapq.heappop(self.heap)[2]
+            role = self.current.next_role()
+            if role is not None:
+                break
+            self.finish(self.current)
+            self.current = None
+        self.retest_bursts += 1
+        self.space.apply(self.current.point, scan_info)
+        scan_info.control_burst = role == ROLE_CONTROL
+        return True
+
+    def evaluate(self, retest):
+        # (outcome, differences, t statistics) of replicates less controls on each axis
+        replicates = retest.bursts[ROLE_REPLICATE]
+        controls = retest.bursts[ROLE_CONTROL]
+        if len(replicates) < 2 or len(controls) < 2:
+            return OUTCOME_INCONCLUSIVE, None, None
+        differences = []
+        statistics = []
+        for axis in range(3):
+            replicate_mean, replicate_std = mean_std([burst[axis] for burst in replicates], self.min_std)
+            control_mean, control_std = mean_std([burst[axis] for burst in controls], self.min_std)
+            difference = replicate_mean - control_mean
+            differences.append(difference)
+            statistics.append(difference / math.sqrt(replicate_std ** 2 / len(replicates) +
+                                                     control_std ** 2 / len(controls)))
+        for difference, statistic in zip(differences, statistics):
+            if abs(difference) >= self.effect and abs(statistic) >= self.t_limit:
+                return OUTCOME_CONFIRMED, differences, statistics
+        return OUTCOME_REJECTED, differences, statistics
+
+    def finish(self, retest):
+        outcome, differences, statistics = self.evaluate(retest)
+        self.counts[outcome] += 1
+        frequencies = retest.frequencies or (0, 0, 0, 0, 0)
+        if differences is None:
+            measured = ',,,,,'
+        else:
+            measured = '%.2f,%.2f,%.2f,%.2f,%.2f,%.2f' % tuple(differences + statistics)
+        self.fh.write('%d,%s,%s,%.2f,%d,%d,%d,%d,%d,%d,%d,%s,%s,%d,%d\n' % (
+            retest.point, retest.sensor, retest.reason, retest.priority, frequencies[0], frequencies[1],
+            frequencies[2], frequencies[3], frequencies[4], len(retest.bursts[ROLE_REPLICATE]),
+            len(retest.bursts[ROLE_CONTROL]), measured, outcome, retest.flagged_ns, time.monotonic_ns()))
+        self.fh.flush()
+        self.report('Retest %s point:%d fx:%d, fy:%d, fz:%d, clock1_phase:%d (%s)' % (
+            outcome.upper(), retest.point, frequencies[0], frequencies[1], frequencies[2], frequencies[3],
+            retest.reason))
+
+    def summary(self):
+        return 'Retest flagged:%d dropped:%d confirmed:%d rejected:%d inconclusive:%d' % (
+            self.counts['flagged'], self.counts['dropped'], self.counts[OUTCOME_CONFIRMED],
+            self.counts[OUTCOME_REJECTED], self.counts[OUTCOME_INCONCLUSIVE])
+
+    def close(self):
+        self.fh.close()
@@ -14,17 +14,35 @@ MIT Open Source License
 https://opensource.org/licenses/MIT
 """
 
+import argparse
 import atexit
+import functools
 import os
-import threading
+import shutil
 import time
 
 import RPi.GPIO as GPIO
 
 from PhaseShifter import PhaseShifter
 from Si5351_clock import Si5351
+from mag_adaptive import BaselineTracker, DecayMonitor, SequentialTest
+from mag_checkpoint import checkpoint_state, read_checkpoint, remove_checkpoint, restore_state, truncate_data
+from mag_checkpoint import write_checkpoint
+from mag_detect import EventLog, OnlineDetector
+from mag_telemetry import TelemetryPublisher
+from mag_drift import TemperatureDriftModel
+from mag_retest import RetestQueue
+from mag_scheduler import DeadlineScheduler
+from mag_spectral import BATCH_BURSTS, BurstSeries, SpectraStore
+from scan_order import optimize_order
+from scan_refine import RefineAxis, RefineScan
+from scan_space import scan_space_3
 from mag_sensor import MagneticSensor
-from mag_scan_info import ScanInfo, MagSample
+from mag_chunked import ChunkedStore, create_chunked, truncate_chunked
+from mag_columnar import ColumnarStore, SampleBatch, create_columnar, truncate_columnar
+from mag_query import IndexedStore
+from mag_writer import FORMAT_CHUNKED, FORMAT_COLUMNAR, FORMAT_CSV, CsvStore, SampleWriter
+from mag_scan_info import CSV_HEADER, ScanInfo, MagSample
 
 GPIO.setwarnings(False)
 
@@ -36,6 +54,14 @@ IN_Y = 20
 IN_Z = 21
 MAG_READY_PIN = 5
 
+DATA_FILE = 'mag_profile.csv'
+COLUMNAR_DIR = 'mag_profile.col'
+CHUNKED_FILE = 'mag_profile.chk'
+CHECKPOINT_FILE = 'mag_profile.checkpoint.json'
+EVENTS_FILE = 'mag_events.jsonl'
+SPECTRA_FILE = 'mag_spectra.csv'
+RETEST_FILE = 'mag_retest.csv'
+
 # Pin Setup:
 GPIO.setmode(GPIO.BCM)  # Broadcom pin-numbering scheme.
 GPIO.setup(ENABLE_X, GPIO.OUT)  # Red LED pin set as output
@@ -60,31 +86,21 @@ def turn_off_magnets():
 atexit.register(turn_off_magnets)
 
 
-# call function after a delay
-def call_method_after_delay(method=None, params=None, seconds=0.0):
-    if params is None:
-        params = []
-    return threading.Timer(seconds, method, params).start()
-
-
-def cancel_delayed_call(timer):
-    timer.cancel()
-
-
 # = Support
 def set_clocks(fx, fy, fz, si):
     # If we always use pll A, don't want to keep resetting it.
+    # Outputs are left disabled, start_field turns them on together.
     pll = 0
     if fx > 0:
-        si.setFrequency(clock=0, pll=pll, targetFrequency=fx)  # X axis
+        si.setFrequency(clock=0, pll=pll, targetFrequency=fx, enableOutput=False)  # X axis
     else:
         si.disableOutput(0)  # disable clock 0
     if fy > 0:
-        si.setFrequency(clock=1, pll=pll, targetFrequency=fy)  # Y axis
+        si.setFrequency(clock=1, pll=pll, targetFrequency=fy, enableOutput=False)  # Y axis
     else:
         si.disableOutput(1)  # disable clock 1
     if fz > 0:
-        si.setFrequency(clock=2, pll=pll, targetFrequency=fz)  # Z axis
+        si.setFrequency(clock=2, pll=pll, targetFrequency=fz, enableOutput=False)  # Z axis
     else:
         si.disableOutput(2)  # disable clock 2
 
@@ -149,6 +165,25 @@ def test_config_3(scan_info):
     set_clocks(f0, f1 * 240, f2, scan_info.si)
 
 
+OFFSET_UNITS = 1 << 16  # offset_frequency coordinate, fraction of base_frequency
+
+
+def refine_scan_3(frequency_start, frequency_end, budget=3600.0):
+    # The test_config_3 scan as a multi-resolution search, see scan_refine.py.
+    # Coordinates are base frequency, offset as a fraction of the base frequency
+    # (so the offset always stays within x..2x) and phase in counts of 240.
+    axes = [RefineAxis('base_frequency', frequency_start, frequency_end, 20),
+            RefineAxis('offset', 0, OFFSET_UNITS, 8),
+            RefineAxis('clock1_phase_offset', 0, 120, 6)]
+
+    def point_values(coords):
+        base, offset, phase = coords
+        return {'base_frequency': base,
+                'offset_frequency': base + (base * offset + OFFSET_UNITS // 2) // OFFSET_UNITS,
+                'clock1_phase_offset': phase}
+    return RefineScan(axes, point_values, budget=budget)
+
+
 def test_config_4(scan_info):
     # scan with harmonics
     if scan_info.cycle_count == 0:
@@ -170,48 +205,255 @@ def test_config_4(scan_info):
 
 
 # = scanning sequence
-def send_burst(scan_info):
-    # initiate burst for selected test
+def prepare_burst(scan_info):
+    # Everything for the next burst except turning the field on:
+    # program the clocks and phase shifters with the outputs still disabled.
+    # adaptive dwell needs a magnets-off baseline before it can decide anything
+    scan_info.burst_test = None
+    if scan_info.adaptive_dwell and scan_info.baseline.ready():
+        scan_info.burst_test = SequentialTest(scan_info.baseline,
+                                              effect=scan_info.adaptive_effect,
+                                              alpha=scan_info.adaptive_alpha,
+                                              beta=scan_info.adaptive_beta)
+    scan_info.burst_request_ns = time.monotonic_ns()
     scan_info.test_config(scan_info)
-    # read sensor just before burst ends
-    m_second = scan_info.duration_now - 0.001
-    call_method_after_delay(method=read_sensor1, params=[scan_info], seconds=m_second)
+    scan_info.burst_series = None
+    retesting = scan_info.retest is not None and scan_info.retest.active()
+    if scan_info.burst_test is not None and scan_info.spectral is not None and not retesting:
+        # keep this burst's readings for its spectrum, scan points only (not re-test bursts)
+        scan_info.burst_series = BurstSeries(scan_info)
+    scan_info.burst_staged = True
+
+
+def start_field(scan_info):
+    # the only bus write left on the critical path
+    if not scan_info.control_burst:
+        scan_info.si.enableOutputs(True)
+    scan_info.burst_start_ns = time.monotonic_ns()
+    scan_info.burst_active = True
+    scan_info.burst_staged = False
+    monitor = scan_info.pause_monitor
+    scan_info.pause_monitor = None
+    if monitor is not None and not monitor.settled:
+        rebuild_baseline(scan_info, monitor)
+    if scan_info.pause_end_ns:
+        scan_info.start_delay.add(scan_info.burst_start_ns - scan_info.pause_end_ns)
+    if scan_info.burst_end_ns:
+        # pause actually used since the previous burst, recorded with each sample
+        scan_info.pause_used = (scan_info.burst_start_ns - scan_info.burst_end_ns) / 1e9
+
+
+def send_burst(scan_info):
+    # initiate burst for selected test, normally staged by next_cycle during the pause
+    if not scan_info.run_next_test_cycle:
+        return  # the scan was stopped while this burst was staged
+    if not scan_info.burst_staged:
+        prepare_burst(scan_info)
+    start_field(scan_info)
+    if scan_info.burst_test is not None:
+        # stream readings during the burst, read_sensor_adaptive ends it once decided
+        duration = scan_info.dwell_max
+    else:
+        duration = scan_info.duration_now
+    # burst length is measured from when the field came on, not from when we were called
+    end_ns = scan_info.burst_start_ns + int(duration * 1e9)
+    if scan_info.burst_test is None:
+        # read sensor just before burst ends
+        scan_info.scheduler.call_at(end_ns - 1000000, read_sensor1, [scan_info])
     # end burst after requested interval
-    call_method_after_delay(method=end_burst, params=[scan_info], seconds=scan_info.duration_now)
+    scan_info.burst_timer = scan_info.scheduler.call_at(end_ns, end_burst, [scan_info])
 
 
-def end_burst(scan_info):
+def turn_off_field(scan_info):
     scan_info.phase_shifter1.clock_disable()
     scan_info.phase_shifter2.clock_disable()
     time.sleep(0.0001)    # allow phase shifter to count clocks off
     scan_info.si.enableOutputs(False)
-    # call_method_after_delay(method=read_sensor2, params=[scan_info], seconds=0.012)
-    # update parameters for next test cycle after requested pause
-    call_method_after_delay(method=scan_info.test_update_parameters, params=[scan_info], seconds=scan_info.cycle_pause)
+    scan_info.burst_end_ns = time.monotonic_ns()
+    with scan_info.burst_lock:
+        # readings taken while the field was on could not know when it would go off
+        scan_info.mag_samples.fill_burst_end(scan_info.burst_start_ns, scan_info.burst_end_ns)
+
+
+def end_burst(scan_info):
+    # may be called by the burst timer or early by read_sensor_adaptive, only act once
+    with scan_info.burst_lock:
+        if not scan_info.burst_active:
+            return
+        scan_info.burst_active = False
+    scan_info.burst_timer.cancel()
+    turn_off_field(scan_info)
+    start_pause(scan_info)
+    if scan_info.burst_test is not None:
+        save_burst_result(scan_info)
+    if scan_info.pipeline:
+        # stage the next point during the pause, once this burst's last reading is in
+        scan_info.scheduler.call_at(scan_info.burst_end_ns + int(scan_info.stage_delay * 1e9), next_cycle, [scan_info])
+    else:
+        # update parameters for next test cycle after requested pause
+        with scan_info.burst_lock:
+            scan_info.pause_timer = scan_info.scheduler.call_at(scan_info.pause_end_ns, next_cycle, [scan_info])
+
+
+def start_pause(scan_info):
+    # The field is off.  The pause lasts cycle_pause, or with adaptive_pause
+    # until the field has decayed back to the baseline (see end_pause).
+    scan_info.pause_timer = None
+    scan_info.pause_monitor = None
+    if scan_info.adaptive_pause and scan_info.baseline.ready():
+        scan_info.pause_monitor = DecayMonitor(scan_info.baseline,
+                                               tolerance=scan_info.pause_tolerance,
+                                               settle_count=scan_info.pause_settle_count)
+    scan_info.pause_end_ns = scan_info.burst_end_ns + int(scan_info.cycle_pause * 1e9)
+    scan_info.baseline_after_ns = scan_info.burst_end_ns + int(scan_info.baseline_settle * 1e9)
+
+
+def end_pause(scan_info):
+    # the field has decayed, start the next burst now but not before pause_min
+    with scan_info.burst_lock:
+        scan_info.pause_end_ns = max(scan_info.burst_end_ns + int(scan_info.pause_min * 1e9), time.monotonic_ns())
+        timer = scan_info.pause_timer
+        if timer is not None and scan_info.scheduler.cancel(timer):
+            scan_info.pause_timer = scan_info.scheduler.call_at(scan_info.pause_end_ns, timer.method, timer.params)
+
+
+def rebuild_baseline(scan_info, monitor):
+    # The pause ran to cycle_pause without the field settling at the baseline.
+    # After a step in the ambient field it never would, so start the baseline
+    # again from the end of this pause rather than keep a stale one.
+    scan_info.pause_timeouts += 1
+    scan_info.baseline.reset()
+    for x, y, z in monitor.late_readings():
+        scan_info.baseline.add(x, y, z)
+
+
+def read_field(scan_info):
+    # read MAG3110, correcting for die temperature drift when enabled
+    # returns (x, y, z) or None if the sensor could not be read
+    if not scan_info.drift_compensation:
+        return scan_info.mag_sensor.readMagneticField()
+    # status, axes and temperature in a single transaction
+    block = scan_info.mag_sensor.readBlock()
+    if block is None:
+        return None
+    status, x, y, z, temperature = block
+    scan_info.die_temperature = temperature
+    x, y, z = scan_info.drift_model.correct(x, y, z, temperature)
+    return round(x), round(y), round(z)
+
+
+def read_baseline(scan_info):
+    # magnets-off reading, fits the drift model and the adaptive dwell baseline
+    # With adaptive_pause, readings only count as baseline once the field has decayed.
+    if scan_info.drift_compensation:
+        block = scan_info.mag_sensor.readBlock()
+        if block is None:
+            return
+        status, raw_x, raw_y, raw_z, temperature = block
+        scan_info.die_temperature = temperature
+        x, y, z = scan_info.drift_model.correct(raw_x, raw_y, raw_z, temperature)
+    else:
+        field = scan_info.mag_sensor.readMagneticField()
+        if field is None:
+            return
+        x, y, z = field
+    monitor = scan_info.pause_monitor
+    if monitor is not None:
+        was_settled = monitor.settled
+        if not monitor.add(x, y, z):
+            return  # still decaying
+        if not was_settled:
+            end_pause(scan_info)
+    if scan_info.drift_compensation:
+        scan_info.drift_model.add(raw_x, raw_y, raw_z, temperature)
+    if scan_info.adaptive_dwell or scan_info.adaptive_pause:
+        scan_info.baseline.add(x, y, z)
+
+
+def discard_reading(scan_info):
+    # MAG3110 INT1 stays high until the output registers are read, so a
+    # conversion left unread means no further data ready edges
+    scan_info.mag_sensor.readMagneticField()
 
 
 def read_sensor1(scan_info):
     # read MAG3110 sensor to initialize for a new measurement
-    x, y, z = scan_info.mag_sensor.readMagneticField()
-    sample = MagSample(x, y, z)
+    read_field(scan_info)
     scan_info.do_read_sensor = True  # read again (read_sensor2) when ready interrupt fires
-    sample.f0 = scan_info.f0
-    sample.f1 = scan_info.f1
-    sample.f2 = scan_info.f2
 
 
-def read_sensor2(scan_info):
-    # print("read_sensor2")
-    x, y, z = scan_info.mag_sensor.readMagneticField()
-    sample = MagSample(x, y, z)
+def take_read_request(scan_info):
+    # True once per read_sensor1, whether claimed by the ready interrupt or by next_cycle
+    with scan_info.burst_lock:
+        requested = scan_info.do_read_sensor
+        scan_info.do_read_sensor = False
+    return requested
+
+
+def make_sample(scan_info, field, ready_ns=0, read_ns=0):
+    # field is (x, y, z), or None when the sensor could not be read.
+    # A failed read is kept as an invalid sample rather than a fake zero reading.
+    # ready_ns and read_ns are the data ready edge and read completion times.
+    if field is None:
+        sample = MagSample(None, None, None)
+        sample.valid = False
+    else:
+        x, y, z = field
+        sample = MagSample(x, y, z)
     sample.f0 = scan_info.f0  # include frequency with sample
     sample.f1 = scan_info.f1
     sample.f2 = scan_info.f2
     sample.clock1_phase_offset = round(scan_info.clock1_phase_offset * 360 / 240)
     sample.clock2_phase_offset = round(scan_info.clock2_phase_offset * 360 / 240)
     sample.duration = scan_info.duration_now
-    scan_info.mag_samples.append(sample)
-    if scan_info.cycle_count - scan_info.cycle_last_interval > 10:
+    sample.pause = scan_info.pause_used
+    sample.temperature = scan_info.die_temperature
+    sample.burst_start_ns = scan_info.burst_start_ns
+    if scan_info.burst_end_ns > scan_info.burst_start_ns:
+        sample.burst_end_ns = scan_info.burst_end_ns
+    # else the field is still on, this burst's end is filled in by turn_off_field or add_sample
+    sample.ready_ns = ready_ns
+    sample.read_ns = read_ns
+    sample.point = scan_info.scan_index
+    return sample
+
+
+def add_sample(scan_info, sample):
+    # the ready callback adds samples while save_samples takes them away
+    # the sample is copied into the next row of the batch, the object itself is not kept
+    with scan_info.burst_lock:
+        if scan_info.retest is not None and scan_info.retest.active():
+            # replicate and control readings are compared by the re-test, they are not scan results
+            scan_info.retest.add(sample)
+            return
+        if (not sample.burst_end_ns and scan_info.burst_start_ns == sample.burst_start_ns and
+                scan_info.burst_end_ns > sample.burst_start_ns):
+            # the field went off while this reading was on its way
+            sample.burst_end_ns = scan_info.burst_end_ns
+        scan_info.mag_samples.append(sample)
+        if scan_info.detector is not None and sample.valid:
+            # O(1) per reading, events go to the detector listeners (mag_events.jsonl)
+            scan_info.detector.add(sample)
+
+
+def read_sensor2(scan_info, ready_ns=0):
+    # print("read_sensor2")
+    field = read_field(scan_info)
+    read_ns = time.monotonic_ns()
+    sample = make_sample(scan_info, field, ready_ns, read_ns)
+    add_sample(scan_info, sample)
+    if scan_info.sensor_array is not None:
+        # map the field at every array position during the same burst
+        for reading in scan_info.sensor_array.readAll():
+            array_sample = make_sample(scan_info, reading.field, ready_ns, reading.timestamp_ns)
+            array_sample.sensor = reading.name
+            add_sample(scan_info, array_sample)
+            if scan_info.telemetry is not None:
+                scan_info.telemetry.sample(array_sample)
+    if scan_info.telemetry is not None:
+        # never blocks, unlike print on a slow terminal
+        scan_info.telemetry.sample(sample)
+    elif sample.valid and scan_info.cycle_count - scan_info.cycle_last_interval > 10:
         # print(sample)
         print('fx:%d, fy:%d, fz:%d, clock1_phase:%d, clock2_phase:%d, magX:%d, magY:%d, magZ:%d' % (
             sample.f0, sample.f1, sample.f2,
@@ -220,6 +462,72 @@ def read_sensor2(scan_info):
     # update_parameters(scan_info)
 
 
+def read_sensor_adaptive(scan_info, ready_ns):
+    # In adaptive mode every data ready event is used, either as a burst
+    # reading for the sequential test or as a magnets-off baseline reading.
+    if take_read_request(scan_info):
+        # fixed length burst while the baseline is still being collected
+        read_sensor2(scan_info, ready_ns)
+        return
+    if not scan_info.burst_active:
+        if ready_ns >= scan_info.baseline_after_ns:
+            read_baseline(scan_info)
+        else:
+            discard_reading(scan_info)
+        return
+    test = scan_info.burst_test
+    if test is None:
+        return
+    field = read_field(scan_info)
+    if field is None:
+        return
+    scan_info.read_ns = time.monotonic_ns()
+    x, y, z = field
+    decision = add_burst_reading(scan_info, ready_ns, x, y, z)
+    if decision is not None and scan_info.read_ns - scan_info.burst_start_ns >= scan_info.dwell_min * 1e9:
+        end_burst(scan_info)
+
+
+def report(scan_info, text):
+    # a message from the scan threads, sent to telemetry viewers rather than the terminal when enabled
+    if scan_info.telemetry is not None:
+        scan_info.telemetry.log(text)
+    else:
+        print(text)
+
+
+def add_burst_reading(scan_info, ready_ns, x, y, z):
+    # one adaptive burst reading, returns the sequential test decision
+    if scan_info.burst_series is not None:
+        scan_info.burst_series.add(ready_ns, x, y, z)
+    return scan_info.burst_test.add(x, y, z)
+
+
+def save_burst_result(scan_info):
+    # record mean field over an adaptive burst along with the test outcome
+    test = scan_info.burst_test
+    if test.count() == 0:
+        report(scan_info, 'No readings during adaptive burst')
+        return
+    x, y, z = test.means()
+    # timestamps are those of the last reading included in the mean
+    sample = make_sample(scan_info, (round(x), round(y), round(z)), scan_info.ready_ns, scan_info.read_ns)
+    sample.duration = (scan_info.burst_end_ns - scan_info.burst_start_ns) / 1e9
+    sample.decision = test.decision
+    add_sample(scan_info, sample)
+    series = scan_info.burst_series
+    if series is not None:
+        # spectral features, computed in batches on the spectral thread
+        series.burst_start_ns = scan_info.burst_start_ns
+        scan_info.burst_series = None
+        submit_or_stop(scan_info, scan_info.spectral, [series])
+    if sample.decision == 'anomaly':
+        report(scan_info, 'Anomaly fx:%d, fy:%d, fz:%d, clock1_phase:%d, magX:%d, magY:%d, magZ:%d' % (
+            sample.f0, sample.f1, sample.f2, sample.clock1_phase_offset, sample.x, sample.y, sample.z))
+        if scan_info.retest is not None and not scan_info.retest.active():
+            scan_info.retest.flag(sample.point, test.deviation(), 'adaptive')
+
+
 def test_update_parameters_2(scan_info):
     scan_info.cycle_count += 1
     scan_info.clock1_phase_offset += 1
@@ -227,19 +535,15 @@ def test_update_parameters_2(scan_info):
     if scan_info.clock2_phase_offset <= 120:
         # For this test, we only need to shift 180 degrees (120 counts of 240)
         # to cover every phase relationship between two clock signals
-        call_method_after_delay(method=send_burst, params=[scan_info], seconds=0.001)
-
+        pass
     elif scan_info.duration_now < scan_info.duration_end:
+        # repeat burst sequence with the next duration
         scan_info.duration_now += scan_info.duration_step
-        # repeat burst sequence
-        call_method_after_delay(method=send_burst, params=[scan_info], seconds=0.001)
     else:
         scan_info.duration_now = scan_info.duration_start
         if scan_info.base_frequency < scan_info.frequency_end:
             scan_info.base_frequency += scan_info.frequency_step
             scan_info.offset_frequency = scan_info.base_frequency
-            # repeat burst sequence after 1ms
-            call_method_after_delay(method=send_burst, params=[scan_info], seconds=0.001)
         else:
             scan_info.run_next_test_cycle = False
             print('Sequence completed')
@@ -247,9 +551,6 @@ def test_update_parameters_2(scan_info):
     scan_info.clock1_phase_offset %= 240
     scan_info.clock2_phase_offset %= 240
 
-    if (scan_info.cycle_count % 1000 == 0) or (not scan_info.run_next_test_cycle):
-        save_samples(scan_info)
-
 
 def test_update_parameters_3(scan_info):
     # Phase shifted Clk1 drives the x-axis since we can only phase shift relative to Clk0.
@@ -274,24 +575,154 @@ def test_update_parameters_3(scan_info):
         print('Sequence completed')
         break
 
+
+def test_update_parameters_space(scan_info):
+    # step to the next point of scan_info.scan_space
+    scan_info.cycle_count += 1
+    scan_info.scan_index += 1
+    stop = scan_info.scan_stop_index if scan_info.scan_stop_index is not None else len(scan_info.scan_space)
+    if scan_info.scan_index < stop:
+        scan_info.scan_space.apply(scan_info.scan_index, scan_info)
+    else:
+        scan_info.run_next_test_cycle = False
+        print('Sequence completed')
+
+
+def update_parameters(scan_info):
+    # step to the next point, after measuring any flagged points again
+    retest = scan_info.retest
+    if retest is None:
+        scan_info.test_update_parameters(scan_info)
+        return
+    retesting = retest.active()
+    if not retesting:
+        scan_info.test_update_parameters(scan_info)
+        retest.scan_finished = not scan_info.run_next_test_cycle
+    if retest.next_step(scan_info):
+        # a replicate or control burst, the scan's next point waits (also after its last point)
+        scan_info.run_next_test_cycle = True
+    elif retesting:
+        # back to the point that was waiting, unless the scan had finished
+        scan_info.control_burst = False
+        scan_info.run_next_test_cycle = not retest.scan_finished
+        if scan_info.run_next_test_cycle:
+            scan_info.scan_space.apply(scan_info.scan_index, scan_info)
+
+
+def scan_eta(scan_info):
+    # (points in scan_space, seconds remaining or None until a point is done)
+    total = scan_info.scan_stop_index if scan_info.scan_stop_index is not None else len(scan_info.scan_space)
+    done = scan_info.scan_index - scan_info.scan_start_index
+    if done <= 0:
+        return total, None
+    seconds_per_point = (time.monotonic_ns() - scan_info.scan_start_ns) / 1e9 / done
+    return total, int(seconds_per_point * (total - scan_info.scan_index))
+
+
+def scan_progress(scan_info):
+    # progress through scan_space with an estimate of the time remaining
+    total, remaining = scan_eta(scan_info)
+    text = 'point %d of %d (%.3f%%)' % (scan_info.scan_index, total, 100.0 * scan_info.scan_index / max(total, 1))
+    if remaining is not None:
+        text += ', ETA %dd %02d:%02d:%02d' % (
+            remaining // 86400, remaining // 3600 % 24, remaining // 60 % 60, remaining % 60)
+    return text
+
+
+def publish_progress(scan_info):
+    # progress, ETA and counters for telemetry viewers, only built when one is listening
+    telemetry = scan_info.telemetry
+    if telemetry is None or not telemetry.active():
+        return
+    total, remaining = scan_eta(scan_info) if scan_info.scan_space is not None else (0, None)
+    sensor = scan_info.mag_sensor
+    counters = {'cycles': scan_info.cycle_count,
+                'sensor_reads': sensor.readCount, 'sensor_errors': sensor.errorCount,
+                'sensor_retries': sensor.retryCount, 'sensor_invalid': sensor.invalidCount,
+                'sensor_recoveries': sensor.recoveryCount, 'sensor_recovering': int(sensor.recovering),
+                'si5351_writes': scan_info.si.writeCount, 'si5351_skipped': scan_info.si.writesSkipped,
+                'si5351_errors': scan_info.si.writeErrors, 'pause_timeouts': scan_info.pause_timeouts,
+                'phase_writes': scan_info.phase_shifter1.write_count + scan_info.phase_shifter2.write_count}
+    if scan_info.writer is not None:
+        stats = scan_info.writer.stats
+        counters.update({'writer_rows': stats.rows, 'writer_stalls': stats.stalls, 'writer_queue_max': stats.max_depth})
+    if scan_info.detector is not None:
+        counters['detector_events'] = scan_info.detector.event_count
+    if scan_info.retest is not None:
+        counters.update({'retest_queued': scan_info.retest.pending(),
+                         'retest_confirmed': scan_info.retest.counts['confirmed'],
+                         'retest_rejected': scan_info.retest.counts['rejected']})
+    lateness = {}
+    if scan_info.scheduler is not None:
+        for name, stats in list(scan_info.scheduler.lateness.items()):
+            lateness[name] = {'mean': stats.mean_ns() / 1e3, 'max': stats.max_ns / 1e3}
+    telemetry.progress({'point': scan_info.scan_index, 'total': total,
+                        'percent': 100.0 * scan_info.scan_index / max(total, 1), 'eta': remaining,
+                        'counters': counters, 'lateness_us': lateness})
+
+
+def next_cycle(scan_info):
+    # update parameters for the next test cycle and start its burst
+    if take_read_request(scan_info):
+        # no data ready edge since read_sensor1, keep the point as an invalid sample
+        add_sample(scan_info, make_sample(scan_info, None))
+    update_parameters(scan_info)
     if scan_info.run_next_test_cycle:
-        call_method_after_delay(method=send_burst, params=[scan_info], seconds=0.001)
-    # save samples to disk after 1000 cycles
-    if (scan_info.cycle_count % 1000 == 0) or (not scan_info.run_next_test_cycle):
+        if scan_info.pipeline:
+            prepare_burst(scan_info)
+            # only the output enable is left for the end of the pause
+            with scan_info.burst_lock:
+                scan_info.pause_timer = scan_info.scheduler.call_at(max(scan_info.pause_end_ns, time.monotonic_ns()),
+                                                                    send_burst, [scan_info])
+        else:
+            scan_info.scheduler.call_after(0.001, send_burst, [scan_info])
+    # hand every point to the writer, or save samples to disk after 1000 cycles
+    if scan_info.writer is not None or (scan_info.cycle_count % 1000 == 0) or (not scan_info.run_next_test_cycle):
         save_samples(scan_info)
 
 
 def save_samples(scan_info):
-    # Save the data we collected
-    samples = scan_info.mag_samples
-    fh = open('mag_profile.csv', 'a')
-    for sample in samples:
-        fh.write('%d,%d,%d,%d,%d,%d,%d %d\n' % (
-            sample.f0, sample.f1, sample.f2,
-            sample.clock1_phase_offset, sample.clock2_phase_offset, sample.x, sample.y, sample.z))
-        # reset samples array to collect more
-        scan_info.mag_samples = []
-    fh.close()
+    # Save the data we collected, starting a new list to collect more
+    with scan_info.burst_lock:
+        samples = scan_info.mag_samples
+        scan_info.mag_samples = SampleBatch()
+    if scan_info.sample_sink is not None:
+        scan_info.sample_sink(samples)
+        return
+    if scan_info.writer is not None:
+        # written and checkpointed by the writer thread, returns at once
+        submit_or_stop(scan_info, scan_info.writer, samples, checkpoint_state(scan_info))
+        return
+    commit_samples(samples, checkpoint_state(scan_info), scan_info.result_format)
+
+
+def submit_or_stop(scan_info, writer, samples, state=None):
+    # hand samples to a SampleWriter, stopping the scan if its store has failed
+    # run_scan raises the error again once the field is off
+    try:
+        writer.submit(samples, state)
+    except Exception:
+        scan_info.run_next_test_cycle = False
+        raise
+
+
+def open_store(result_format):
+    # where samples are appended: mag_profile.csv, the columnar mag_profile.col or the chunked mag_profile.chk
+    if result_format == FORMAT_COLUMNAR:
+        # kept indexed for mag_query.py as it grows
+        return IndexedStore(ColumnarStore(COLUMNAR_DIR))
+    if result_format == FORMAT_CHUNKED:
+        return ChunkedStore(CHUNKED_FILE)
+    return CsvStore(DATA_FILE)
+
+
+def commit_samples(samples, state, result_format=FORMAT_CSV):
+    # append samples, then record the checkpoint that covers them
+    store = open_store(result_format)
+    store.append(samples)
+    state['data_length'] = store.sync()
+    store.close()
+    write_checkpoint(CHECKPOINT_FILE, state)
     print('file saved')
 
 
@@ -306,10 +737,19 @@ class ReadSensorEvents(object):
         # GPIO.remove_event_detect(MAG_READY_PIN)
 
     def callback(self, pin):
+        # timestamp the data ready edge before doing anything else
+        ready_ns = time.monotonic_ns()
+        self.scan_info.ready_ns = ready_ns
         # print("Mag Event")
-        if self.scan_info.do_read_sensor:
-            self.scan_info.do_read_sensor = False
-            read_sensor2(self.scan_info)
+        if self.scan_info.adaptive_dwell:
+            read_sensor_adaptive(self.scan_info, ready_ns)
+        elif take_read_request(self.scan_info):
+            read_sensor2(self.scan_info, ready_ns)
+        elif (self.scan_info.drift_compensation or self.scan_info.adaptive_pause) and not self.scan_info.burst_active:
+            if ready_ns >= self.scan_info.baseline_after_ns:
+                read_baseline(self.scan_info)
+            else:
+                discard_reading(self.scan_info)
 
     def cleanup(self):
         GPIO.remove_event_detect(MAG_READY_PIN)
@@ -318,60 +758,310 @@ class ReadSensorEvents(object):
 # Main Program to run test sequence
 
 
-def prepare_test_run():
+def prepare_test_run(resume=False, result_format=FORMAT_CSV):
+    # Returns the checkpoint state to resume from, or None for a new run.
+    # On resume the result format is the one recorded in the checkpoint.
+    if resume:
+        state = read_checkpoint(CHECKPOINT_FILE)
+        if state is None:
+            raise SystemExit('No %s to resume from' % CHECKPOINT_FILE)
+        # drop rows written after the checkpoint, those points are measured again
+        if state.get('result_format', FORMAT_CSV) == FORMAT_COLUMNAR:
+            truncate_columnar(COLUMNAR_DIR, state['data_length'])
+        elif state.get('result_format', FORMAT_CSV) == FORMAT_CHUNKED:
+            truncate_chunked(CHUNKED_FILE, state['data_length'])
+        else:
+            truncate_data(DATA_FILE, state['data_length'])
+        print('Resuming at point %d' % state['scan_index'])
+        return state
+
     # remove old data if any
-    if os.path.isfile("mag_profile.csv"):
-        os.remove("mag_profile.csv")
+    if os.path.isfile(DATA_FILE):
+        os.remove(DATA_FILE)
         print("Previous mag_profile.csv removed!")
+    if os.path.isdir(COLUMNAR_DIR):
+        shutil.rmtree(COLUMNAR_DIR)
+        print("Previous %s removed!" % COLUMNAR_DIR)
+    if os.path.isfile(CHUNKED_FILE):
+        os.remove(CHUNKED_FILE)
+        print("Previous %s removed!" % CHUNKED_FILE)
+    for output in (EVENTS_FILE, SPECTRA_FILE, RETEST_FILE):
+        if os.path.isfile(output):
+            os.remove(output)
+    remove_checkpoint(CHECKPOINT_FILE)
+
+    if result_format == FORMAT_COLUMNAR:
+        create_columnar(COLUMNAR_DIR)
+        return None
+    if result_format == FORMAT_CHUNKED:
+        create_chunked(CHUNKED_FILE)
+        return None
 
     # write column headers to new csv output file
-    fh = open('mag_profile.csv', 'a')
-    fh.write("freq_x,freq_y,freq_z,clock1_phase,clock2_phase,mag_x,mag_y,mag_z\n")
+    fh = open(DATA_FILE, 'a')
+    fh.write(CSV_HEADER + '\n')
     fh.close()
+    return None
 
 
-prepare_test_run()
+def resume_scan(scan_info, state):
+    # continue at the first point not covered by the checkpoint
+    if scan_info.scan_space is None:
+        raise SystemExit('Resume needs a scan_space')
+    restore_state(scan_info, state)
+    if scan_info.scan_index >= len(scan_info.scan_space):
+        print('Sequence already completed')
+        return False
+    scan_info.scan_space.apply(scan_info.scan_index, scan_info)
+    return True
 
 
-def run_test_sequence():
-    print("Starting test sequence")
-    print("Press ^C to abort\n")
+def save_interrupted_samples(scan_info):
+    # Keep samples of completed points only, the point in progress is measured again on resume.
+    scan_info.mag_samples = scan_info.mag_samples.before_point(scan_info.scan_index)
+    save_samples(scan_info)
+
+
+def make_scan_info():
     scan_info = ScanInfo()
     # scan_info is an object containing the test parameters we pass from step to step.
     # This allows asynchronous processing and also simplifies specifying multiple tests compactly.
     # si and mag are controller objects for Si5351 clock generator and MAG3110 magnetic sensor
     # fx, fy, fz are frequencies for each magnetic axis. 0 means disabled.
-    # results are stored as an array of MagSample objects which is saved to disk periodically in file mag_profile.csv
+    # results are collected in a SampleBatch (see mag_columnar.py) and saved to disk periodically in mag_profile.csv
     # see ScanInfo for a description of each parameter.
     # assign devices
     scan_info.si = Si5351()
     scan_info.mag_sensor = MagneticSensor()
     scan_info.phase_shifter1 = PhaseShifter()
     scan_info.phase_shifter2 = PhaseShifter(address=0x21)
-    scan_info.mag_samples = []
+    scan_info.mag_samples = SampleBatch()
+    scan_info.baseline = BaselineTracker()
+    scan_info.drift_model = TemperatureDriftModel()
+    # watch every reading for responses as they happen, see mag_detect.py
+    scan_info.detector = OnlineDetector()
+    # samples, events and progress for viewers (python mag_telemetry.py) instead of prints on the scan threads
+    scan_info.telemetry = TelemetryPublisher()
     # configure which test to run
     scan_info.test_config = test_config_3
-    scan_info.test_update_parameters = test_update_parameters_3
-    # Set parameters to resume previous test
-    scan_info.base_frequency = 20000
-    scan_info.offset_frequency = 20000
- 
+    scan_info.test_update_parameters = test_update_parameters_space
+    scan_info.scan_space = scan_space_3(20000, 40000, 1)
+    # or search the same space coarse to fine within a time budget (no --resume)
+    refine = None
+    # refine = refine_scan_3(20000, 40000, budget=24 * 3600.0)
+    if refine is not None:
+        scan_info.scan_space = None
+        scan_info.test_update_parameters = refine.update_parameters
+        refine.start(scan_info)
+        return configure_options(scan_info)
+    # measure the same points in the order that rewrites the fewest device registers
+    # scan_info.optimize_order = True
+    if scan_info.optimize_order:
+        scan_info.scan_space = optimize_order(scan_info.scan_space, scan_info.test_config)
+    # Set scan_index to resume previous test at that point
+    # (run with --resume to continue from the last checkpoint)
+    scan_info.scan_index = 0
+    scan_info.scan_start_index = scan_info.scan_index
+    scan_info.scan_space.apply(scan_info.scan_index, scan_info)
+    return configure_options(scan_info)
+
+
+def configure_options(scan_info):
+    # measurement options, the same for every scan
+    # end each burst as soon as the sequential test is decided
+    # scan_info.adaptive_dwell = True
+    # scan_info.dwell_min = 0.1
+    # scan_info.dwell_max = 1.0
+    # and record the spectrum of each burst's readings at the expected alias frequencies in mag_spectra.csv
+    # scan_info.spectral_analysis = True
+    # measure points flagged by the detector or adaptive dwell again, with magnets-off controls, before moving on
+    # scan_info.retest_anomalies = True
+    # start the next burst once the field has decayed to the baseline, at most cycle_pause
+    # scan_info.adaptive_pause = True
+    # scan_info.pause_min = 0.1
+    # fit and remove die temperature drift instead of repeating baseline runs
+    # scan_info.drift_compensation = True
+    # map the field at additional positions, one MAG3110 per multiplexer channel or bus
+    # from mag_sensor_array import MagneticSensorArray, SensorPosition
+    # scan_info.sensor_array = MagneticSensorArray([
+    #     SensorPosition('left', busnum=1, channel=0, position=(-0.05, 0.0, 0.0)),
+    #     SensorPosition('right', busnum=1, channel=1, position=(0.05, 0.0, 0.0)),
+    #     SensorPosition('top', busnum=3, position=(0.0, 0.0, 0.05))])
+    return scan_info
+
+
+def print_device_summary(scan_info):
+    print(scan_info.mag_sensor.errorSummary())
+    # measured register traffic, compare with the prediction from optimize_order
+    print(scan_info.si.writeSummary())
+    print('Phase shifter writes:%d skipped:%d errors:%d' % (
+        scan_info.phase_shifter1.write_count + scan_info.phase_shifter2.write_count,
+        scan_info.phase_shifter1.writes_skipped + scan_info.phase_shifter2.writes_skipped,
+        scan_info.phase_shifter1.write_errors + scan_info.phase_shifter2.write_errors))
+    if scan_info.sensor_array is not None:
+        for bus in scan_info.sensor_array.buses:
+            for sensor in bus.sensors:
+                print(sensor.errorSummary())
+
+
+def open_event_log(scan_info):
+    # detector events are appended to mag_events.jsonl and published, or printed without telemetry
+    # returns the EventLog or None
+    if scan_info.detector is None:
+        return None
+    event_log = EventLog(EVENTS_FILE, echo=scan_info.telemetry is None)
+    scan_info.detector.listeners.append(event_log.write)
+    if scan_info.telemetry is not None:
+        scan_info.detector.listeners.append(scan_info.telemetry.event)
+    return event_log
+
+
+def close_event_log(scan_info, event_log):
+    if event_log is not None:
+        scan_info.detector.listeners.remove(event_log.write)
+        if scan_info.telemetry is not None:
+            scan_info.detector.listeners.remove(scan_info.telemetry.event)
+        event_log.close()
+        print(scan_info.detector.summary())
+
+
+def open_spectral(scan_info):
+    # per burst spectra of adaptive bursts, written to mag_spectra.csv by their own thread
+    if scan_info.spectral_analysis and scan_info.adaptive_dwell:
+        scan_info.spectral = SampleWriter(SpectraStore(SPECTRA_FILE), commit_interval=30.0, commit_rows=BATCH_BURSTS)
+
+
+def close_spectral(scan_info):
+    if scan_info.spectral is not None:
+        spectral, scan_info.spectral = scan_info.spectral, None
+        spectral.close()
+
+
+def open_retest(scan_info):
+    # flagged points are measured again right away, outcomes in mag_retest.csv
+    # points are scan_space indexes, so not for refine scans
+    if not scan_info.retest_anomalies or scan_info.scan_space is None:
+        return
+    scan_info.retest = RetestQueue(scan_info.scan_space, RETEST_FILE, effect=scan_info.adaptive_effect,
+                                   report=functools.partial(report, scan_info))
+    if scan_info.retest_state is not None:
+        scan_info.retest.restore(scan_info.retest_state)
+        scan_info.retest_state = None
+    if scan_info.detector is not None:
+        scan_info.detector.listeners.append(scan_info.retest.on_event)
+
+
+def close_retest(scan_info):
+    if scan_info.retest is not None:
+        if scan_info.detector is not None:
+            scan_info.detector.listeners.remove(scan_info.retest.on_event)
+        scan_info.retest.close()
+        print(scan_info.retest.summary())
+        # what is still queued goes into the checkpoint of an interrupted scan
+        scan_info.retest_state = scan_info.retest.state()
+        scan_info.retest = None
+        scan_info.control_burst = False
+
+
+def wait_for_steps(scan_info, seconds, poll=0.1):
+    # sleep while the scheduler runs the scan, waking early once it stops
+    end = time.monotonic() + seconds
+    while scan_info.run_next_test_cycle and scan_info.scheduler.error is None:
+        remaining = end - time.monotonic()
+        if remaining <= 0:
+            return
+        time.sleep(min(poll, remaining))
+
+
+def run_scan(scan_info, progress_interval=5.0):
+    # Run the scan set up in scan_info until it completes.
+    # The field is off when this returns, also after ^C (KeyboardInterrupt is passed on)
+    # and when a scan step raised (the exception is passed on).
+    # one thread runs every timed step of the scan
+    scan_info.scheduler = DeadlineScheduler()
+    scan_info.scheduler.start()
+    if scan_info.sample_sink is None:
+        # mag_profile.csv and the checkpoint are written from their own thread
+        scan_info.writer = SampleWriter(open_store(scan_info.result_format), CHECKPOINT_FILE)
+    event_log = open_event_log(scan_info)
+    open_spectral(scan_info)
+    open_retest(scan_info)
     read_events = ReadSensorEvents(scan_info)
     read_events.setup()
-    send_burst(scan_info)
-    while scan_info.run_next_test_cycle:
-        print('.')  # let user know testing is underway
-        # loop to check if we're done every 5 seconds
-        time.sleep(5.0)
+    scan_info.scheduler.call_after(0.0, send_burst, [scan_info])
+    scan_info.scan_start_ns = time.monotonic_ns()
+    try:
+        while scan_info.run_next_test_cycle:
+            # let user know testing is underway, from this thread only
+            print(scan_progress(scan_info) if scan_info.scan_space is not None else '.')
+            publish_progress(scan_info)
+            # loop to check if we're done every progress_interval seconds
+            wait_for_steps(scan_info, progress_interval)
+            # a step that raised has ended the chain of steps, the field goes off below
+            scan_info.scheduler.check()
+    finally:
+        # waits for a step in progress, such as the final save_samples
+        scan_info.scheduler.stop()
+        read_events.cleanup()
+        turn_off_field(scan_info)
+        try:
+            if scan_info.writer is not None:
+                # everything handed over is on disk before this returns, raises if the store failed
+                writer, scan_info.writer = scan_info.writer, None
+                writer.close()
+                print(writer.stats.summary())
+        finally:
+            close_retest(scan_info)
+            close_spectral(scan_info)
+            close_event_log(scan_info, event_log)
+
+
+def run_test_sequence(resume_state=None, scan_info=None, progress_interval=5.0):
+    print("Starting test sequence")
+    print("Press ^C to abort\n")
+    if scan_info is None:
+        scan_info = make_scan_info()
+    if resume_state is not None and not resume_scan(scan_info, resume_state):
+        return
+    interrupted = False
+    try:
+        run_scan(scan_info, progress_interval)
+    except KeyboardInterrupt:
+        interrupted = True
 
     # cleanup
-    read_events.cleanup()
-    scan_info.phase_shifter1.clock_disable()
-    scan_info.phase_shifter2.clock_disable()
-    time.sleep(0.0001)    # allow phase shifter to count clocks off
-    scan_info.si.enableOutputs(False)
+    if scan_info.sensor_array is not None:
+        scan_info.sensor_array.close()
+    if interrupted:
+        save_interrupted_samples(scan_info)
+        print('Interrupted, run with --resume to continue at point %d' % scan_info.scan_index)
     turn_off_magnets()
+    print_device_summary(scan_info)
+    print(scan_info.scheduler.lateness_summary())
+    if scan_info.start_delay.count:
+        print('pause end to field on: mean %.1f us, max %.1f us' % (
+            scan_info.start_delay.mean_ns() / 1e3, scan_info.start_delay.max_ns / 1e3))
     print("End")
 
 
-run_test_sequence()
+def parse_args():
+    parser = argparse.ArgumentParser(description='Scan frequencies and phase relationships')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue from the last checkpoint instead of starting a new %s' % DATA_FILE)
+    parser.add_argument('--format', choices=[FORMAT_CSV, FORMAT_COLUMNAR, FORMAT_CHUNKED], default=FORMAT_CSV,
+                        help='results as %s, binary columns in %s or compressed chunks in %s '
+                             '(a resumed scan keeps its format)' % (DATA_FILE, COLUMNAR_DIR, CHUNKED_FILE))
+    return parser.parse_args()
+
+
+def make_run(args):
+    # checkpoint state (or None) and scan_info for the command line options
+    resume_state = prepare_test_run(resume=args.resume, result_format=args.format)
+    scan_info = make_scan_info()
+    scan_info.result_format = args.format
+    return resume_state, scan_info
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    run_test_sequence(*make_run(args))
@@ -0,0 +1,228 @@
+#!/usr/bin/python
+"""
+Summary: asyncio version of the mag_scan test sequence.
+Bursts, sensor waits and pauses are coroutines run in order by one task,
+so the scan state in ScanInfo is only touched from the event loop.
+MAG3110 data ready edges are passed from the GPIO callback thread into the
+loop with call_soon_threadsafe.  Every I2C operation runs on a single
+dedicated executor thread, so bus transactions never interleave, and
+results are written to disk on a separate storage thread while the next
+bursts run.
+
+Uses the same test_config / test_update_parameters functions, ScanInfo
+settings and mag_profile.csv format as mag_scan.py.
+
+MIT Open Source License
+https://opensource.org/licenses/MIT
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import time
+
+import RPi.GPIO as GPIO
+
+from mag_checkpoint import checkpoint_state
+from mag_columnar import SampleBatch
+from mag_scan import MAG_READY_PIN, make_run, make_scan_info, parse_args, print_device_summary
+from mag_scan import prepare_burst, read_baseline, read_field, read_sensor2, resume_scan, save_burst_result
+from mag_scan import start_field, start_pause, turn_off_field
+from mag_scan import add_burst_reading, close_event_log, close_spectral, open_event_log, open_spectral
+from mag_scan import close_retest, open_retest, publish_progress, update_parameters
+from mag_scan import commit_samples, discard_reading, save_interrupted_samples, scan_progress, turn_off_magnets
+
+
+class AsyncScanEngine(object):
+    """Run the scan described by scan_info as a sequence of coroutines"""
+    def __init__(self, scan_info):
+        self.scan_info = scan_info
+        self.loop = None
+        self.ready_queue = None     # data ready edge timestamps from the GPIO thread
+        self.i2c_executor = ThreadPoolExecutor(max_workers=1)      # all bus traffic, in order
+        self.storage_executor = ThreadPoolExecutor(max_workers=1)  # file writes
+        self.pending_writes = []
+
+    # = Bridging threads into the loop
+    def on_data_ready(self, pin):
+        # GPIO callback thread: timestamp the edge before handing it to the loop
+        ready_ns = time.monotonic_ns()
+        self.loop.call_soon_threadsafe(self.ready_queue.put_nowait, ready_ns)
+
+    async def i2c(self, method, *params):
+        return await self.loop.run_in_executor(self.i2c_executor, functools.partial(method, *params))
+
+    async def sleep_until(self, deadline_ns):
+        delay_ns = deadline_ns - time.monotonic_ns()
+        if delay_ns > 0:
+            await asyncio.sleep(delay_ns / 1e9)
+
+    async def next_ready(self, deadline_ns):
+        # wait for the next data ready edge, returns its timestamp or None at the deadline
+        timeout = (deadline_ns - time.monotonic_ns()) / 1e9
+        if timeout <= 0:
+            return None
+        try:
+            return await asyncio.wait_for(self.ready_queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    async def drain_ready(self):
+        # forget edges for readings we no longer want
+        # MAG3110 INT1 stays high until the output registers are read, so an
+        # edge is only forgotten once its conversion has been read
+        if self.ready_queue.empty():
+            return
+        while not self.ready_queue.empty():
+            self.ready_queue.get_nowait()
+        await self.i2c(discard_reading, self.scan_info)
+
+    # = Scan steps
+    async def burst(self):
+        scan_info = self.scan_info
+        if not scan_info.burst_staged:
+            await self.i2c(prepare_burst, scan_info)
+        await self.i2c(start_field, scan_info)
+        if scan_info.burst_test is None:
+            await self.fixed_burst()
+        else:
+            await self.adaptive_burst()
+
+    async def fixed_burst(self):
+        scan_info = self.scan_info
+        end_ns = scan_info.burst_start_ns + int(scan_info.duration_now * 1e9)
+        # read sensor just before burst ends to start a new measurement
+        await self.sleep_until(end_ns - 1000000)
+        await self.i2c(read_field, scan_info)
+        await self.drain_ready()
+        await self.sleep_until(end_ns)
+        await self.end_burst()
+        # the next data ready edge completes the measurement
+        ready_ns = await self.next_ready(time.monotonic_ns() + 100000000)
+        await self.i2c(read_sensor2, scan_info, ready_ns or 0)
+
+    async def adaptive_burst(self):
+        scan_info = self.scan_info
+        test = scan_info.burst_test
+        end_ns = scan_info.burst_start_ns + int(scan_info.dwell_max * 1e9)
+        min_ns = scan_info.burst_start_ns + int(scan_info.dwell_min * 1e9)
+        await self.drain_ready()
+        while True:
+            ready_ns = await self.next_ready(end_ns)
+            if ready_ns is None:
+                break
+            field = await self.i2c(read_field, scan_info)
+            if field is None:
+                continue
+            scan_info.ready_ns = ready_ns
+            scan_info.read_ns = time.monotonic_ns()
+            x, y, z = field
+            if add_burst_reading(scan_info, ready_ns, x, y, z) is not None and scan_info.read_ns >= min_ns:
+                break
+        await self.end_burst()
+        save_burst_result(scan_info)
+
+    async def end_burst(self):
+        scan_info = self.scan_info
+        scan_info.burst_active = False
+        await self.i2c(turn_off_field, scan_info)
+        start_pause(scan_info)
+
+    async def pause(self):
+        # magnets are off, use the readings as baseline where needed
+        # read_baseline moves pause_end_ns earlier once an adaptive pause has settled
+        scan_info = self.scan_info
+        use_baseline = scan_info.adaptive_dwell or scan_info.drift_compensation or scan_info.adaptive_pause
+        await self.drain_ready()
+        while True:
+            ready_ns = await self.next_ready(scan_info.pause_end_ns)
+            if ready_ns is None:
+                break
+            if use_baseline and ready_ns >= scan_info.baseline_after_ns:
+                await self.i2c(read_baseline, scan_info)
+            else:
+                # not wanted or still settling, read anyway so the sensor raises the next edge
+                await self.i2c(discard_reading, scan_info)
+
+    def save(self):
+        # hand the collected samples to the storage thread, keep scanning
+        samples = self.scan_info.mag_samples
+        self.scan_info.mag_samples = SampleBatch()
+        if self.scan_info.sample_sink is not None:
+            self.scan_info.sample_sink(samples)
+            return
+        # the checkpoint is taken now but written after the samples it covers
+        state = checkpoint_state(self.scan_info)
+        future = self.loop.run_in_executor(self.storage_executor, commit_samples, samples, state,
+                                           self.scan_info.result_format)
+        for write in self.pending_writes:
+            if write.done():
+                write.result()  # raises if a write failed, stopping the scan
+        self.pending_writes = [write for write in self.pending_writes if not write.done()]
+        self.pending_writes.append(future)
+
+    async def progress(self):
+        scan_info = self.scan_info
+        scan_info.scan_start_ns = time.monotonic_ns()
+        while True:
+            # let user know testing is underway
+            print(scan_progress(scan_info) if scan_info.scan_space is not None else '.')
+            publish_progress(scan_info)
+            await asyncio.sleep(5.0)
+
+    async def run(self):
+        scan_info = self.scan_info
+        self.loop = asyncio.get_running_loop()
+        self.ready_queue = asyncio.Queue()
+        GPIO.setup(MAG_READY_PIN, GPIO.IN)  # MAG3110 ready interrupt
+        GPIO.add_event_detect(MAG_READY_PIN, GPIO.RISING, callback=self.on_data_ready)
+        progress = asyncio.ensure_future(self.progress())
+        event_log = open_event_log(scan_info)
+        open_spectral(scan_info)
+        open_retest(scan_info)
+        try:
+            while scan_info.run_next_test_cycle:
+                await self.burst()
+                if not scan_info.pipeline:
+                    await self.pause()
+                update_parameters(scan_info)
+                # save samples to disk after 1000 cycles
+                if (scan_info.cycle_count % 1000 == 0) or (not scan_info.run_next_test_cycle):
+                    self.save()
+                if scan_info.pipeline and scan_info.run_next_test_cycle:
+                    # stage the next point on the i2c thread while the pause runs
+                    await asyncio.gather(self.i2c(prepare_burst, scan_info), self.pause())
+            await asyncio.gather(*self.pending_writes)
+        finally:
+            progress.cancel()
+            GPIO.remove_event_detect(MAG_READY_PIN)
+            await self.i2c(turn_off_field, scan_info)
+            self.i2c_executor.shutdown()
+            self.storage_executor.shutdown()
+            close_retest(scan_info)
+            close_spectral(scan_info)
+            close_event_log(scan_info, event_log)
+
+
+def run_async_test_sequence(resume_state=None, scan_info=None):
+    print("Starting async test sequence")
+    print("Press ^C to abort\n")
+    if scan_info is None:
+        scan_info = make_scan_info()
+    if resume_state is not None and not resume_scan(scan_info, resume_state):
+        return
+    engine = AsyncScanEngine(scan_info)
+    try:
+        asyncio.run(engine.run())
+    except KeyboardInterrupt:
+        # engine.run has turned the field off and finished pending writes
+        save_interrupted_samples(scan_info)
+        print('Interrupted, run with --resume to continue at point %d' % scan_info.scan_index)
+    turn_off_magnets()
+    print_device_summary(scan_info)
+    print("End")
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    run_async_test_sequence(*make_run(args))
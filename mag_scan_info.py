@@ -6,6 +6,9 @@
 # Author: Peter Sichel 9-Sep-2020
 #
 
+import threading
+
+from mag_scheduler import LatenessStats
 
 class ScanInfo(object):
     """This object allows us to pass all needed state between asynchronous
@@ -21,6 +24,8 @@ class ScanInfo(object):
         self.mag_sensor = None
         self.phase_shifter1 = None
         self.phase_shifter2 = None
+        self.sensor_array = None      # optional MagneticSensorArray read along with mag_sensor
+        self.scheduler = None         # DeadlineScheduler running the timed scan steps
 
         # properties representing current test state
         self.frequency_start = 10000  # scan range start (Hz)
@@ -37,10 +42,82 @@ class ScanInfo(object):
         self.cycle_count = 0          # number of test cycles so far
         self.cycle_last_interval = 0  # Remember start of cycle interval
         self.cycle_pause = 0.9        # seconds before starting next cycle
-        self.mag_samples = []         # frequency and magnetic field readings
+        self.mag_samples = []         # frequency and magnetic field readings, MagSample objects or a SampleBatch
+                                      # (see mag_columnar.py)
         self.do_read_sensor = False   # read magnetic sensor
         self.run_next_test_cycle = True
 
+        # declarative scan (see scan_space.py) used by test_update_parameters_space
+        self.scan_space = None        # ScanSpace of points to measure
+        self.scan_index = 0           # index of the current point in scan_space
+        self.scan_start_index = 0     # first point measured in this run
+        self.scan_start_ns = 0        # when this run started, for the ETA
+        self.scan_stop_index = None   # stop before this point instead of the end of scan_space
+        self.sample_sink = None       # if set, save_samples passes samples here instead of writing mag_profile.csv
+        self.writer = None            # SampleWriter while run_scan is running, save_samples hands samples to it
+        self.result_format = 'csv'    # 'csv' for mag_profile.csv, 'columnar' for mag_profile.col (see mag_columnar.py)
+                                      # or 'chunked' for mag_profile.chk (see mag_chunked.py)
+        self.optimize_order = False   # reorder scan_space to reduce register writes (see scan_order.py)
+
+        # adaptive dwell: end a burst early once the sequential test is decided
+        self.adaptive_dwell = False
+        self.dwell_min = 0.1          # shortest burst in adaptive mode (seconds)
+        self.dwell_max = 1.0          # longest burst in adaptive mode (seconds)
+        self.adaptive_effect = 4.0    # smallest field change worth detecting (sensor counts)
+        self.adaptive_alpha = 0.001   # chance of calling a null point anomalous
+        self.adaptive_beta = 0.01     # chance of missing an anomalous point
+        self.baseline_settle = 0.05   # wait after a burst before readings count as baseline
+        self.baseline = None          # BaselineTracker, magnets-off field
+        self.burst_test = None        # SequentialTest for the burst in progress
+        self.burst_active = False
+        self.burst_timer = None       # pending end_burst ScheduledEvent
+        self.baseline_after_ns = 0
+        self.burst_lock = threading.Lock()
+        self.spectral_analysis = False  # spectrum of each adaptive burst's readings (see mag_spectral.py)
+        self.spectral = None          # SampleWriter computing the spectra while run_scan is running
+        self.burst_series = None      # BurstSeries of the burst in progress
+
+        # pipelining: stage the next point's registers during the pause
+        self.pipeline = True
+        self.stage_delay = 0.05       # after a burst, wait for its last reading before staging (seconds)
+        self.burst_staged = False     # prepare_burst has run for the current point
+        self.pause_end_ns = 0         # when the pause after the last burst ends
+        self.start_delay = LatenessStats()  # pause end to field on
+
+        # adaptive pause: end the pause once the field has decayed back to the baseline
+        self.adaptive_pause = False
+        self.pause_min = 0.1          # shortest pause in adaptive mode, cycle_pause is the longest (seconds)
+        self.pause_tolerance = 3.0    # settled when within this many baseline standard deviations
+        self.pause_settle_count = 3   # consecutive settled readings needed
+        self.pause_monitor = None     # DecayMonitor for the pause in progress
+        self.pause_timeouts = 0       # pauses that ran to cycle_pause without settling
+        self.pause_timer = None       # pending ScheduledEvent that ends the pause
+        self.pause_used = 0.0         # pause before the current burst (seconds)
+
+        # die temperature drift compensation fitted from magnets-off readings
+        self.drift_compensation = False
+        self.drift_model = None       # TemperatureDriftModel
+        self.die_temperature = 0      # latest MAG3110 die temperature (C)
+
+        # online anomaly detection on every valid reading (see mag_detect.py)
+        self.detector = None          # OnlineDetector, None to turn detection off
+
+        # measure anomalous points again with magnets-off controls before moving on (see mag_retest.py)
+        self.retest_anomalies = False
+        self.retest = None            # RetestQueue while run_scan is running
+        self.retest_state = None      # RetestQueue.state() from the checkpoint resumed from
+        self.control_burst = False    # leave the outputs disabled for this burst, a magnets-off control
+
+        # live telemetry for viewer processes (see mag_telemetry.py)
+        self.telemetry = None         # TelemetryPublisher, None to print from the scan threads instead
+
+        # event timestamps, time.monotonic_ns() taken as close to the event as possible
+        self.burst_request_ns = 0     # prepare_burst started configuring the clocks
+        self.burst_start_ns = 0       # clocks configured and outputs enabled, field on
+        self.burst_end_ns = 0         # outputs disabled, field off
+        self.ready_ns = 0             # latest MAG3110 data ready edge
+        self.read_ns = 0              # latest adaptive burst reading completed
+
         self.f0 = 0  # Clk0 frequency
         self.f1 = 0  # Clk1 frequency
         self.f2 = 0  # Clk2 frequency
@@ -48,13 +125,46 @@ class ScanInfo(object):
 
 class MagSample(object):
     """Magnetic field strenth readling along x, y, and z axis with corresponding frequency information"""
+    # no per instance __dict__, samples are created for every reading of multi-day scans
+    __slots__ = ('f0', 'f1', 'f2', 'clock1_phase_offset', 'clock2_phase_offset', 'duration', 'pause', 'decision',
+                 'temperature', 'sensor', 'valid', 'point', 'burst_start_ns', 'burst_end_ns', 'ready_ns', 'read_ns',
+                 'x', 'y', 'z')
+
     def __init__(self, x, y, z):
         self.f0 = 0
         self.f1 = 0
         self.f2 = 0
+        self.clock1_phase_offset = 0  # degrees
+        self.clock2_phase_offset = 0
         self.duration = 0
-        self.base_frequency = 0
-        self.call_method_after_delay = 0
+        self.pause = 0.0      # pause between the previous burst and this one (seconds)
+        self.decision = None  # adaptive dwell outcome: None, 'null' or 'anomaly'
+        self.temperature = 0  # MAG3110 die temperature (C)
+        self.sensor = ''      # sensor array position name, empty for the main sensor
+        self.valid = True     # False if the sensor could not be read (x, y, z are None)
+        self.point = 0        # scan_index of the point this sample belongs to
+        # time.monotonic_ns() timestamps
+        self.burst_start_ns = 0  # field turned on
+        self.burst_end_ns = 0    # field turned off
+        self.ready_ns = 0        # data ready edge that triggered the read, 0 if none
+        self.read_ns = 0         # sensor read completed
         self.x = x
         self.y = y
         self.z = z
+
+
+CSV_HEADER = ('freq_x,freq_y,freq_z,clock1_phase,clock2_phase,mag_x,mag_y,mag_z,duration,pause,decision,temperature,'
+              'sensor,burst_start_ns,burst_end_ns,ready_ns,read_ns,point')
+
+
+def csv_row(sample):
+    """One mag_profile.csv line (without the newline) for a MagSample"""
+    if sample.valid:
+        field = '%d,%d,%d' % (sample.x, sample.y, sample.z)
+    else:
+        field = ',,'  # sensor read failed, leave the field empty
+    return '%d,%d,%d,%d,%d,%s,%.3f,%.3f,%s,%d,%s,%d,%d,%d,%d,%d' % (
+        sample.f0, sample.f1, sample.f2,
+        sample.clock1_phase_offset, sample.clock2_phase_offset, field,
+        sample.duration, sample.pause, sample.decision or '', sample.temperature, sample.sensor,
+        sample.burst_start_ns, sample.burst_end_ns, sample.ready_ns, sample.read_ns, sample.point)
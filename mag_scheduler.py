@@ -0,0 +1,162 @@
+#!/usr/bin/python
+#
+# Summary:
+# Single thread deadline scheduler for the scan state machine.
+# Replaces a chain of threading.Timer objects (one new OS thread per step)
+# with one thread that keeps a heap of absolute time.monotonic_ns() deadlines.
+# The thread sleeps until shortly before the next deadline, then spins for
+# the final stretch so events fire with sub-millisecond accuracy.
+# How late each event actually fired is recorded per method.
+# An exception from an event stops the scheduler: each step schedules the
+# next, so the chain has ended.  The exception is kept in error and raised
+# again by check(), for the thread that started the scheduler.
+#
+# MIT Open Source License
+# https://opensource.org/licenses/MIT
+#
+
+import heapq
+import itertools
+import threading
+import time
+
+
+class ScheduledEvent(object):
+    """A method call waiting for its deadline"""
+    def __init__(self, deadline_ns, method, params):
+        self.deadline_ns = deadline_ns
+        self.method = method
+        self.params = params
+        self.cancelled = False
+        self.fired_ns = 0   # when the call actually started, 0 until fired
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class LatenessStats(object):
+    """How late events for one method fired (nanoseconds)"""
+    def __init__(self):
+        self.count = 0
+        self.total_ns = 0
+        self.max_ns = 0
+
+    def add(self, late_ns):
+        self.count += 1
+        self.total_ns += late_ns
+        self.max_ns = max(self.max_ns, late_ns)
+
+    def mean_ns(self):
+        return self.total_ns / self.count if self.count else 0
+
+
+class DeadlineScheduler(object):
+    """Run method(*params) at absolute monotonic deadlines from one thread.
+    Methods run on the scheduler thread and should return promptly.
+    The first method to raise stops the scheduler.
+    """
+    def __init__(self, spin_ns=2000000, clock=time.monotonic_ns):
+        self.spin_ns = spin_ns  # busy wait this long before each deadline
+        self.clock = clock
+        self.heap = []
+        self.counter = itertools.count()  # keeps equal deadlines in call order
+        self.condition = threading.Condition()
+        self.running = False
+        self.thread = None
+        self.lateness = {}      # method name -> LatenessStats
+        self.error = None       # exception that stopped the scheduler
+
+    def start(self):
+        self.running = True
+        self.error = None
+        self.thread = threading.Thread(target=self.run, name='DeadlineScheduler')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+
+    def check(self):
+        """Raise the exception that stopped the scheduler, if any"""
+        if self.error is not None:
+            raise self.error
+
+    def call_at(self, deadline_ns, method, params=None):
+        """Schedule method(*params) at the absolute time deadline_ns"""
+        event = ScheduledEvent(deadline_ns, method, params or [])
+        with self.condition:
+            heapq.heappush(self.heap, (deadline_ns, next(self.counter), event))
+            # wake the scheduler in case this is now the earliest deadline
+            self.condition.notify()
+        return event
+
+    def cancel(self, event):
+        """Cancel event, returns False if it has already fired"""
+        with self.condition:
+            if event.fired_ns:
+                return False
+            event.cancelled = True
+            return True
+
+    def call_after(self, seconds, method, params=None):
+        """Schedule method(*params) seconds from now"""
+        return self.call_at(self.clock() + int(seconds * 1e9), method, params)
+
+    def next_event(self):
+        # Wait until the earliest deadline is within spin_ns and return its event,
+        # or None once stopped.
+        with self.condition:
+            while self.running:
+                if not self.heap:
+                    self.condition.wait()
+                    continue
+                deadline_ns, _seq, event = self.heap[0]
+                if event.cancelled:
+                    heapq.heappop(self.heap)
+                    continue
+                remaining = deadline_ns - self.clock()
+                if remaining > self.spin_ns:
+                    # coarse sleep, woken early if an earlier event is added
+                    self.condition.wait((remaining - self.spin_ns) / 1e9)
+                    continue
+                return event
+        return None
+
+    def run(self):
+        while True:
+            event = self.next_event()
+            if event is None:
+                return
+            # spin for the final stretch without holding the lock
+            while self.clock() < event.deadline_ns:
+                pass
+            with self.condition:
+                # an earlier event may have been added while spinning
+                if not self.heap or self.heap[0][2] is not event:
+                    continue
+                heapq.heappop(self.heap)
+                if event.cancelled:
+                    continue
+                # from here on cancel() reports the event as fired
+                event.fired_ns = self.clock()
+            name = getattr(event.method, '__name__', str(event.method))
+            self.lateness.setdefault(name, LatenessStats()).add(event.fired_ns - event.deadline_ns)
+            try:
+                event.method(*event.params)
+            except Exception as error:
+                # the steps after this one will never be scheduled
+                with self.condition:
+                    self.error = error
+                    self.running = False
+                return
+
+    def lateness_summary(self):
+        lines = []
+        for name, stats in sorted(self.lateness.items()):
+            lines.append('%s: %d calls, late mean %.1f us, max %.1f us' % (
+                name, stats.count, stats.mean_ns() / 1e3, stats.max_ns / 1e3))
+        return '\n'.join(lines)
@@ -17,6 +17,29 @@ import RPi.GPIO as GPIO
 GPIO.setwarnings(False)
 READY_PIN = 5
 
+# MAG3110 registers
+MAG3110_DR_STATUS = 0x00	# data ready status
+MAG3110_OUT_X_MSB = 0x01	# X, Y, Z output 0x01..0x06
+MAG3110_DIE_TEMP  = 0x0F	# die temperature, signed 8-bit, 1 degree C per count
+MAG3110_BLOCK_LEN = MAG3110_DIE_TEMP - MAG3110_DR_STATUS + 1
+
+# one lock per I2C bus, held for each transaction (and multiplexer switch) so
+# scan reads and background recovery never interleave on the bus
+busLocks = {}
+busLocksLock = threading.Lock()
+
+def busLock(busnum):
+	if busnum < 0 and hasattr(Adafruit_I2C, 'getPiI2CBusNumber'):
+		busnum = Adafruit_I2C.getPiI2CBusNumber()	# the default bus is shared with explicit users of it
+	with busLocksLock:
+		return busLocks.setdefault(busnum, threading.RLock())
+
+def toSigned16(msb, lsb):
+	value = msb * 256 + lsb
+	if value > 32767 :
+		value -= 65536
+	return value
+
 class MagneticSensor:
 
 	def event_callback(self, pin):
@@ -25,51 +48,156 @@ class MagneticSensor:
 			self.readMagneticField()
 			#self.doReadSensor = False
 
-	def __init__(self, readyPin=5, address=0x0E, busnum=-1):
+	def __init__(self, readyPin=5, address=0x0E, busnum=-1, retries=2, retryDelay=0.0002, mux=None, channel=None):
 		self.readyPin = readyPin
 		self.address = address
+		self.busnum = busnum
+		self.lock = busLock(busnum)
+		# behind a multiplexer the sensor is only reachable with its channel selected,
+		# see mag_sensor_array.py
+		self.mux = mux
+		self.channel = channel
 		self.i2c = Adafruit_I2C(address=address, busnum=busnum)
 		self.doReadSensor = True
-			# MAG3110 config
+		# Error handling: a failed read is retried quickly a few times, after
+		# that the read returns None and the device is recovered in the
+		# background.  Reads return None immediately while recovering so the
+		# caller is never blocked by a misbehaving bus.
+		self.retries = retries
+		self.retryDelay = retryDelay
+		self.recovering = False
+		self.recoveryDelay = 0.01	# first recovery attempt, doubles up to recoveryDelayMax
+		self.recoveryDelayMax = 5.0
+		# per device error accounting
+		self.readCount = 0		# read requests
+		self.errorCount = 0		# failed bus transactions
+		self.retryCount = 0		# transactions retried
+		self.invalidCount = 0	# reads returned as invalid (None)
+		self.recoveryCount = 0	# completed recoveries
+		with self.lock:
+			self.connect()
+			try:
+				self.configure()
+			finally:
+				self.disconnect()
+		# setup to read when MAG3110 is ready.
+        #GPIO.add_event_detect(self.readyPin, GPIO.RISING, callback=self.event_callback)
+		# GPIO.remove_event_detect(READY_PIN)
+
+	def connect(self):
+		# route the bus to this sensor, the caller holds self.lock
+		if self.mux is None:
+			return
+		if self.channel is None:
+			self.mux.disable()
+		else:
+			self.mux.select(self.channel)
+
+	def disconnect(self):
+		# leave the bus to the sensors wired to it directly
+		if self.mux is not None:
+			self.mux.disable()
+
+	def configure(self):
+		# MAG3110 config
 		# CTRL_REG1 (0x10)  Value: 01
 		#	Data rate 80 Hz, Over sampling rate 16, Active mode
 		# CTRL_REG2 (0x11)  Value: 80
 		#	Automatic Magnetic Sensor Reset enabled
 		self.i2c.write8(0x10, 0x01)
 		self.i2c.write8(0x11, 0x80)
-		# setup to read when MAG3110 is ready.
-        #GPIO.add_event_detect(self.readyPin, GPIO.RISING, callback=self.event_callback)
-		# GPIO.remove_event_detect(READY_PIN)
 
-	def __del__(self):
-		##GPIO.remove_event_detect(READY_PIN)
+	def standby(self):
 		# MAG3110 CTRL_REG1 (0x10)  Value: 00
 		#	Standby mode
-		self.i2c.write8(0x10, 0x00)
+		# routed like any other transaction, so behind a multiplexer it reaches this sensor
+		with self.lock:
+			self.connect()
+			try:
+				self.i2c.write8(0x10, 0x00)
+			finally:
+				self.disconnect()
+
+	def __del__(self):
+		##GPIO.remove_event_detect(READY_PIN)
+		self.standby()
+
+	def readList(self, register, length):
+		# Read a block of registers with bounded fast retries.
+		# Adafruit_I2C reports bus errors by returning -1 rather than raising.
+		# Returns the list of bytes, or None if the read failed.
+		self.readCount += 1
+		if self.recovering:
+			self.invalidCount += 1
+			return None
+		with self.lock:
+			for attempt in range(self.retries + 1):
+				if attempt > 0:
+					self.retryCount += 1
+					time.sleep(self.retryDelay)
+				try:
+					data = self.i2c.readList(register, length)
+				except Exception:
+					data = None
+				if isinstance(data, list) and len(data) == length:
+					return data
+				self.errorCount += 1
+		self.invalidCount += 1
+		self.startRecovery()
+		return None
+
+	def startRecovery(self):
+		# may run on the GPIO callback thread, so no print: the recovering flag and
+		# recoveryCount are reported by errorSummary and the scan's telemetry
+		if self.recovering:
+			return
+		self.recovering = True
+		thread = threading.Thread(target=self.recover)
+		thread.daemon = True
+		thread.start()
+
+	def recover(self):
+		# Reopen the bus and reconfigure the sensor until a read succeeds.
+		delay = self.recoveryDelay
+		while True:
+			time.sleep(delay)
+			with self.lock:
+				try:
+					self.connect()
+					i2c = Adafruit_I2C(address=self.address, busnum=self.busnum)
+					self.i2c = i2c
+					self.configure()
+					data = i2c.readList(MAG3110_OUT_X_MSB, 6)
+					if isinstance(data, list) and len(data) == 6:
+						break
+				except Exception:
+					pass
+				finally:
+					try:
+						self.disconnect()
+					except Exception:
+						pass
+			delay = min(2 * delay, self.recoveryDelayMax)
+		self.recoveryCount += 1
+		self.recovering = False
+
+	def errorSummary(self):
+		return "device 0x%02X reads:%d errors:%d retries:%d invalid:%d recoveries:%d%s" % (
+			self.address, self.readCount, self.errorCount, self.retryCount,
+			self.invalidCount, self.recoveryCount, " (recovering)" if self.recovering else "")
 
 	def readMagneticField(self):
 		# Read data back from 0x01(1), 6 bytes
 		# X-Axis MSB, X-Axis LSB, Y-Axis MSB, Y-Axis LSB, Z-Axis MSB, Z-Axis LSB
-		try:
-			data = self.i2c.readList(0x01, 6)
-
-			# Convert the data
-			xMag = data[0] * 256 + data[1]
-			if xMag > 32767 :
-				xMag -= 65536
-
-			yMag = data[2] * 256 + data[3]
-			if yMag > 32767 :
-				yMag -= 65536
-
-			zMag = data[4] * 256 + data[5]
-			if zMag > 32767 :
-				zMag -= 65536
-		except:
-			print("Failed to read from device")
-			xMag = 0
-			yMag = 0
-			zMag = 0
+		# Returns None if the sensor could not be read.
+		data = self.readList(MAG3110_OUT_X_MSB, 6)
+		if data is None:
+			return None
+
+		# Convert the data
+		xMag = toSigned16(data[0], data[1])
+		yMag = toSigned16(data[2], data[3])
+		zMag = toSigned16(data[4], data[5])
 
 		# Return field strength reading
 		return (xMag, yMag, zMag)
@@ -78,6 +206,24 @@ class MagneticSensor:
 		# print ("Magnetic field in Y-Axis : %d" %yMag)
 		# print ("Magnetic field in Z-Axis : %d" %zMag)
 
+	def readBlock(self):
+		# Read DR_STATUS, X, Y, Z and DIE_TEMP in one auto-increment transaction.
+		# The register pointer steps 0x00..0x0F, so WHO_AM_I, SYSMOD and the
+		# user offset registers come along and are ignored.
+		# Returns (status, x, y, z, temperature), or None if the sensor could not be read.
+		data = self.readList(MAG3110_DR_STATUS, MAG3110_BLOCK_LEN)
+		if data is None:
+			return None
+		status = data[0]
+		xMag = toSigned16(data[1], data[2])
+		yMag = toSigned16(data[3], data[4])
+		zMag = toSigned16(data[5], data[6])
+		temperature = data[15]
+		if temperature > 127 :
+			temperature -= 256
+
+		return (status, xMag, yMag, zMag, temperature)
+
 if __name__ == '__main__':
 		# Pin Setup:
 	GPIO.setmode(GPIO.BCM)   # Broadcom pin-numbering scheme.
@@ -0,0 +1,134 @@
+#!/usr/bin/python
+#
+# Summary:
+# Array of MAG3110 magnetic field sensors used to map the field at several
+# positions during a single burst.
+# The MAG3110 I2C address is fixed (0x0E) so each sensor sits either on its
+# own I2C bus or behind a TCA9548A style I2C multiplexer channel.
+# Buses are read concurrently (one worker per bus).  On a multiplexed bus the
+# sensors wired directly to the bus are read first, then the multiplexed ones
+# in channel order.  Every multiplexer channel is disabled again before a
+# direct sensor is read and after each read of the bus, so a direct sensor
+# (including the scan's own MAG3110) never answers alongside a multiplexed one
+# at the same address.  A bus is held (mag_sensor.busLock) for the whole pass
+# over its sensors, so a sensor recovering in the background, which selects
+# its own channel, never switches the multiplexer in the middle of a read.
+#
+# TCA9548A Datasheet
+# https://www.ti.com/lit/ds/symlink/tca9548a.pdf
+#
+# MIT Open Source License
+# https://opensource.org/licenses/MIT
+#
+
+from concurrent.futures import ThreadPoolExecutor
+import time
+
+from Adafruit_I2C import Adafruit_I2C
+from mag_sensor import MagneticSensor, busLock
+
+TCA9548A_I2C_ADDRESS_DEFAULT = 0x70
+
+
+class I2CMultiplexer(object):
+    """TCA9548A 1-to-8 I2C multiplexer.
+    Remembers the selected channel so redundant switches cost no bus traffic.
+    """
+    def __init__(self, address=TCA9548A_I2C_ADDRESS_DEFAULT, busnum=-1):
+        self.i2c = Adafruit_I2C(address=address, busnum=busnum)
+        self.address = address
+        self.channel = None
+        self.switch_count = 0
+
+    def select(self, channel):
+        if channel == self.channel:
+            return
+        # control register has one enable bit per channel
+        self.i2c.writeRaw8(1 << channel)
+        self.channel = channel
+        self.switch_count += 1
+
+    def disable(self):
+        # no channel connected, only devices wired directly to the bus answer
+        if self.channel is None:
+            return
+        self.i2c.writeRaw8(0)
+        self.channel = None
+        self.switch_count += 1
+
+
+class SensorPosition(object):
+    """Where a sensor is mounted and how to reach it"""
+    def __init__(self, name, busnum=-1, channel=None, position=(0.0, 0.0, 0.0)):
+        self.name = name
+        self.busnum = busnum      # I2C bus, -1 for the default bus
+        self.channel = channel    # multiplexer channel 0..7, None if not multiplexed
+        self.position = position  # sensor location (x, y, z) relative to the coils
+
+
+class SensorReading(object):
+    """Field reading from one sensor of the array"""
+    def __init__(self, sensor, field, timestamp_ns):
+        self.name = sensor.name
+        self.position = sensor.position
+        self.field = field  # (x, y, z), or None if the sensor could not be read
+        self.timestamp_ns = timestamp_ns  # time.monotonic_ns() when the read completed
+
+
+class SensorBus(object):
+    """Sensors on one I2C bus, optionally behind a multiplexer"""
+    def __init__(self, busnum, positions, mux_address=TCA9548A_I2C_ADDRESS_DEFAULT):
+        self.busnum = busnum
+        self.lock = busLock(busnum)
+        self.mux = None
+        if any(position.channel is not None for position in positions):
+            self.mux = I2CMultiplexer(address=mux_address, busnum=busnum)
+        # read order with the fewest channel switches
+        self.positions = sorted(positions, key=lambda position: -1 if position.channel is None else position.channel)
+        self.sensors = []
+        for position in self.positions:
+            self.sensors.append(MagneticSensor(busnum=busnum, mux=self.mux, channel=position.channel))
+
+    def read(self):
+        readings = []
+        with self.lock:
+            try:
+                for position, sensor in zip(self.positions, self.sensors):
+                    sensor.connect()
+                    field = sensor.readMagneticField()
+                    readings.append(SensorReading(position, field, time.monotonic_ns()))
+            finally:
+                # leave the bus to the sensors wired to it directly
+                if self.mux is not None:
+                    self.mux.disable()
+        return readings
+
+
+class MagneticSensorArray(object):
+    """Read every sensor in the array, buses in parallel"""
+    def __init__(self, positions, mux_address=TCA9548A_I2C_ADDRESS_DEFAULT):
+        by_bus = {}
+        for position in positions:
+            by_bus.setdefault(position.busnum, []).append(position)
+        self.buses = [SensorBus(busnum, bus_positions, mux_address) for busnum, bus_positions in sorted(by_bus.items())]
+        self.executor = ThreadPoolExecutor(max_workers=len(self.buses))
+
+    def readAll(self):
+        """Returns a list of SensorReading, one per sensor"""
+        if len(self.buses) == 1:
+            return self.buses[0].read()
+        futures = [self.executor.submit(bus.read) for bus in self.buses]
+        readings = []
+        for future in futures:
+            readings.extend(future.result())
+        return readings
+
+    def switchCount(self):
+        return sum(bus.mux.switch_count for bus in self.buses if bus.mux is not None)
+
+    def close(self):
+        # no reads in flight, then every sensor to standby while the buses are still open
+        self.executor.shutdown(wait=True)
+        for bus in self.buses:
+            for sensor in bus.sensors:
+                sensor.standby()
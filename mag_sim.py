@@ -0,0 +1,671 @@
+#!/usr/bin/python
+#
+# Summary:
+# Run mag_scan without the rig.
+# Fake RPi.GPIO, Adafruit_I2C and smbus modules are installed in sys.modules
+# before mag_scan is imported.  They talk to simulated Si5351, MCP23017 phase
+# shifter, TCA9548A and MAG3110 devices.  The MAG3110 produces readings at its
+# 80 Hz data rate from a synthetic field model: earth field, die temperature
+# drift, noise, coil drive that decays when switched off, and anomalies
+# injected at chosen frequencies and phases.
+#
+# Time is virtual.  The scan's DeadlineScheduler is replaced by a
+# VirtualScheduler that runs every event (scan steps and sensor data ready
+# edges) on the calling thread in deadline order, jumping the clock straight
+# to the next deadline, and time.sleep in the scan modules advances the
+# virtual clock instead of waiting.  A 10 hour scan runs in seconds, and the
+# run is deterministic for a given --seed.
+#
+# Usage:
+#   python mag_sim.py --hours 10 --dir /tmp/sim          # new scan, stopped like ^C after 10 hours
+#   python mag_sim.py --hours 10 --dir /tmp/sim --resume # continue from its checkpoint
+#   python mag_sim.py --hours 1 --dir /tmp/sim --engine async
+#
+# The threaded engine in mag_scan.py runs by default.  With --engine async,
+# mag_scan_async.py runs on an asyncio loop whose clock is the virtual
+# clock: where the loop would wait, its selector runs the simulation up to
+# the next event instead, and the engine's executors run their work at once
+# on the loop thread.
+#
+# MIT Open Source License
+# https://opensource.org/licenses/MIT
+#
+
+import argparse
+import asyncio
+import concurrent.futures
+import heapq
+import math
+import os
+import random
+import selectors
+import sys
+import threading
+import time
+import types
+
+from mag_scheduler import DeadlineScheduler, LatenessStats
+
+MAG3110_ADDRESS = 0x0E
+MAG3110_READY_PIN = 5
+MAG3110_PERIOD_NS = 12500000   # 80 Hz data rate
+TCA9548A_ADDRESS = 0x70
+SI5351_ADDRESS = 0x60
+SI5351_CRYSTAL = 25000000
+SIM_START_NS = 1000000000000   # virtual monotonic clock at start (non zero, like a real uptime)
+
+
+# = Virtual time
+class VirtualClock(object):
+    """Monotonic nanosecond clock that only moves when told to"""
+    def __init__(self, start_ns=SIM_START_NS):
+        self.now_ns = start_ns
+        self.condition = threading.Condition()
+
+    def monotonic_ns(self):
+        return self.now_ns
+
+    def advance_to(self, deadline_ns):
+        if deadline_ns > self.now_ns:
+            with self.condition:
+                self.now_ns = deadline_ns
+                self.condition.notify_all()
+
+    def wait_until(self, deadline_ns):
+        # for threads other than the one driving the simulation
+        with self.condition:
+            while self.now_ns < deadline_ns:
+                self.condition.wait(0.1)
+
+
+class VirtualScheduler(DeadlineScheduler):
+    """DeadlineScheduler on the virtual clock.
+    No thread: events run from run_until, which the virtual time.sleep calls.
+    """
+    def __init__(self, clock):
+        DeadlineScheduler.__init__(self, spin_ns=0, clock=clock.monotonic_ns)
+        self.virtual_clock = clock
+        self.dispatching = False
+        self.event_count = 0
+
+    def start(self):
+        self.running = True
+        self.error = None
+
+    def stop(self):
+        self.running = False
+
+    def run_until(self, deadline_ns):
+        """Run every event due up to deadline_ns, leaving the clock at deadline_ns"""
+        heap = self.heap
+        while heap and heap[0][0] <= deadline_ns:
+            event_deadline_ns, _seq, event = heapq.heappop(heap)
+            if event.cancelled:
+                continue
+            # an event may be overdue if the previous one slept
+            self.virtual_clock.advance_to(event_deadline_ns)
+            event.fired_ns = self.clock()
+            name = getattr(event.method, '__name__', str(event.method))
+            if name != 'conversion':
+                self.lateness.setdefault(name, LatenessStats()).add(event.fired_ns - event.deadline_ns)
+            self.event_count += 1
+            self.dispatching = True
+            try:
+                event.method(*event.params)
+            except Exception as error:
+                # as DeadlineScheduler, kept for check(); device events keep running
+                if self.error is None:
+                    self.error = error
+                self.running = False
+            finally:
+                self.dispatching = False
+        self.virtual_clock.advance_to(deadline_ns)
+
+
+class VirtualTime(object):
+    """Stands in for the time module inside the scan modules"""
+    def __init__(self, clock, scheduler, driver_thread):
+        self.clock = clock
+        self.scheduler = scheduler
+        self.driver_thread = driver_thread
+        self.wall_start = time.time()
+        self.stop_at_ns = None     # raise KeyboardInterrupt from the driver's sleep after this time
+
+    def monotonic_ns(self):
+        return self.clock.monotonic_ns()
+
+    def monotonic(self):
+        return self.clock.monotonic_ns() / 1e9
+
+    def time(self):
+        return self.wall_start + (self.clock.monotonic_ns() - SIM_START_NS) / 1e9
+
+    def perf_counter(self):
+        return self.monotonic()
+
+    def sleep(self, seconds):
+        deadline_ns = self.clock.monotonic_ns() + int(seconds * 1e9)
+        if threading.current_thread() is not self.driver_thread:
+            self.clock.wait_until(deadline_ns)
+        elif self.scheduler.dispatching:
+            # busy wait inside a scan step, e.g. letting the phase shifter count off
+            self.clock.advance_to(deadline_ns)
+        else:
+            if self.stop_at_ns is not None:
+                deadline_ns = min(deadline_ns, max(self.stop_at_ns, self.clock.monotonic_ns()))
+            self.scheduler.run_until(deadline_ns)
+            if self.stop_at_ns is not None and self.clock.monotonic_ns() >= self.stop_at_ns:
+                self.stop_at_ns = None
+                raise KeyboardInterrupt
+
+
+class SynchronousExecutor(concurrent.futures.Executor):
+    """Stands in for a ThreadPoolExecutor: runs each call at once on the calling thread,
+    as a scan step, so a sleep inside it only moves the virtual clock
+    """
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+
+    def submit(self, fn, *args, **kwargs):
+        future = concurrent.futures.Future()
+        self.scheduler.dispatching = True
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as error:
+            future.set_exception(error)
+        finally:
+            self.scheduler.dispatching = False
+        return future
+
+
+class VirtualSelector(object):
+    """Selector of the asyncio loop on virtual time.  Rather than wait, it runs
+    the simulation event by event until a callback is queued for the loop or
+    the timeout has passed on the virtual clock.
+    """
+    def __init__(self, clock, scheduler, virtual_time):
+        self.clock = clock
+        self.scheduler = scheduler
+        self.virtual_time = virtual_time
+        self.selector = selectors.DefaultSelector()
+
+    def __getattr__(self, name):
+        # register, unregister, get_map ... of the real selector (the loop's self-pipe)
+        return getattr(self.selector, name)
+
+    def select(self, timeout=None):
+        events = self.selector.select(0)
+        if events or (timeout is not None and timeout <= 0):
+            return events
+        # round up, a timeout under 1 ns must still move the clock on
+        deadline_ns = self.clock.monotonic_ns() + int(math.ceil(timeout * 1e9)) if timeout is not None else None
+        while True:
+            candidates = [deadline_ns] if deadline_ns is not None else []
+            if self.scheduler.heap:
+                candidates.append(self.scheduler.heap[0][0])
+            if not candidates:
+                return self.selector.select(timeout)    # nothing simulated left to run
+            next_ns = min(candidates)
+            stop_at_ns = self.virtual_time.stop_at_ns
+            if stop_at_ns is not None and next_ns >= stop_at_ns:
+                self.scheduler.run_until(stop_at_ns)
+                self.virtual_time.stop_at_ns = None
+                raise KeyboardInterrupt
+            self.scheduler.run_until(next_ns)
+            events = self.selector.select(0)
+            if events or (deadline_ns is not None and self.clock.monotonic_ns() >= deadline_ns):
+                return events
+
+
+class VirtualEventLoop(asyncio.SelectorEventLoop):
+    """asyncio loop on the virtual clock, for mag_scan_async"""
+    def __init__(self, sim):
+        asyncio.SelectorEventLoop.__init__(self, VirtualSelector(sim.clock, sim.scheduler, sim.virtual_time))
+        self.sim = sim
+
+    def time(self):
+        return self.sim.clock.monotonic_ns() / 1e9
+
+
+class VirtualEventLoopPolicy(asyncio.DefaultEventLoopPolicy):
+    """Makes asyncio.run use a VirtualEventLoop"""
+    def __init__(self, sim):
+        asyncio.DefaultEventLoopPolicy.__init__(self)
+        self.sim = sim
+
+    def new_event_loop(self):
+        return VirtualEventLoop(self.sim)
+
+
+# = Field model
+class Anomaly(object):
+    """Extra field when the x drive frequency, y drive frequency and phase are near a point"""
+    def __init__(self, base_frequency, offset_frequency, phase=None, width=20.0, amplitude=12.0,
+                 direction=(0.0, 0.0, 1.0)):
+        self.base_frequency = base_frequency
+        self.offset_frequency = offset_frequency
+        self.phase = phase            # counts of 240, None for any phase
+        self.width = width            # Hz, gaussian in both frequencies
+        self.amplitude = amplitude    # sensor counts
+        self.direction = direction
+
+    def response(self, fx, fy, phase):
+        distance2 = (fx - self.base_frequency) ** 2 + (fy - self.offset_frequency) ** 2
+        scale = self.amplitude * math.exp(-distance2 / (2.0 * self.width * self.width))
+        if self.phase is not None:
+            scale *= 0.5 * (1.0 + math.cos(math.radians((phase - self.phase) * 1.5)))
+        return [scale * d for d in self.direction]
+
+
+class FieldModel(object):
+    """Field at the sensor in MAG3110 counts"""
+    def __init__(self, rng, anomalies=(), earth=(-320.0, 140.0, 780.0), noise=1.5,
+                 temperature=30.0, temperature_swing=3.0, temperature_period=7200.0,
+                 drift=(0.8, -0.5, 1.2), coil_offset=(3.0, 2.0, 0.0), decay=0.03):
+        self.rng = rng
+        self.anomalies = list(anomalies)
+        self.earth = earth
+        self.noise = noise
+        self.temperature = temperature               # mean die temperature (C)
+        self.temperature_swing = temperature_swing
+        self.temperature_period = temperature_period  # seconds
+        self.drift = drift                # counts per degree C on each axis
+        self.coil_offset = coil_offset    # rectified coil pickup while driven
+        self.decay = decay                # seconds, field decay after the drive stops
+        self.driven = [0.0, 0.0, 0.0]     # drive contribution at last_change
+        self.driving = False
+        self.last_change_s = 0.0
+
+    def die_temperature(self, t):
+        return self.temperature + self.temperature_swing * math.sin(2.0 * math.pi * t / self.temperature_period)
+
+    def drive(self, fx, fy, phase):
+        field = list(self.coil_offset)
+        for anomaly in self.anomalies:
+            for axis, value in enumerate(anomaly.response(fx, fy, phase)):
+                field[axis] += value
+        return field
+
+    def field(self, t, drive):
+        """drive is (fx, fy, phase) while the coils are driven, else None.  Returns (x, y, z, T)"""
+        if drive is not None:
+            self.driven = self.drive(*drive)
+            self.driving = True
+            self.last_change_s = t
+            residual = self.driven
+        else:
+            if self.driving:
+                self.driving = False
+                self.last_change_s = t
+            residual = [value * math.exp(-(t - self.last_change_s) / self.decay) for value in self.driven]
+        temperature = self.die_temperature(t)
+        reading = []
+        for axis in range(3):
+            value = self.earth[axis] + self.drift[axis] * (temperature - self.temperature) + residual[axis]
+            reading.append(value + self.rng.gauss(0.0, self.noise))
+        return reading[0], reading[1], reading[2], temperature
+
+
+# = Devices
+class SimDevice(object):
+    """Register file, the Adafruit_I2C methods used by the drivers"""
+    def __init__(self, sim):
+        self.sim = sim
+        self.registers = {}
+
+    def write8(self, register, value):
+        self.registers[register] = value & 0xFF
+
+    def readU8(self, register):
+        return self.registers.get(register, 0)
+
+    def readList(self, register, length):
+        return [self.readU8(register + i) for i in range(length)]
+
+    def writeRaw8(self, value):
+        pass
+
+
+class SimSi5351(SimDevice):
+    """Decodes output frequencies from the PLL and Multisynth registers"""
+    def __init__(self, sim):
+        SimDevice.__init__(self, sim)
+        self.registers[3] = 0xFF   # outputs disabled
+        self.cache = None
+
+    def write8(self, register, value):
+        SimDevice.write8(self, register, value)
+        self.cache = None
+
+    def ratio(self, base):
+        # a + b / c from the P1, P2, P3 encoding shared by PLL and Multisynth registers
+        r = [self.registers.get(base + i, 0) for i in range(8)]
+        p1 = ((r[2] & 0x03) << 16) | (r[3] << 8) | r[4]
+        p2 = ((r[5] & 0x0F) << 16) | (r[6] << 8) | r[7]
+        p3 = ((r[5] >> 4) << 16) | (r[0] << 8) | r[1]
+        if p3 == 0:
+            return 0.0
+        return (p1 + 512 + float(p2) / p3) / 128.0
+
+    def outputs(self):
+        """Frequency of each enabled output, 0 when disabled"""
+        if self.cache is None:
+            frequencies = []
+            for clock in range(3):
+                control = self.registers.get(16 + clock, 0x80)
+                enabled = not (self.registers.get(3, 0xFF) >> clock) & 1 and not control & 0x80
+                pll_base = 34 if control & (1 << 5) else 26
+                ms_base = 42 + 8 * clock
+                vco = SI5351_CRYSTAL * self.ratio(pll_base)
+                divider = self.ratio(ms_base) * (2 ** ((self.registers.get(ms_base + 2, 0) >> 4) & 0x07))
+                frequencies.append(vco / divider if enabled and divider else 0.0)
+            self.cache = frequencies
+        return self.cache
+
+
+class SimPhaseShifter(SimDevice):
+    """MCP23017 driving the phase shifter counters"""
+    def enabled(self):
+        # clock_disable sets turn on 255, turn off 1
+        return not (self.registers.get(0x12, 0) == 255 and self.registers.get(0x13, 0) == 1)
+
+    def phase(self):
+        return self.registers.get(0x12, 0)
+
+
+class SimMultiplexer(SimDevice):
+    def __init__(self, sim):
+        SimDevice.__init__(self, sim)
+        self.channel = None
+
+    def writeRaw8(self, value):
+        self.channel = int(math.log(value, 2)) if value else None
+
+
+class SimMAG3110(SimDevice):
+    """Converts at 80 Hz once active.  INT1 rises when new data is ready and
+    falls when the output registers are read, so an unread conversion gives no new edge.
+    """
+    def __init__(self, sim, ready_pin=None, offset=(0.0, 0.0, 0.0)):
+        SimDevice.__init__(self, sim)
+        self.ready_pin = ready_pin
+        self.offset = offset       # field difference at this sensor's position
+        self.active = False
+        self.ready = False
+        self.conversions = 0
+
+    def write8(self, register, value):
+        SimDevice.write8(self, register, value)
+        if register == 0x10 and value & 0x01 and not self.active:
+            self.active = True
+            self.sim.scheduler.call_after(0.0, self.conversion)
+        elif register == 0x10 and not value & 0x01:
+            self.active = False
+
+    def conversion(self):
+        if not self.active:
+            return
+        self.conversions += 1
+        x, y, z, temperature = self.sim.field_reading()
+        status = 0x0F | (0xF0 if self.ready else 0)   # ZYXDR, overwrite bits if unread
+        for axis, value in enumerate((x, y, z)):
+            counts = max(-32768, min(32767, int(round(value + self.offset[axis]))))
+            self.registers[0x01 + 2 * axis] = (counts >> 8) & 0xFF
+            self.registers[0x02 + 2 * axis] = counts & 0xFF
+        self.registers[0x00] = status
+        self.registers[0x0F] = int(round(temperature)) & 0xFF
+        was_ready = self.ready
+        self.ready = True
+        if not was_ready and self.ready_pin is not None:
+            self.sim.gpio.edge(self.ready_pin)
+        self.sim.scheduler.call_after(MAG3110_PERIOD_NS / 1e9, self.conversion)
+
+    def readList(self, register, length):
+        if self.sim.rng.random() < self.sim.error_rate:
+            self.sim.bus_errors += 1
+            return -1   # Adafruit_I2C reports bus errors this way
+        data = SimDevice.readList(self, register, length)
+        if register <= 0x06 < register + length:
+            # reading OUT_Z_LSB completes the read and clears data ready
+            self.ready = False
+            self.registers[0x00] = 0
+        return data
+
+
+class SimBus(object):
+    """Maps (busnum, address) to devices, sensors behind a multiplexer by channel"""
+    def __init__(self, sim):
+        self.sim = sim
+        self.devices = {}
+        self.muxed = {}     # (busnum, channel, address) -> device
+
+    def add(self, busnum, address, device, channel=None):
+        if channel is None:
+            self.devices[(busnum, address)] = device
+        else:
+            self.muxed[(busnum, channel, address)] = device
+
+    def device(self, busnum, address):
+        mux = self.devices.get((busnum, TCA9548A_ADDRESS))
+        if mux is not None and address != TCA9548A_ADDRESS:
+            device = self.muxed.get((busnum, mux.channel, address))
+            if device is not None:
+                return device
+        return self.devices.get((busnum, address))
+
+
+class SimI2C(object):
+    """Adafruit_I2C replacement, resolves the device on every call so multiplexing works"""
+    def __init__(self, address, busnum=-1, debug=False):
+        self.address = address
+        self.busnum = busnum
+
+    def target(self):
+        device = Simulation.current.bus.device(self.busnum, self.address)
+        if device is None:
+            raise IOError('no simulated device 0x%02X on bus %d' % (self.address, self.busnum))
+        return device
+
+    def write8(self, register, value):
+        sim = Simulation.current
+        if sim.write_failures:
+            # lost on the bus, Adafruit_I2C prints the IOError and returns -1
+            sim.write_failures -= 1
+            sim.bus_errors += 1
+            return -1
+        self.target().write8(register, value)
+
+    def readU8(self, register):
+        return self.target().readU8(register)
+
+    def readList(self, register, length):
+        return self.target().readList(register, length)
+
+    def writeRaw8(self, value):
+        self.target().writeRaw8(value)
+
+
+class SimGPIO(object):
+    """State behind the fake RPi.GPIO module"""
+    def __init__(self):
+        self.outputs = {}
+        self.callbacks = {}
+        self.edges = 0
+
+    def module(self):
+        gpio = types.ModuleType('RPi.GPIO')
+        for name, value in (('BCM', 11), ('BOARD', 10), ('IN', 1), ('OUT', 0), ('HIGH', 1), ('LOW', 0),
+                            ('RISING', 31), ('FALLING', 32), ('BOTH', 33), ('PUD_UP', 22), ('PUD_DOWN', 21)):
+            setattr(gpio, name, value)
+        gpio.setwarnings = lambda flag: None
+        gpio.setmode = lambda mode: None
+        gpio.setup = lambda pin, direction, **kwargs: None
+        gpio.cleanup = lambda *pins: None
+        gpio.output = self.output
+        gpio.input = lambda pin: self.outputs.get(pin, 0)
+        gpio.add_event_detect = self.add_event_detect
+        gpio.remove_event_detect = lambda pin: self.callbacks.pop(pin, None)
+        return gpio
+
+    def output(self, pin, value):
+        self.outputs[pin] = value
+
+    def add_event_detect(self, pin, edge, callback=None, bouncetime=None):
+        self.callbacks[pin] = callback
+
+    def edge(self, pin):
+        self.edges += 1
+        callback = self.callbacks.get(pin)
+        if callback is not None:
+            callback(pin)
+
+
+# = Simulation
+class Simulation(object):
+    """The simulated rig.  install() must run before mag_scan is imported."""
+    current = None
+
+    def __init__(self, seed=1, anomalies=(), error_rate=0.0, busnum=-1):
+        self.rng = random.Random(seed)
+        self.error_rate = error_rate    # chance of a failed MAG3110 read
+        self.bus_errors = 0
+        self.write_failures = 0         # the next register writes on any device fail
+        self.clock = VirtualClock()
+        self.scheduler = VirtualScheduler(self.clock)
+        self.virtual_time = VirtualTime(self.clock, self.scheduler, threading.current_thread())
+        self.gpio = SimGPIO()
+        self.field_model = FieldModel(self.rng, anomalies)
+        self.bus = SimBus(self)
+        self.si = SimSi5351(self)
+        self.phase_shifter1 = SimPhaseShifter(self)
+        self.phase_shifter2 = SimPhaseShifter(self)
+        self.mag_sensor = SimMAG3110(self, ready_pin=MAG3110_READY_PIN)
+        self.bus.add(busnum, SI5351_ADDRESS, self.si)
+        self.bus.add(busnum, 0x20, self.phase_shifter1)
+        self.bus.add(busnum, 0x21, self.phase_shifter2)
+        self.bus.add(busnum, MAG3110_ADDRESS, self.mag_sensor)
+
+    def add_array_sensor(self, busnum, channel=None, offset=(0.0, 0.0, 0.0)):
+        """A MAG3110 for mag_sensor_array, behind a multiplexer channel if channel is given"""
+        if channel is not None and (busnum, TCA9548A_ADDRESS) not in self.bus.devices:
+            self.bus.add(busnum, TCA9548A_ADDRESS, SimMultiplexer(self))
+        self.bus.add(busnum, MAG3110_ADDRESS, SimMAG3110(self, offset=offset), channel)
+
+    def install(self):
+        """Put the fake hardware modules in sys.modules"""
+        Simulation.current = self
+        rpi = types.ModuleType('RPi')
+        rpi.GPIO = self.gpio.module()
+        sys.modules['RPi'] = rpi
+        sys.modules['RPi.GPIO'] = rpi.GPIO
+        adafruit = types.ModuleType('Adafruit_I2C')
+        adafruit.Adafruit_I2C = SimI2C
+        sys.modules['Adafruit_I2C'] = adafruit
+        smbus = types.ModuleType('smbus')
+        smbus.SMBus = lambda busnum=None: None
+        sys.modules['smbus'] = smbus
+
+    def patch(self, *modules):
+        """Run the given (already imported) modules on virtual time and the virtual scheduler"""
+        for module in modules:
+            if hasattr(module, 'time'):
+                module.time = self.virtual_time
+            if hasattr(module, 'GPIO'):
+                # imported under an earlier Simulation, e.g. by another test
+                module.GPIO = sys.modules['RPi.GPIO']
+            if hasattr(module, 'DeadlineScheduler'):
+                module.DeadlineScheduler = lambda *args, **kwargs: self.scheduler
+            if hasattr(module, 'ThreadPoolExecutor'):
+                module.ThreadPoolExecutor = lambda *args, **kwargs: SynchronousExecutor(self.scheduler)
+
+    def use_virtual_event_loop(self):
+        """Run asyncio (mag_scan_async) on virtual time"""
+        asyncio.set_event_loop_policy(VirtualEventLoopPolicy(self))
+
+    def stop_after(self, seconds):
+        """Interrupt the scan (as ^C would) once seconds of virtual time have passed"""
+        self.virtual_time.stop_at_ns = self.clock.monotonic_ns() + int(seconds * 1e9)
+
+    def drive(self):
+        # (x frequency, y frequency, phase) while the coils are driven, else None.
+        # test_config_3 wiring: Clk1 / 240 through phase shifter 1 drives x, Clk2 drives y.
+        f0, f1, f2 = self.si.outputs()
+        if not self.phase_shifter1.enabled() or not (f1 or f2):
+            return None
+        return (f1 / 240.0, f2, self.phase_shifter1.phase())
+
+    def field_reading(self):
+        t = (self.clock.monotonic_ns() - SIM_START_NS) / 1e9
+        return self.field_model.field(t, self.drive())
+
+    def summary(self):
+        return 'virtual %.1f s, %d events, %d sensor conversions, %d data ready edges, %d injected bus errors' % (
+            (self.clock.monotonic_ns() - SIM_START_NS) / 1e9, self.scheduler.event_count,
+            self.mag_sensor.conversions, self.gpio.edges, self.bus_errors)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Run the mag_scan test sequence on simulated hardware')
+    parser.add_argument('--hours', type=float, default=10.0, help='virtual hours to run before stopping like ^C')
+    parser.add_argument('--dir', default='.', help='directory for mag_profile.csv and the checkpoint')
+    parser.add_argument('--resume', action='store_true', help='continue from the checkpoint in --dir')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--anomalies', type=int, default=5, help='anomalies injected in the first scanned base frequencies')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='chance of a failed sensor read')
+    parser.add_argument('--adaptive-dwell', action='store_true')
+    parser.add_argument('--adaptive-pause', action='store_true')
+    parser.add_argument('--spectral-analysis', action='store_true', help='spectra of adaptive bursts')
+    parser.add_argument('--drift-compensation', action='store_true')
+    parser.add_argument('--retest', action='store_true', help='measure flagged points again with magnets-off controls')
+    parser.add_argument('--format', choices=['csv', 'columnar', 'chunked'], default='csv', help='result format for a new scan')
+    parser.add_argument('--progress', type=float, default=600.0, help='virtual seconds between progress lines')
+    parser.add_argument('--engine', choices=['threaded', 'async'], default='threaded',
+                        help='mag_scan.py or mag_scan_async.py')
+    return parser.parse_args()
+
+
+def make_anomalies(count, rng, frequency_start=20000):
+    # near the start of the test_config_3 scan so a short run reaches them
+    anomalies = []
+    for i in range(count):
+        base = frequency_start + rng.randint(0, 2)
+        anomalies.append(Anomaly(base, base + rng.randint(0, base), phase=rng.choice(range(0, 121, 20)),
+                                 width=rng.uniform(5.0, 50.0), amplitude=rng.uniform(5.0, 30.0)))
+    return anomalies
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    anomaly_rng = random.Random(args.seed + 1)
+    sim = Simulation(seed=args.seed, anomalies=make_anomalies(args.anomalies, anomaly_rng),
+                     error_rate=args.error_rate)
+    sim.install()
+    import mag_scan
+    import mag_sensor
+    import mag_sensor_array
+    import scan_refine
+    sim.patch(mag_scan, mag_sensor, mag_sensor_array, scan_refine)
+    os.chdir(args.dir)
+    wall_start = time.time()
+    cpu_start = time.process_time()
+    resume_state, scan_info = mag_scan.make_run(args)
+    scan_info.adaptive_dwell = args.adaptive_dwell
+    scan_info.adaptive_pause = args.adaptive_pause
+    scan_info.spectral_analysis = args.spectral_analysis
+    scan_info.drift_compensation = args.drift_compensation
+    scan_info.retest_anomalies = args.retest
+    first_index = resume_state['scan_index'] if resume_state is not None else 0
+    sim.stop_after(args.hours * 3600.0)
+    if args.engine == 'async':
+        import mag_scan_async
+        sim.patch(mag_scan_async)
+        sim.use_virtual_event_loop()
+        mag_scan_async.run_async_test_sequence(resume_state, scan_info)
+    else:
+        mag_scan.run_test_sequence(resume_state, scan_info, progress_interval=args.progress)
+    wall = time.time() - wall_start
+    cpu = time.process_time() - cpu_start
+    points = scan_info.scan_index - first_index
+    print(sim.summary())
+    print('%d points in %.1f s wall, %.1f s CPU, %.1f us CPU per point, %.0f points per virtual hour' % (
+        points, wall, cpu, 1e6 * cpu / max(points, 1), points / max(args.hours, 1e-9)))
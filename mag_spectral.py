@@ -0,0 +1,202 @@
+#!/usr/bin/python
+#
+# Summary:
+# Spectral features of the readings taken during each burst.
+# A burst's mean hides periodic effects.  The drive frequencies are tens of
+# kHz, but the MAG3110 samples at its output data rate (80 Hz), so a drive
+# frequency, or a sum or beat of two of them, shows up folded into the 0-40 Hz
+# band.  For every burst the alias frequencies of f0, f1, f2 and of their
+# pairwise sums and differences are worked out, each axis is detrended
+# (least squares line), and the amplitude at each alias frequency is
+# evaluated directly from the reading timestamps (a Goertzel style single
+# bin DFT, exact for the slightly uneven data ready times).  The strongest
+# component on a grid over the band and the median grid amplitude (noise
+# floor) are added, so unexpected periodicities are noticed too.
+#
+# Bursts are processed in batches: SpectraStore collects them and computes a
+# whole batch at once with NumPy (bursts x frequencies x readings), or with
+# plain Python when NumPy is missing.  It is used as the store of a
+# SampleWriter, so the analysis runs on its own thread and writes one row
+# per burst to mag_spectra.csv, keyed by point and burst_start_ns like the
+# burst means in the results.
+#
+# MIT Open Source License
+# https://opensource.org/licenses/MIT
+#
+
+import cmath
+import math
+import os
+
+try:
+    import numpy
+except ImportError:
+    numpy = None    # computed one burst at a time instead
+
+SENSOR_ODR = 80.0   # MAG3110 output data rate (Hz), CTRL_REG1 as set in mag_sensor.py
+COMPONENTS = ['f0', 'f1', 'f2', 'f1-f0', 'f2-f0', 'f2-f1', 'f0+f1', 'f0+f2', 'f1+f2']
+MIN_READINGS = 8    # fewer readings in a burst and no spectrum is computed
+GRID_STEP = 0.5     # Hz between grid frequencies searched for the strongest component
+BATCH_BURSTS = 256  # bursts computed together
+
+
+def alias_frequency(frequency, odr=SENSOR_ODR):
+    """Frequency seen by a sensor sampling at odr, folded into 0..odr/2"""
+    folded = math.fmod(abs(frequency), odr)
+    return min(folded, odr - folded)
+
+
+def component_frequencies(f0, f1, f2):
+    # drive side frequency of each entry of COMPONENTS
+    return [f0, f1, f2, abs(f1 - f0), abs(f2 - f0), abs(f2 - f1), f0 + f1, f0 + f2, f1 + f2]
+
+
+class BurstSeries(object):
+    """Readings of one burst, filled by the scan as they arrive"""
+    def __init__(self, scan_info):
+        self.point = scan_info.scan_index
+        self.f0 = scan_info.f0
+        self.f1 = scan_info.f1
+        self.f2 = scan_info.f2
+        self.burst_start_ns = 0
+        self.times_ns = []  # data ready edge of each reading
+        self.x = []
+        self.y = []
+        self.z = []
+
+    def add(self, ready_ns, x, y, z):
+        self.times_ns.append(ready_ns)
+        self.x.append(x)
+        self.y.append(y)
+        self.z.append(z)
+
+    def __len__(self):
+        return len(self.times_ns)
+
+
+def spectra_header():
+    columns = ['point', 'burst_start_ns', 'f0', 'f1', 'f2', 'readings', 'span']
+    for name in COMPONENTS:
+        columns.extend(['%s_hz' % name, '%s_x' % name, '%s_y' % name, '%s_z' % name])
+    return ','.join(columns + ['peak_hz', 'peak_amplitude', 'floor_amplitude'])
+
+
+class SpectraStore(object):
+    """Computes per burst spectra in batches and appends them to a CSV file, a store for SampleWriter"""
+    def __init__(self, path, odr=SENSOR_ODR, batch_bursts=BATCH_BURSTS, grid_step=GRID_STEP):
+        self.path = path
+        self.odr = odr
+        self.batch_bursts = batch_bursts
+        self.grid = [grid_step * i for i in range(1, int(odr / 2.0 / grid_step) + 1)]
+        new_file = not os.path.isfile(path)
+        self.fh = open(path, 'a')
+        if new_file:
+            self.fh.write(spectra_header() + '\n')
+        self.pending = []
+        self.bursts = 0
+
+    def append(self, bursts):
+        self.pending.extend(burst for burst in bursts if len(burst) >= MIN_READINGS)
+        if len(self.pending) >= self.batch_bursts:
+            self.process()
+
+    def process(self):
+        bursts, self.pending = self.pending, []
+        if not bursts:
+            return
+        frequencies = [[alias_frequency(f, self.odr) for f in component_frequencies(burst.f0, burst.f1, burst.f2)]
+                       for burst in bursts]
+        if numpy is not None:
+            rows = batch_spectra(bursts, frequencies, self.grid)
+        else:
+            rows = [burst_spectrum(burst, burst_frequencies, self.grid)
+                    for burst, burst_frequencies in zip(bursts, frequencies)]
+        for burst, burst_frequencies, (amplitudes, peak_hz, peak, floor) in zip(bursts, frequencies, rows):
+            span = (burst.times_ns[-1] - burst.times_ns[0]) / 1e9
+            values = ['%d,%d,%d,%d,%d,%d,%.4f' % (burst.point, burst.burst_start_ns, burst.f0, burst.f1, burst.f2,
+                                                   len(burst), span)]
+            for frequency, (x, y, z) in zip(burst_frequencies, amplitudes):
+                values.append('%.3f,%.3f,%.3f,%.3f' % (frequency, x, y, z))
+            values.append('%.3f,%.3f,%.3f' % (peak_hz, peak, floor))
+            self.fh.write(','.join(values) + '\n')
+        self.bursts += len(bursts)
+
+    def sync(self):
+        """Compute what is pending and flush, returns the number of bursts written"""
+        self.process()
+        self.fh.flush()
+        os.fsync(self.fh.fileno())
+        return self.bursts
+
+    def close(self):
+        self.sync()
+        self.fh.close()
+
+
+def detrend(times, values):
+    # values less their least squares line over times
+    n = len(values)
+    mean_t = sum(times) / n
+    mean_v = sum(values) / float(n)
+    stt = sum((t - mean_t) ** 2 for t in times)
+    slope = sum((t - mean_t) * (v - mean_v) for t, v in zip(times, values)) / stt if stt else 0.0
+    return [v - mean_v - slope * (t - mean_t) for t, v in zip(times, values)]
+
+
+def amplitude(times, residual, frequency):
+    # amplitude of the sinusoid at frequency, a single DFT bin evaluated at the reading times
+    step = -2j * math.pi * frequency
+    total = sum(value * cmath.exp(step * t) for t, value in zip(times, residual))
+    return 2.0 * abs(total) / len(residual)
+
+
+def burst_spectrum(burst, frequencies, grid):
+    """(per component (x, y, z) amplitudes, peak frequency, peak amplitude, floor amplitude) without NumPy"""
+    times = [(t - burst.times_ns[0]) / 1e9 for t in burst.times_ns]
+    residuals = [detrend(times, values) for values in (burst.x, burst.y, burst.z)]
+    amplitudes = [tuple(amplitude(times, residual, frequency) if frequency > 0 else 0.0 for residual in residuals)
+                  for frequency in frequencies]
+    grid_amplitudes = [max(amplitude(times, residual, frequency) for residual in residuals) for frequency in grid]
+    peak = max(range(len(grid)), key=grid_amplitudes.__getitem__)
+    ordered = sorted(grid_amplitudes)
+    middle = len(ordered) // 2
+    floor = ordered[middle] if len(ordered) % 2 else (ordered[middle - 1] + ordered[middle]) / 2.0
+    return amplitudes, grid[peak], grid_amplitudes[peak], floor
+
+
+def batch_spectra(bursts, frequencies, grid):
+    """burst_spectrum for a batch of bursts at once with NumPy"""
+    count = len(bursts)
+    length = max(len(burst) for burst in bursts)
+    # bursts padded to the longest, mask marks real readings
+    times = numpy.zeros((count, length))
+    values = numpy.zeros((count, 3, length))
+    mask = numpy.zeros((count, length))
+    for i, burst in enumerate(bursts):
+        n = len(burst)
+        times[i, :n] = (numpy.array(burst.times_ns, dtype=numpy.int64) - burst.times_ns[0]) / 1e9
+        values[i, 0, :n] = burst.x
+        values[i, 1, :n] = burst.y
+        values[i, 2, :n] = burst.z
+        mask[i, :n] = 1.0
+    n = mask.sum(axis=1)
+    # detrend each axis over the real readings
+    mean_t = (times * mask).sum(axis=1) / n
+    dt = (times - mean_t[:, None]) * mask
+    mean_v = (values * mask[:, None, :]).sum(axis=2) / n[:, None]
+    dv = (values - mean_v[:, :, None]) * mask[:, None, :]
+    stt = (dt * dt).sum(axis=1)
+    slope = (dv * dt[:, None, :]).sum(axis=2) / numpy.where(stt > 0, stt, 1.0)[:, None]
+    residual = dv - slope[:, :, None] * dt[:, None, :]
+    # single bins at the component frequencies: bursts x frequencies x readings
+    component = numpy.array(frequencies)
+    basis = numpy.exp(-2j * numpy.pi * component[:, :, None] * times[:, None, :])
+    amplitudes = 2.0 * numpy.abs(numpy.einsum('bfn,ban->bfa', basis, residual)) / n[:, None, None]
+    amplitudes[component <= 0] = 0.0
+    # the same on the common grid, strongest axis at each frequency
+    grid = numpy.array(grid)
+    basis = numpy.exp(-2j * numpy.pi * grid[None, :, None] * times[:, None, :])
+    grid_amplitudes = (2.0 * numpy.abs(numpy.einsum('bfn,ban->bfa', basis, residual)) / n[:, None, None]).max(axis=2)
+    peak = grid_amplitudes.argmax(axis=1)
+    floor = numpy.median(grid_amplitudes, axis=1)
+    return [(amplitudes[i].tolist(), grid[peak[i]], grid_amplitudes[i, peak[i]], floor[i]) for i in range(count)]
@@ -0,0 +1,196 @@
+#!/usr/bin/python
+#
+# Summary:
+# Live telemetry from a running scan, without terminal output on the scan threads.
+# The scan publishes JSON datagrams (samples, detector events, messages and
+# a periodic progress report with counters) on a UNIX datagram socket.  Any
+# number of viewers subscribe by binding a socket named viewer-*.sock in the
+# telemetry directory; the publisher looks for them once a second.
+#
+# Publishing never blocks: the socket is non-blocking, so a datagram that a
+# slow viewer has no room for is dropped and counted, and a viewer that has
+# gone away is forgotten and its socket file removed.  With no viewer
+# nothing is even formatted.
+#
+# Usage:
+#   python mag_telemetry.py                   # everything, one sample line in 10
+#   python mag_telemetry.py --kinds progress event
+#   python mag_telemetry.py --json            # raw messages, one per line
+#
+# MIT Open Source License
+# https://opensource.org/licenses/MIT
+#
+
+import argparse
+import json
+import os
+import socket
+import time
+
+from mag_scheduler import LatenessStats
+
+TELEMETRY_DIR = '/tmp/mag_telemetry'
+VIEWER_PREFIX = 'viewer-'
+VIEWER_SUFFIX = '.sock'
+KINDS = ['sample', 'progress', 'event', 'log']
+MAX_DATAGRAM = 65536
+
+
+class TelemetryPublisher(object):
+    """Sends telemetry to every subscribed viewer, dropping what a viewer cannot take at once.
+    Called from the scan threads; a lost count under contention is of no consequence.
+    """
+    def __init__(self, directory=TELEMETRY_DIR, rescan_interval=1.0):
+        self.directory = directory
+        self.rescan_interval = rescan_interval   # seconds between looks for new viewers
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+        self.viewers = []
+        self.next_rescan = 0.0
+        self.sent = 0
+        self.dropped = 0                         # datagrams a viewer had no room for
+        self.read_latency = LatenessStats()      # data ready edge to sensor read completed
+
+    def rescan(self):
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            names = []
+        self.viewers = [os.path.join(self.directory, name) for name in sorted(names)
+                        if name.startswith(VIEWER_PREFIX) and name.endswith(VIEWER_SUFFIX)]
+        self.next_rescan = time.monotonic() + self.rescan_interval
+
+    def active(self):
+        """True if anyone is listening, so callers can skip building a message"""
+        if time.monotonic() >= self.next_rescan:
+            self.rescan()
+        return bool(self.viewers)
+
+    def publish(self, kind, fields):
+        if not self.active():
+            return
+        fields['kind'] = kind
+        fields['time'] = time.time()
+        data = json.dumps(fields).encode('utf-8')
+        for path in self.viewers:
+            try:
+                self.socket.sendto(data, path)
+                self.sent += 1
+            except (BlockingIOError, InterruptedError):
+                self.dropped += 1   # the viewer is behind
+            except (ConnectionRefusedError, FileNotFoundError):
+                # the viewer has exited, nothing is bound to its socket any more
+                self.viewers = [viewer for viewer in self.viewers if viewer != path]
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            except OSError:
+                self.dropped += 1
+
+    def sample(self, sample):
+        if sample.ready_ns:
+            self.read_latency.add(sample.read_ns - sample.ready_ns)
+        if not self.active():
+            return
+        self.publish('sample', {
+            'point': sample.point, 'sensor': sample.sensor, 'valid': sample.valid,
+            'f0': sample.f0, 'f1': sample.f1, 'f2': sample.f2,
+            'clock1_phase_offset': sample.clock1_phase_offset, 'clock2_phase_offset': sample.clock2_phase_offset,
+            'x': sample.x, 'y': sample.y, 'z': sample.z, 'temperature': sample.temperature,
+            'ready_ns': sample.ready_ns, 'read_ns': sample.read_ns})
+
+    def event(self, event):
+        # a detector listener
+        self.publish('event', event.as_dict())
+
+    def log(self, text):
+        self.publish('log', {'text': text})
+
+    def progress(self, fields):
+        fields['telemetry'] = {'sent': self.sent, 'dropped': self.dropped}
+        fields['read_latency_us'] = {'mean': self.read_latency.mean_ns() / 1e3, 'max': self.read_latency.max_ns / 1e3}
+        self.publish('progress', fields)
+
+    def close(self):
+        self.socket.close()
+
+
+class TelemetryViewer(object):
+    """Subscribes to telemetry by binding a viewer socket in the telemetry directory"""
+    def __init__(self, directory=TELEMETRY_DIR, buffer_size=1 << 20):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.path = os.path.join(directory, '%s%d%s' % (VIEWER_PREFIX, os.getpid(), VIEWER_SUFFIX))
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, buffer_size)
+        self.socket.bind(self.path)
+
+    def messages(self):
+        """Messages as dicts, forever"""
+        while True:
+            yield json.loads(self.socket.recv(MAX_DATAGRAM).decode('utf-8'))
+
+    def close(self):
+        self.socket.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def format_message(message):
+    kind = message['kind']
+    if kind == 'sample':
+        if not message['valid']:
+            return 'point:%d %s read failed' % (message['point'], message['sensor'] or 'main')
+        return '%sfx:%d, fy:%d, fz:%d, clock1_phase:%d, clock2_phase:%d, magX:%d, magY:%d, magZ:%d' % (
+            message['sensor'] + ' ' if message['sensor'] else '', message['f0'], message['f1'], message['f2'],
+            message['clock1_phase_offset'], message['clock2_phase_offset'], message['x'], message['y'], message['z'])
+    if kind == 'progress':
+        text = 'point %d of %d (%.3f%%)' % (message['point'], message['total'], message['percent'])
+        if message.get('eta') is not None:
+            eta = int(message['eta'])
+            text += ', ETA %dd %02d:%02d:%02d' % (eta // 86400, eta // 3600 % 24, eta // 60 % 60, eta % 60)
+        counters = message.get('counters', {})
+        text += '\n  ' + ', '.join('%s:%s' % (name, counters[name]) for name in sorted(counters))
+        for name, late in sorted(message.get('lateness_us', {}).items()):
+            text += '\n  %s late mean %.1f us, max %.1f us' % (name, late['mean'], late['max'])
+        text += '\n  read latency mean %.1f us, max %.1f us, telemetry sent:%d dropped:%d' % (
+            message['read_latency_us']['mean'], message['read_latency_us']['max'],
+            message['telemetry']['sent'], message['telemetry']['dropped'])
+        return text
+    if kind == 'event':
+        return '%s %s point:%d fx:%d, fy:%d, fz:%d, clock1_phase:%d, mag%s:%d baseline:%.1f z:%.1f' % (
+            message['alarm'].upper(), message['sensor'] or 'main', message['point'], message['f0'], message['f1'],
+            message['f2'], message['clock1_phase_offset'], message['axis'].upper(), message['value'],
+            message['baseline'], message['z'])
+    return message.get('text', '')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Show live telemetry from a running scan')
+    parser.add_argument('--dir', default=TELEMETRY_DIR, help='telemetry directory')
+    parser.add_argument('--kinds', nargs='+', choices=KINDS, default=KINDS)
+    parser.add_argument('--sample-every', type=int, default=10, help='show one sample in this many')
+    parser.add_argument('--json', action='store_true', help='print the raw messages')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    viewer = TelemetryViewer(args.dir)
+    samples = 0
+    try:
+        for message in viewer.messages():
+            if message['kind'] not in args.kinds:
+                continue
+            if message['kind'] == 'sample':
+                samples += 1
+                if samples % args.sample_every:
+                    continue
+            print(json.dumps(message) if args.json else format_message(message))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        viewer.close()
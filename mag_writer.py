@@ -0,0 +1,190 @@
+#!/usr/bin/python
+#
+# Summary:
+# Storage stage for the scan engine.
+# save_samples hands each batch of samples, together with the checkpoint
+# state that covers it, to a SampleWriter and returns at once.  The writer
+# thread appends them to a store kept open for the whole scan (CsvStore for
+# mag_profile.csv, ColumnarStore from mag_columnar.py or ChunkedStore from
+# mag_chunked.py), and commits in
+# groups: the store is fsync'd and the checkpoint replaced once
+# commit_interval seconds or commit_rows rows have built up, instead of
+# after every batch.  A checkpoint is only ever written after the rows it
+# covers are on disk.
+#
+# The hand-off is a deque, whose append and popleft are atomic, so the
+# scan thread takes no lock to submit a batch.  The queue is bounded: if
+# the disk falls behind by max_batches the scan thread waits for room
+# (backpressure) rather than dropping samples, and the wait is counted.
+# If the store fails (disk full, I/O error) the writer thread stops and the
+# error is raised again from the next submit and from close, so the scan
+# stops instead of running on with nothing written.
+#
+# MIT Open Source License
+# https://opensource.org/licenses/MIT
+#
+
+import collections
+import os
+import threading
+import time
+
+from mag_checkpoint import write_checkpoint
+from mag_scan_info import csv_row
+
+FORMAT_CSV = 'csv'
+FORMAT_COLUMNAR = 'columnar'
+FORMAT_CHUNKED = 'chunked'
+
+
+class CsvStore(object):
+    """Appends mag_profile.csv rows through one buffered file handle"""
+    def __init__(self, path, buffer_size=1 << 16):
+        self.path = path
+        self.fh = open(path, 'a', buffering=buffer_size)
+
+    def append(self, samples):
+        for sample in samples:
+            self.fh.write(csv_row(sample) + '\n')
+
+    def sync(self):
+        """Flush to disk, returns the data length a checkpoint should record"""
+        self.fh.flush()
+        os.fsync(self.fh.fileno())
+        return self.fh.tell()
+
+    def close(self):
+        self.fh.close()
+
+
+class WriterStats(object):
+    """Throughput and backpressure counters"""
+    def __init__(self):
+        self.batches = 0          # batches submitted
+        self.rows = 0             # rows written
+        self.commits = 0          # fsync + checkpoint groups
+        self.max_depth = 0        # most batches waiting in the queue
+        self.stalls = 0           # submits that had to wait for room
+        self.stall_ns = 0         # total time the scan thread waited
+        self.max_stall_ns = 0
+        self.commit_ns = 0        # total time spent in fsync and checkpoint writes
+        self.max_commit_ns = 0
+
+    def summary(self):
+        return ('Writer batches:%d rows:%d commits:%d (%.1f ms mean, %.1f ms max) '
+                'queue max:%d stalls:%d (%.1f ms total, %.1f ms max)' % (
+                    self.batches, self.rows, self.commits,
+                    self.commit_ns / 1e6 / self.commits if self.commits else 0.0, self.max_commit_ns / 1e6,
+                    self.max_depth, self.stalls, self.stall_ns / 1e6, self.max_stall_ns / 1e6))
+
+
+class SampleWriter(object):
+    """Appends samples to a store from its own thread, with group commit"""
+    def __init__(self, store, checkpoint_path=None, max_batches=256, commit_interval=5.0, commit_rows=5000):
+        self.store = store
+        self.checkpoint_path = checkpoint_path   # None to write data only
+        self.max_batches = max_batches
+        self.commit_interval = commit_interval   # seconds between commits at most
+        self.commit_rows = commit_rows           # or commit once this many rows are waiting
+        self.queue = collections.deque()         # (samples, checkpoint state)
+        self.wakeup = threading.Event()          # set when a batch is queued
+        self.room = threading.Event()            # set when the writer has taken batches off the queue
+        self.stopping = False
+        self.error = None                        # exception that stopped the writer thread
+        self.stats = WriterStats()
+        self.thread = threading.Thread(target=self.run, name='SampleWriter')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def check(self):
+        """Raise the error that stopped the writer, if any"""
+        if self.error is not None:
+            raise self.error
+
+    def submit(self, samples, state=None):
+        """Queue samples for writing, state is the checkpoint to record once they are on disk.
+        Raises the store's error once the writer has failed.
+        """
+        self.check()
+        if len(self.queue) >= self.max_batches:
+            # disk is behind, wait for room rather than lose samples
+            start_ns = time.monotonic_ns()
+            while len(self.queue) >= self.max_batches and self.thread.is_alive():
+                self.room.clear()
+                if len(self.queue) >= self.max_batches:
+                    self.room.wait(0.1)
+            stall_ns = time.monotonic_ns() - start_ns
+            self.stats.stalls += 1
+            self.stats.stall_ns += stall_ns
+            self.stats.max_stall_ns = max(self.stats.max_stall_ns, stall_ns)
+            self.check()
+        self.queue.append((samples, state))
+        self.stats.batches += 1
+        self.stats.max_depth = max(self.stats.max_depth, len(self.queue))
+        self.wakeup.set()
+
+    def run(self):
+        try:
+            self.write_batches()
+        except Exception as error:
+            # nothing more can be written, hand the error to the scan thread
+            self.error = error
+            self.room.set()
+
+    def write_batches(self):
+        pending_rows = 0      # written since the last commit
+        pending_state = None  # newest checkpoint not yet recorded
+        last_commit = time.monotonic()
+        while True:
+            timeout = max(0.0, last_commit + self.commit_interval - time.monotonic())
+            self.wakeup.wait(timeout if pending_rows or pending_state is not None else None)
+            # clear before draining, a batch queued from now on sets it again
+            self.wakeup.clear()
+            while self.queue:
+                samples, state = self.queue.popleft()
+                self.room.set()
+                self.store.append(samples)
+                pending_rows += len(samples)
+                self.stats.rows += len(samples)
+                if state is not None:
+                    pending_state = state
+                if pending_rows >= self.commit_rows:
+                    break
+            stopping = self.stopping and not self.queue
+            due = time.monotonic() - last_commit >= self.commit_interval or pending_rows >= self.commit_rows
+            if (pending_rows or pending_state is not None) and (due or stopping):
+                self.commit(pending_state)
+                pending_rows = 0
+                pending_state = None
+                last_commit = time.monotonic()
+            if stopping:
+                return
+            if self.queue:
+                self.wakeup.set()
+
+    def commit(self, state):
+        start_ns = time.monotonic_ns()
+        data_length = self.store.sync()
+        if state is not None and self.checkpoint_path is not None:
+            state['data_length'] = data_length
+            write_checkpoint(self.checkpoint_path, state)
+        commit_ns = time.monotonic_ns() - start_ns
+        self.stats.commits += 1
+        self.stats.commit_ns += commit_ns
+        self.stats.max_commit_ns = max(self.stats.max_commit_ns, commit_ns)
+
+    def close(self):
+        """Write and commit everything queued, then close the store.
+        Raises the store's error if the writer failed.
+        """
+        self.stopping = True
+        self.wakeup.set()
+        self.thread.join()
+        if self.error is None:
+            self.store.close()
+            return
+        try:
+            self.store.close()
+        except Exception:
+            pass    # the first error is the one reported
+        raise self.error
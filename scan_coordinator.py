@@ -0,0 +1,308 @@
+#!/usr/bin/python
+#
+# Summary:
+# Share one scan between several identical rigs.
+# The coordinator splits a scan space into leases (contiguous ranges of
+# scan_index) and hands them to scan_worker.py processes over TCP.
+# Messages are single JSON objects, one request and one reply per connection:
+#   {"op": "lease", "rig": name}                 -> lease, wait or done
+#   {"op": "heartbeat", "rig": name, "lease": id}  keeps a lease alive
+#   {"op": "result", "rig": name, "lease": id, "rows": [...]}
+#   {"op": "status"}
+# A lease that is neither completed nor renewed within lease_timeout is
+# handed out again.  Results are appended to one merged CSV, the usual
+# mag_profile.csv columns plus the rig that measured each row and the lease
+# it belonged to.  If a re-issued lease is completed twice only the first
+# result is kept.  Once a lease's rows are on disk (fsync) a completion
+# marker with the merged file's length is appended to the .leases file next
+# to it, and only marked leases count as done on --resume; rows of a lease
+# cut short by a crash are truncated away and the lease measured again.
+#
+# Usage: python scan_coordinator.py --port 5351 --lease-size 1000
+#
+# MIT Open Source License
+# https://opensource.org/licenses/MIT
+#
+
+import argparse
+import collections
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+
+from mag_scan_info import CSV_HEADER
+from scan_space import scan_space_3
+
+MERGED_FILE = 'mag_profile_merged.csv'
+LEASES_SUFFIX = '.leases'    # completion markers: lease id, merged file length once its rows were synced
+COORDINATOR_PORT = 5351
+
+
+class Lease(object):
+    """Points start..stop-1 of the scan handed to one rig"""
+    def __init__(self, lease_id, start, stop):
+        self.id = lease_id
+        self.start = start
+        self.stop = stop
+        self.rig = None
+        self.deadline = 0.0
+        self.issued = 0      # times handed out
+
+
+class RigStats(object):
+    def __init__(self):
+        self.leases = 0
+        self.points = 0
+        self.rows = 0
+        self.first_time = 0.0
+        self.last_time = 0.0
+
+    def points_per_second(self):
+        seconds = self.last_time - self.first_time
+        return self.points / seconds if seconds > 0 else 0.0
+
+
+class ScanCoordinator(object):
+    """Lease bookkeeping, thread safe, independent of the transport.
+    Lease k covers points k * lease_size up to the next lease, leases are
+    created when first handed out so huge scans cost nothing up front.
+    """
+    def __init__(self, space, output=MERGED_FILE, lease_size=1000, lease_timeout=600.0, resume=False):
+        self.space = space
+        self.points = len(space)
+        self.output = output
+        self.leases_path = output + LEASES_SUFFIX
+        self.lease_size = lease_size
+        self.lease_timeout = lease_timeout
+        self.lease_count = (self.points + lease_size - 1) // lease_size
+        self.lock = threading.Lock()
+        self.next_id = 0                     # first lease never handed out
+        self.requeued = collections.deque()  # timed out leases, handed out again first
+        self.active = {}                     # lease id -> Lease
+        self.completed = set()
+        self.done_points = 0
+        self.rigs = {}                       # rig name -> RigStats
+        self.start_time = time.time()
+        if resume and os.path.isfile(output):
+            completed, length = self.completed_leases()
+            for lease_id in completed:
+                self.completed.add(lease_id)
+                start, stop = self.lease_bounds(lease_id)
+                self.done_points += stop - start
+            # drop the rows of a lease that was being written when we stopped
+            fh = open(output, 'r+')
+            fh.truncate(length)
+            fh.close()
+        else:
+            fh = open(output, 'w')
+            fh.write(CSV_HEADER + ',rig,lease\n')
+            fh.close()
+            open(self.leases_path, 'w').close()
+
+    def lease_bounds(self, lease_id):
+        start = lease_id * self.lease_size
+        return start, min(start + self.lease_size, self.points)
+
+    def completed_leases(self):
+        # (lease ids, merged file length covered) from the markers of a previous run
+        done = set()
+        length = len(CSV_HEADER + ',rig,lease\n')
+        if not os.path.isfile(self.leases_path):
+            return done, length
+        fh = open(self.leases_path)
+        for line in fh:
+            if not line.endswith('\n'):
+                break   # marker cut short, its lease is not done
+            lease_id, lease_end = line.split(',')
+            done.add(int(lease_id))
+            length = int(lease_end)
+        fh.close()
+        return done, length
+
+    def done(self):
+        return len(self.completed) == self.lease_count
+
+    def handle(self, message):
+        op = message.get('op')
+        rig = str(message.get('rig', '')).replace(',', '_')
+        with self.lock:
+            if op == 'lease':
+                return self.issue(rig)
+            if op == 'heartbeat':
+                return self.renew(rig, message['lease'])
+            if op == 'result':
+                return self.complete(rig, message['lease'], message['rows'])
+            if op == 'status':
+                return {'op': 'status', 'text': self.status()}
+        return {'op': 'error', 'error': 'unknown op %r' % op}
+
+    def issue(self, rig):
+        self.expire()
+        if self.done():
+            return {'op': 'done'}
+        while self.next_id < self.lease_count and self.next_id in self.completed:
+            self.next_id += 1
+        if self.requeued:
+            lease = self.requeued.popleft()
+        elif self.next_id < self.lease_count:
+            lease = Lease(self.next_id, *self.lease_bounds(self.next_id))
+            self.next_id += 1
+        else:
+            # everything is out, ask again in case a lease times out
+            return {'op': 'wait', 'seconds': min(self.lease_timeout, 5.0)}
+        now = time.time()
+        stats = self.rigs.setdefault(rig, RigStats())
+        if not stats.first_time:
+            stats.first_time = now  # throughput is measured from the first lease
+        lease.rig = rig
+        lease.deadline = now + self.lease_timeout
+        lease.issued += 1
+        self.active[lease.id] = lease
+        if lease.issued > 1:
+            print('Lease %d (points %d..%d) re-issued to %s' % (lease.id, lease.start, lease.stop - 1, rig))
+        return {'op': 'lease', 'lease': lease.id, 'start': lease.start, 'stop': lease.stop,
+                'points': self.points, 'timeout': self.lease_timeout}
+
+    def renew(self, rig, lease_id):
+        lease = self.active.get(lease_id)
+        if lease is None or lease.rig != rig:
+            # expired and given to another rig, or already completed
+            return {'op': 'lost'}
+        lease.deadline = time.time() + self.lease_timeout
+        return {'op': 'ok'}
+
+    def complete(self, rig, lease_id, rows):
+        if lease_id in self.completed or not 0 <= lease_id < self.lease_count:
+            return {'op': 'ok', 'duplicate': True}
+        self.active.pop(lease_id, None)
+        for lease in self.requeued:
+            if lease.id == lease_id:
+                # timed out but finished before anyone else picked it up
+                self.requeued.remove(lease)
+                break
+        fh = open(self.output, 'a')
+        for row in rows:
+            fh.write('%s,%s,%d\n' % (row, rig, lease_id))
+        fh.flush()
+        os.fsync(fh.fileno())
+        length = fh.tell()
+        fh.close()
+        # the lease only counts as done once its rows are on disk
+        fh = open(self.leases_path, 'a')
+        fh.write('%d,%d\n' % (lease_id, length))
+        fh.flush()
+        os.fsync(fh.fileno())
+        fh.close()
+        self.completed.add(lease_id)
+        start, stop = self.lease_bounds(lease_id)
+        self.done_points += stop - start
+        stats = self.rigs.setdefault(rig, RigStats())
+        stats.leases += 1
+        stats.points += stop - start
+        stats.rows += len(rows)
+        stats.last_time = time.time()
+        return {'op': 'ok'}
+
+    def expire(self):
+        # return timed out leases to the front of the queue
+        now = time.time()
+        for lease_id, lease in list(self.active.items()):
+            if lease.deadline < now:
+                print('Lease %d held by %s timed out' % (lease_id, lease.rig))
+                del self.active[lease_id]
+                self.requeued.append(lease)
+
+    def status(self):
+        elapsed = time.time() - self.start_time
+        lines = ['%d of %d leases done, %d active, %d points in %.0f s (%.2f points/s)' % (
+            len(self.completed), self.lease_count, len(self.active), self.done_points, elapsed,
+            self.done_points / elapsed if elapsed > 0 else 0.0)]
+        for rig, stats in sorted(self.rigs.items()):
+            lines.append('  %s: %d leases, %d points, %d rows, %.2f points/s' % (
+                rig, stats.leases, stats.points, stats.rows, stats.points_per_second()))
+        return '\n'.join(lines)
+
+
+class CoordinatorHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        try:
+            reply = self.server.coordinator.handle(json.loads(line.decode('utf-8')))
+        except (ValueError, KeyError) as error:
+            reply = {'op': 'error', 'error': str(error)}
+        self.wfile.write((json.dumps(reply) + '\n').encode('utf-8'))
+
+
+class CoordinatorServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, coordinator):
+        socketserver.ThreadingTCPServer.__init__(self, address, CoordinatorHandler)
+        self.coordinator = coordinator
+
+
+def request(address, message, timeout=30.0):
+    """Send one message to the coordinator at address (host, port), returns the reply"""
+    connection = socket.create_connection(address, timeout=timeout)
+    try:
+        connection.sendall((json.dumps(message) + '\n').encode('utf-8'))
+        reply = connection.makefile('rb').readline()
+    finally:
+        connection.close()
+    if not reply:
+        raise IOError('no reply from coordinator %s:%d' % address)
+    return json.loads(reply.decode('utf-8'))
+
+
+def run_coordinator(coordinator, host='', port=COORDINATOR_PORT, progress_interval=10.0):
+    server = CoordinatorServer((host, port), coordinator)
+    thread = threading.Thread(target=server.serve_forever, name='CoordinatorServer')
+    thread.daemon = True
+    thread.start()
+    print('Coordinator listening on port %d, %d leases of up to %d points' % (
+        server.server_address[1], coordinator.lease_count, coordinator.lease_size))
+    try:
+        last_progress = time.time()
+        while not coordinator.done():
+            time.sleep(0.5)
+            if time.time() - last_progress >= progress_interval:
+                last_progress = time.time()
+                with coordinator.lock:
+                    print(coordinator.status())
+        # give waiting workers a chance to hear they are done
+        time.sleep(min(coordinator.lease_timeout, 5.0))
+    except KeyboardInterrupt:
+        print('Interrupted, run with --resume to continue')
+    server.shutdown()
+    server.server_close()
+    with coordinator.lock:
+        print(coordinator.status())
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Hand out a scan to several rigs and merge the results')
+    parser.add_argument('--host', default='', help='address to listen on (default all)')
+    parser.add_argument('--port', type=int, default=COORDINATOR_PORT)
+    parser.add_argument('--lease-size', type=int, default=1000, help='points per lease')
+    parser.add_argument('--lease-timeout', type=float, default=600.0,
+                        help='seconds without a heartbeat before a lease is handed out again')
+    parser.add_argument('--frequency-start', type=int, default=20000)
+    parser.add_argument('--frequency-end', type=int, default=40000)
+    parser.add_argument('--frequency-step', type=int, default=1)
+    parser.add_argument('--output', default=MERGED_FILE)
+    parser.add_argument('--resume', action='store_true', help='keep leases completed in the merged file')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    space = scan_space_3(args.frequency_start, args.frequency_end, args.frequency_step)
+    coordinator = ScanCoordinator(space, output=args.output, lease_size=args.lease_size,
+                                  lease_timeout=args.lease_timeout, resume=args.resume)
+    run_coordinator(coordinator, args.host, args.port)
@@ -0,0 +1,169 @@
+#!/usr/bin/python
+#
+# Summary:
+# Choose the order scan points are measured in to reduce hardware
+# reconfiguration between bursts.
+# The scan spaces in scan_space.py visit points like nested for loops, so
+# whenever an inner loop wraps around every inner parameter jumps back to its
+# start.  A serpentine (boustrophedon, or reflected mixed radix Gray code)
+# traversal runs every other pass of an inner loop backwards instead, so
+# consecutive points differ in as few parameters, and by as little, as possible.
+# The reordered space is a permutation of the original one: exactly the same
+# points are measured, only the order changes.
+#
+# The cost of an order is predicted by running the scan's test_config on
+# Si5351 and PhaseShifter objects connected to a CountingI2C instead of the
+# bus, so the register shadows in those drivers decide what is written just
+# as they do on the real hardware.
+#
+# MIT Open Source License
+# https://opensource.org/licenses/MIT
+#
+
+from PhaseShifter import PhaseShifter
+from Si5351_clock import Si5351
+from mag_scan_info import ScanInfo
+from scan_space import Product, RatioSweep, ScanSpace
+
+
+class SerpentineProduct(ScanSpace):
+    """Product visiting every other pass of each inner space in reverse"""
+    def __init__(self, product):
+        self.spaces = [serpentine(space) for space in product.spaces]
+        self.names = product.names
+        self.count = len(product)
+
+    def __len__(self):
+        return self.count
+
+    def point(self, k):
+        values = []
+        for space in reversed(self.spaces):
+            k, digit = divmod(k, len(space))
+            # the prefix index k is odd, run this pass backwards
+            if k % 2:
+                digit = len(space) - 1 - digit
+            values[0:0] = space.point(digit)
+        return tuple(values)
+
+
+class SerpentineRatioSweep(ScanSpace):
+    """RatioSweep with the inner sweep reversed for odd outer values"""
+    def __init__(self, sweep):
+        self.sweep = sweep
+        self.names = sweep.names
+
+    def __len__(self):
+        return len(self.sweep)
+
+    def point(self, k):
+        i, j = self.sweep.locate(k)
+        if i % 2:
+            j = self.sweep.inner_count(i) - 1 - j
+        return self.sweep.value(i, j)
+
+
+def serpentine(space):
+    """The same points as space in serpentine order.
+    Spaces without nested loops are returned unchanged.
+    """
+    if isinstance(space, Product):
+        return SerpentineProduct(space)
+    if isinstance(space, RatioSweep):
+        return SerpentineRatioSweep(space)
+    return space
+
+
+def same_points(space_a, space_b):
+    """True if both spaces contain exactly the same points (enumerates both, small spaces only)"""
+    if space_a.names != space_b.names or len(space_a) != len(space_b):
+        return False
+    return sorted(space_a) == sorted(space_b)
+
+
+class CountingI2C(object):
+    """Stands in for Adafruit_I2C, counts writes and remembers register values"""
+    def __init__(self):
+        self.registers = {}
+        self.write_count = 0
+
+    def write8(self, register, value):
+        self.registers[register] = value
+        self.write_count += 1
+
+    def writeRaw8(self, value):
+        self.write_count += 1
+
+    def readU8(self, register):
+        return self.registers.get(register, 0)
+
+
+class ScanCost(object):
+    """Register traffic for part of a scan"""
+    def __init__(self, points, si_writes, si_skipped, pll_resets, expander_writes, pll_reset_cost):
+        self.points = points
+        self.si_writes = si_writes              # includes pll_resets
+        self.si_skipped = si_skipped
+        self.pll_resets = pll_resets
+        self.expander_writes = expander_writes
+        self.pll_reset_cost = pll_reset_cost    # a PLL reset costs this many register writes
+
+    def total(self):
+        return self.si_writes + self.expander_writes + (self.pll_reset_cost - 1) * self.pll_resets
+
+    def per_point(self):
+        return float(self.total()) / self.points if self.points else 0.0
+
+    def unshadowed_per_point(self):
+        # the same writes without the Si5351 register shadow
+        return self.per_point() + float(self.si_skipped) / self.points if self.points else 0.0
+
+    def summary(self):
+        return ('%d points: Si5351 writes %d (skipped %d), PLL resets %d, expander writes %d, '
+                'cost %.1f per point (%.1f without skipping)' % (
+                    self.points, self.si_writes, self.si_skipped, self.pll_resets, self.expander_writes,
+                    self.per_point(), self.unshadowed_per_point()))
+
+
+def predict_cost(space, test_config, points=7000, pll_reset_cost=8):
+    """Run test_config for the first points of space against counting devices.
+    Each point is followed by the writes made by start_field and turn_off_field.
+    """
+    scan_info = ScanInfo()
+    scan_info.si = Si5351(i2c=CountingI2C())
+    scan_info.phase_shifter1 = PhaseShifter(i2c=CountingI2C())
+    scan_info.phase_shifter2 = PhaseShifter(address=0x21, i2c=CountingI2C())
+    scan_info.cycle_count = 1  # skip the test_config start up messages
+    shifters = (scan_info.phase_shifter1, scan_info.phase_shifter2)
+    # count from the first point on, not the device set up
+    si_writes, si_skipped = scan_info.si.writeCount, scan_info.si.writesSkipped
+    expander_writes = sum(shifter.write_count for shifter in shifters)
+    points = min(points, len(space))
+    for k in range(points):
+        space.apply(k, scan_info)
+        test_config(scan_info)
+        scan_info.si.enableOutputs(True)
+        for shifter in shifters:
+            shifter.clock_disable()
+        scan_info.si.enableOutputs(False)
+    return ScanCost(points,
+                    scan_info.si.writeCount - si_writes,
+                    scan_info.si.writesSkipped - si_skipped,
+                    scan_info.si.pllResets,
+                    sum(shifter.write_count for shifter in shifters) - expander_writes,
+                    pll_reset_cost)
+
+
+def optimize_order(space, test_config, points=7000):
+    """Returns space reordered to minimize the predicted register traffic,
+    printing the predicted cost of each candidate order.
+    """
+    candidates = [('original', space), ('serpentine', serpentine(space))]
+    best_name, best_space, best_cost = None, space, None
+    for name, candidate in candidates:
+        cost = predict_cost(candidate, test_config, points)
+        print('%s order, %s' % (name, cost.summary()))
+        if best_cost is None or cost.total() < best_cost.total():
+            best_name, best_space, best_cost = name, candidate, cost
+    print('Using %s order' % best_name)
+    return best_space
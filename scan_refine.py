@@ -0,0 +1,182 @@
+#!/usr/bin/python
+#
+# Summary:
+# Multi-resolution scanning.
+# Instead of measuring every point of a huge scan, measure the corners of a
+# coarse lattice of cells, rank the cells by how much the field response
+# varies across them (or by its magnitude), and keep splitting the most
+# promising cell in half along every axis until the hardware resolution is
+# reached or the time budget runs out.
+#
+# RefineScan.update_parameters is used as scan_info.test_update_parameters,
+# so the usual test_config, burst and sample recording code is unchanged.
+# Each measured point gets the next scan_index, which is written to the
+# point column of mag_profile.csv.
+#
+# MIT Open Source License
+# https://opensource.org/licenses/MIT
+#
+
+import collections
+import heapq
+import itertools
+import math
+import time
+
+SCORE_VARIANCE = 'variance'
+SCORE_MAGNITUDE = 'magnitude'
+
+
+class RefineAxis(object):
+    """An integer scan coordinate from start to stop, never split finer than resolution"""
+    def __init__(self, name, start, stop, coarse_steps, resolution=1):
+        self.name = name
+        self.start = start
+        self.stop = stop
+        self.coarse_steps = coarse_steps  # cells along this axis in the initial lattice
+        self.resolution = resolution
+
+    def lattice(self):
+        # coarse lattice values, on the resolution grid
+        values = [self.snap(self.start + (self.stop - self.start) * i // self.coarse_steps)
+                  for i in range(self.coarse_steps + 1)]
+        return sorted(set(values))
+
+    def snap(self, value):
+        return self.start + (value - self.start) // self.resolution * self.resolution
+
+    def midpoint(self, lo, hi):
+        # None if lo..hi can not be split any further
+        if hi - lo <= self.resolution:
+            return None
+        return self.snap((lo + hi) // 2)
+
+
+class Cell(object):
+    """A box of coordinates, measured at its corners"""
+    def __init__(self, bounds, depth=0):
+        self.bounds = bounds    # (lo, hi) per axis
+        self.depth = depth      # number of times split from the coarse lattice
+
+    def corners(self):
+        return list(itertools.product(*[sorted(set(bound)) for bound in self.bounds]))
+
+    def size(self):
+        return sum(hi - lo for lo, hi in self.bounds)
+
+
+class RefineScan(object):
+    """Best first refinement of a scan over axes.
+    point_values(coords) returns the ScanInfo attribute values for a tuple of
+    axis coordinates as a dict, e.g. {'base_frequency': 20000, ...}.
+    """
+    def __init__(self, axes, point_values, score=SCORE_VARIANCE, budget=3600.0):
+        self.axes = axes
+        self.point_values = point_values
+        self.score_method = score
+        self.budget = budget              # seconds, no new point is started past this
+        self.responses = {}               # point values -> response, None if not measured
+        self.pending = collections.deque()    # coords waiting to be measured
+        self.queued = set()               # point values measured or pending
+        self.waiting = []                 # cells whose corners are being measured
+        self.heap = []                    # (-score, -size, seq, cell) of measured cells
+        self.counter = itertools.count()
+        self.current = None               # point values being measured
+        self.start_time = 0.0
+        self.cells_split = 0
+
+    # = Scan engine interface
+    def start(self, scan_info):
+        """Queue the coarse lattice and apply its first point to scan_info"""
+        self.start_time = time.monotonic()
+        lattices = [axis.lattice() for axis in self.axes]
+        for lows in itertools.product(*[range(len(lattice) - 1) for lattice in lattices]):
+            bounds = tuple((lattice[i], lattice[i + 1]) for lattice, i in zip(lattices, lows))
+            self.add_cell(Cell(bounds))
+        scan_info.scan_index = 0
+        self.apply(self.next_point(), scan_info)
+
+    def update_parameters(self, scan_info):
+        """test_update_parameters function: record the point just measured, move to the next"""
+        scan_info.cycle_count += 1
+        self.responses[self.current] = self.response(scan_info)
+        elapsed = time.monotonic() - self.start_time
+        per_point = elapsed / max(len(self.responses), 1)
+        coords = None
+        if elapsed + per_point <= self.budget:
+            coords = self.next_point()
+        if coords is None:
+            scan_info.run_next_test_cycle = False
+            print('Refinement completed, %d points, %d cells split, %.0f s' % (
+                len(self.responses), self.cells_split, elapsed))
+            return
+        scan_info.scan_index += 1
+        self.apply(coords, scan_info)
+
+    def apply(self, coords, scan_info):
+        values = self.point_values(coords)
+        for name, value in values.items():
+            setattr(scan_info, name, value)
+        self.current = self.key(values)
+
+    def response(self, scan_info):
+        # field change for the point just measured, relative to the magnets-off
+        # baseline when one is available, None if the sensor could not be read
+        fields = [(sample.x, sample.y, sample.z) for sample in scan_info.mag_samples
+                  if sample.point == scan_info.scan_index and sample.valid and not sample.sensor]
+        if not fields:
+            return None
+        x, y, z = fields[-1]
+        if scan_info.baseline is not None and scan_info.baseline.ready():
+            mx, my, mz = scan_info.baseline.mean
+            x, y, z = x - mx, y - my, z - mz
+        return math.sqrt(x * x + y * y + z * z)
+
+    # = Refinement
+    def key(self, values):
+        return tuple(sorted(values.items()))
+
+    def add_cell(self, cell):
+        self.waiting.append(cell)
+        for coords in cell.corners():
+            key = self.key(self.point_values(coords))
+            if key not in self.queued:
+                self.queued.add(key)
+                self.pending.append(coords)
+
+    def score(self, cell):
+        values = [self.responses.get(self.key(self.point_values(coords))) for coords in cell.corners()]
+        values = [value for value in values if value is not None]
+        if not values:
+            return 0.0
+        if self.score_method == SCORE_MAGNITUDE:
+            return max(values)
+        mean = sum(values) / len(values)
+        return sum((value - mean) ** 2 for value in values) / len(values)
+
+    def split(self, cell):
+        # halve every axis that is still wider than its resolution
+        choices = []
+        for axis, (lo, hi) in zip(self.axes, cell.bounds):
+            mid = axis.midpoint(lo, hi)
+            choices.append([(lo, hi)] if mid is None else [(lo, mid), (mid, hi)])
+        if all(len(choice) == 1 for choice in choices):
+            return []
+        return [Cell(bounds, cell.depth + 1) for bounds in itertools.product(*choices)]
+
+    def next_point(self):
+        """Coordinates of the next point to measure, None when there is nothing left to refine"""
+        while not self.pending:
+            # corners of the waiting cells are all measured, rank them
+            for cell in self.waiting:
+                heapq.heappush(self.heap, (-self.score(cell), -cell.size(), next(self.counter), cell))
+            self.waiting = []
+            if not self.heap:
+                return None
+            cell = heapq.heappop(self.heap)[3]
+            children = self.split(cell)
+            if children:
+                self.cells_split += 1
+            for child in children:
+                self.add_cell(child)
+        return self.pending.popleft()
@@ -0,0 +1,223 @@
+#!/usr/bin/python
+#
+# Summary:
+# Declarative scan spaces.
+# A scan is described as ranges and products over ScanInfo parameters
+# (frequency, offset, phase, duration ...) instead of hand written update
+# state machines.  Spaces are lazy: len() and access to the k-th point are
+# O(1) (Concat is O(log parts)), so a scan can report exact progress, be split
+# across rigs, or resume at any point without enumerating the points before it.
+#
+# Each point is a tuple of values in the order of space.names, and
+# space.apply(k, scan_info) copies point k onto the matching ScanInfo fields.
+#
+# Example, the test_config_3 scan:
+#   Product(RatioSweep(Range('base_frequency', 20000, 40000), 'offset_frequency', 1, 2),
+#           Range('clock1_phase_offset', 0, 120, 20))
+#
+# MIT Open Source License
+# https://opensource.org/licenses/MIT
+#
+
+import bisect
+import math
+
+
+class ScanSpace(object):
+    """Base class: a finite, indexable sequence of scan points"""
+    names = ()
+
+    def __len__(self):
+        raise NotImplementedError
+
+    def point(self, k):
+        """Values of point k, 0 <= k < len(self)"""
+        raise NotImplementedError
+
+    def __getitem__(self, k):
+        count = len(self)
+        if k < 0:
+            k += count
+        if not 0 <= k < count:
+            raise IndexError('scan point %d out of range (%d points)' % (k, count))
+        return self.point(k)
+
+    def __iter__(self):
+        for k in range(len(self)):
+            yield self.point(k)
+
+    def as_dict(self, k):
+        return dict(zip(self.names, self[k]))
+
+    def apply(self, k, target):
+        """Set the attributes of target (normally a ScanInfo) for point k"""
+        for name, value in zip(self.names, self[k]):
+            setattr(target, name, value)
+
+    def slice(self, start, stop):
+        return Slice(self, start, stop)
+
+    def split(self, parts):
+        """Divide into parts contiguous slices of nearly equal length"""
+        count = len(self)
+        bounds = [count * i // parts for i in range(parts + 1)]
+        return [Slice(self, bounds[i], bounds[i + 1]) for i in range(parts)]
+
+
+class Range(ScanSpace):
+    """name = start, start + step, ... up to and including stop"""
+    def __init__(self, name, start, stop, step=1):
+        if step <= 0:
+            raise ValueError('step must be positive')
+        self.names = (name,)
+        self.start = start
+        self.stop = stop
+        self.step = step
+        self.count = max(0, int((stop - start) // step) + 1)
+
+    def __len__(self):
+        return self.count
+
+    def value(self, k):
+        return self.start + k * self.step
+
+    def point(self, k):
+        return (self.value(k),)
+
+
+class Values(ScanSpace):
+    """An explicit list of values for name"""
+    def __init__(self, name, values):
+        self.names = (name,)
+        self.values = list(values)
+
+    def __len__(self):
+        return len(self.values)
+
+    def point(self, k):
+        return (self.values[k],)
+
+
+class Product(ScanSpace):
+    """Every combination of the given spaces, the last one varying fastest
+    (like nested for loops with the last space innermost)
+    """
+    def __init__(self, *spaces):
+        self.spaces = spaces
+        self.names = tuple(name for space in spaces for name in space.names)
+        self.count = 1
+        for space in spaces:
+            self.count *= len(space)
+
+    def __len__(self):
+        return self.count
+
+    def point(self, k):
+        values = []
+        for space in reversed(self.spaces):
+            k, digit = divmod(k, len(space))
+            values[0:0] = space.point(digit)
+        return tuple(values)
+
+
+class Concat(ScanSpace):
+    """One space after another, all with the same names"""
+    def __init__(self, *spaces):
+        self.spaces = spaces
+        self.names = spaces[0].names
+        for space in spaces:
+            if space.names != self.names:
+                raise ValueError('Concat spaces must have the same names')
+        self.ends = []
+        total = 0
+        for space in spaces:
+            total += len(space)
+            self.ends.append(total)
+
+    def __len__(self):
+        return self.ends[-1] if self.ends else 0
+
+    def point(self, k):
+        part = bisect.bisect_right(self.ends, k)
+        start = self.ends[part - 1] if part > 0 else 0
+        return self.spaces[part].point(k - start)
+
+
+class Slice(ScanSpace):
+    """Points start..stop-1 of another space"""
+    def __init__(self, space, start, stop):
+        self.space = space
+        self.names = space.names
+        self.start = start
+        self.stop = min(stop, len(space))
+
+    def __len__(self):
+        return max(0, self.stop - self.start)
+
+    def point(self, k):
+        return self.space.point(self.start + k)
+
+
+class RatioSweep(ScanSpace):
+    """For each value v of outer (a Range), sweep name from
+    ratio_start * v to ratio_end * v in step increments.
+    Yields (v, inner) pairs.  The number of inner values grows linearly
+    with the outer index, so the k-th point is found by solving a quadratic.
+    """
+    def __init__(self, outer, name, ratio_start=1, ratio_end=2, step=None):
+        if step is None:
+            step = outer.step
+        span = ratio_end - ratio_start
+        if span < 0 or (span * outer.start) % step or (span * outer.step) % step:
+            raise ValueError('RatioSweep needs an integer number of steps for every outer value')
+        self.outer = outer
+        self.names = outer.names + (name,)
+        self.ratio_start = ratio_start
+        self.step = step
+        # inner count for outer index i is first + growth * i
+        self.first = (span * outer.start) // step + 1
+        self.growth = (span * outer.step) // step
+        self.count = self.points_before(len(outer))
+
+    def points_before(self, i):
+        # total points for outer indices 0..i-1
+        return i * self.first + self.growth * i * (i - 1) // 2
+
+    def __len__(self):
+        return self.count
+
+    def inner_count(self, i):
+        # number of inner values for outer index i
+        return self.first + self.growth * i
+
+    def locate(self, k):
+        """Outer and inner index (i, j) of point k"""
+        if self.growth == 0:
+            i = k // self.first
+        else:
+            # largest i with points_before(i) <= k
+            a = self.growth
+            b = 2 * self.first - self.growth
+            i = (math.isqrt(b * b + 8 * a * k) - b) // (2 * a)
+            while self.points_before(i + 1) <= k:
+                i += 1
+            while self.points_before(i) > k:
+                i -= 1
+        return (i, k - self.points_before(i))
+
+    def value(self, i, j):
+        v = self.outer.value(i)
+        return (v, self.ratio_start * v + j * self.step)
+
+    def point(self, k):
+        return self.value(*self.locate(k))
+
+
+def scan_space_3(frequency_start, frequency_end, frequency_step=1):
+    """The test_config_3 scan, same order as test_update_parameters_3.
+    Scan x from frequency_start to frequency_end, for each x step y from x to 2x,
+    for each x-y step the phase 0..120 counts of 240 (0..180 degrees) by 20.
+    """
+    return Product(RatioSweep(Range('base_frequency', frequency_start, frequency_end, frequency_step),
+                              'offset_frequency', 1, 2),
+                   Range('clock1_phase_offset', 0, 120, 20))
@@ -0,0 +1,161 @@
+#!/usr/bin/python
+#
+# Summary:
+# Worker for scan_coordinator.py, one per rig.
+# Repeatedly takes a lease (a range of scan points) from the coordinator,
+# measures it and sends back the mag_profile.csv rows.  A heartbeat keeps
+# the lease alive while it is being measured.
+#
+# On a rig the points are measured by the mag_scan engine using the devices
+# and options from mag_scan.make_scan_info.  With --simulate the same engine
+# runs on the simulated rig from mag_sim.py (virtual time, fake devices, no
+# hardware), so the coordinator can be tried out with several local workers:
+#   python scan_coordinator.py --frequency-start 100 --frequency-end 110 --lease-size 500 &
+#   for rig in a b c; do python scan_worker.py --rig $rig --simulate --frequency-start 100 --frequency-end 110 & done
+#
+# MIT Open Source License
+# https://opensource.org/licenses/MIT
+#
+
+import argparse
+import random
+import socket
+import threading
+import time
+
+from mag_scan_info import csv_row
+from scan_coordinator import COORDINATOR_PORT, request
+from scan_space import scan_space_3
+
+
+class RigMeasure(object):
+    """Measure leases with the mag_scan engine on this rig's hardware.
+    space replaces the scan space of make_scan_info, e.g. to match the coordinator's.
+    """
+    def __init__(self, space=None):
+        # imported here so simulated rigs can install their fake devices first
+        import mag_scan
+        self.mag_scan = mag_scan
+        self.scan_info = mag_scan.make_scan_info()
+        if space is not None:
+            self.scan_info.scan_space = space
+        self.space = self.scan_info.scan_space
+
+    def measure(self, start, stop):
+        scan_info = self.scan_info
+        rows = []
+        scan_info.sample_sink = lambda samples: rows.extend(csv_row(sample) for sample in samples)
+        scan_info.run_next_test_cycle = True
+        scan_info.scan_index = scan_info.scan_start_index = start
+        scan_info.scan_stop_index = stop
+        scan_info.scan_space.apply(start, scan_info)
+        self.mag_scan.run_scan(scan_info, progress_interval=1.0)
+        return rows
+
+
+def simulate_rig(seed, frequency_start):
+    # put mag_sim.py's virtual rig in place of the hardware libraries, before mag_scan is imported
+    from mag_sim import Simulation, make_anomalies
+    sim = Simulation(seed=seed, anomalies=make_anomalies(5, random.Random(seed + 1), frequency_start))
+    sim.install()
+    import mag_scan
+    import mag_sensor
+    import mag_sensor_array
+    import scan_refine
+    sim.patch(mag_scan, mag_sensor, mag_sensor_array, scan_refine)
+    return sim
+
+
+class Heartbeat(object):
+    """Renews a lease in the background while it is being measured"""
+    def __init__(self, address, rig, lease_id, interval):
+        self.address = address
+        self.message = {'op': 'heartbeat', 'rig': rig, 'lease': lease_id}
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.lost = False
+        self.thread = threading.Thread(target=self.run, name='Heartbeat')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                if request(self.address, self.message).get('op') == 'lost':
+                    self.lost = True
+            except (IOError, socket.error) as error:
+                print('Heartbeat failed: %s' % error)
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+
+class ScanWorker(object):
+    def __init__(self, address, rig, measure, retry_delay=5.0):
+        self.address = address
+        self.rig = rig
+        self.measure = measure
+        self.retry_delay = retry_delay
+        self.leases = 0
+        self.points = 0
+
+    def send(self, message):
+        # keep trying while the coordinator is unreachable (restarting)
+        while True:
+            try:
+                return request(self.address, message)
+            except (IOError, socket.error) as error:
+                print('%s: coordinator %s:%d unreachable (%s), retrying' % (
+                    self.rig, self.address[0], self.address[1], error))
+                time.sleep(self.retry_delay)
+
+    def run(self):
+        start_time = time.time()
+        while True:
+            reply = self.send({'op': 'lease', 'rig': self.rig})
+            if reply['op'] == 'done':
+                break
+            if reply['op'] == 'wait':
+                time.sleep(reply['seconds'])
+                continue
+            if reply['op'] != 'lease':
+                raise SystemExit('%s: unexpected reply %r' % (self.rig, reply))
+            if reply['points'] != len(self.measure.space):
+                raise SystemExit('%s: coordinator scan has %d points, this rig has %d' % (
+                    self.rig, reply['points'], len(self.measure.space)))
+            heartbeat = Heartbeat(self.address, self.rig, reply['lease'], reply['timeout'] / 3.0)
+            try:
+                rows = self.measure.measure(reply['start'], reply['stop'])
+            finally:
+                heartbeat.stop()
+            if heartbeat.lost:
+                print('%s: lease %d timed out while measuring, sending results anyway' % (self.rig, reply['lease']))
+            self.send({'op': 'result', 'rig': self.rig, 'lease': reply['lease'], 'rows': rows})
+            self.leases += 1
+            self.points += reply['stop'] - reply['start']
+        elapsed = time.time() - start_time
+        print('%s: %d leases, %d points in %.1f s' % (self.rig, self.leases, self.points, elapsed))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Measure scan leases handed out by scan_coordinator.py')
+    parser.add_argument('--host', default='localhost', help='coordinator address')
+    parser.add_argument('--port', type=int, default=COORDINATOR_PORT)
+    parser.add_argument('--rig', default=socket.gethostname(), help='name recorded with every row')
+    parser.add_argument('--simulate', action='store_true', help='measure on the simulated rig of mag_sim.py')
+    parser.add_argument('--seed', type=int, default=1, help='simulated rig noise and anomalies')
+    parser.add_argument('--frequency-start', type=int, default=20000, help='simulated scan, as the coordinator')
+    parser.add_argument('--frequency-end', type=int, default=40000)
+    parser.add_argument('--frequency-step', type=int, default=1)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.simulate:
+        simulate_rig(args.seed, args.frequency_start)
+        measure = RigMeasure(scan_space_3(args.frequency_start, args.frequency_end, args.frequency_step))
+    else:
+        measure = RigMeasure()
+    ScanWorker((args.host, args.port), args.rig, measure).run()
@@ -0,0 +1,22 @@
+# The modules are flat at the top of the repository, make them importable from tests/
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def sim():
+    """A fresh simulated rig (mag_sim.py) with the hardware modules running on it"""
+    from mag_sim import Simulation
+    simulation = Simulation(seed=1)
+    simulation.install()
+    import PhaseShifter
+    import Si5351_clock
+    import mag_scan
+    import mag_sensor
+    import mag_sensor_array
+    simulation.patch(PhaseShifter, Si5351_clock, mag_scan, mag_sensor, mag_sensor_array)
+    return simulation
@@ -0,0 +1,37 @@
+# An adaptive pause follows a step in the ambient field instead of timing out for the rest of the scan
+
+import argparse
+import csv
+
+
+def test_baseline_follows_ambient_step(sim, tmp_path, monkeypatch):
+    import mag_scan
+    monkeypatch.chdir(tmp_path)
+    resume_state, scan_info = mag_scan.make_run(argparse.Namespace(resume=False, format='csv'))
+    scan_info.adaptive_dwell = True
+    scan_info.adaptive_pause = True
+    end_burst = mag_scan.end_burst
+    step_point = []
+
+    def stepping_end_burst(scan_info):
+        end_burst(scan_info)
+        if not step_point and scan_info.scan_index >= 40:
+            # a car parks next to the rig
+            x, y, z = sim.field_model.earth
+            sim.field_model.earth = (x + 60.0, y - 40.0, z + 80.0)
+            step_point.append(scan_info.scan_index)
+
+    monkeypatch.setattr(mag_scan, 'end_burst', stepping_end_burst)
+    sim.stop_after(240.0)
+    mag_scan.run_test_sequence(resume_state, scan_info, progress_interval=600.0)
+    assert step_point
+    with open(mag_scan.DATA_FILE) as fh:
+        rows = [row for row in csv.DictReader(fh) if int(row['point']) > step_point[0]]
+    # a few pauses time out while the baseline is rebuilt, then they are short again
+    late = rows[len(rows) // 2:]
+    assert len(late) >= 20
+    assert all(float(row['pause']) < 0.5 * scan_info.cycle_pause for row in late)
+    assert 0 < scan_info.pause_timeouts <= 5
+    # the baseline is the new ambient field, give or take the die temperature drift
+    for axis, value in enumerate(sim.field_model.earth):
+        assert abs(scan_info.baseline.mean[axis] - value) < 10.0
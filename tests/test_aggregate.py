@@ -0,0 +1,77 @@
+# Response maps of a small simulated scan in every result format, with one
+# and with several worker processes, against the cells computed row by row
+
+import argparse
+import math
+
+import pytest
+
+from mag_scan_info import CSV_HEADER, csv_row
+
+numpy = pytest.importorskip('numpy')
+
+FORMATS = ['csv', 'columnar', 'chunked']
+GROUP = ['freq_x', 'freq_z', 'clock1_phase']
+
+
+def scan(sim, result_format, seconds=300.0):
+    # returns the path of the result file
+    import mag_scan
+    resume_state, scan_info = mag_scan.make_run(argparse.Namespace(resume=False, format=result_format))
+    sim.stop_after(seconds)
+    mag_scan.run_test_sequence(resume_state, scan_info, progress_interval=600.0)
+    return {'csv': mag_scan.DATA_FILE, 'columnar': mag_scan.COLUMNAR_DIR, 'chunked': mag_scan.CHUNKED_FILE}[result_format]
+
+
+def stored_rows(result_format, path):
+    # every stored sample as a dict of its csv columns
+    import mag_chunked
+    import mag_columnar
+    if result_format == 'columnar':
+        lines = [csv_row(sample) for sample in mag_columnar.ColumnarData(path).samples()]
+    elif result_format == 'chunked':
+        data = mag_chunked.ChunkedData(path)
+        lines = [csv_row(sample) for sample in data.samples()]
+        data.close()
+    else:
+        with open(path) as fh:
+            lines = [line.rstrip('\n') for line in fh][1:]
+    names = CSV_HEADER.split(',')
+    return [dict(zip(names, line.split(','))) for line in lines]
+
+
+def row_cells(rows):
+    # {key: (count, b_mean, dz_mean)} of the main sensor's valid readings
+    sums = {}
+    for row in rows:
+        if row['mag_x'] == '' or row['sensor'] != '':
+            continue
+        x, y, z = [float(row[name]) for name in ('mag_x', 'mag_y', 'mag_z')]
+        key = tuple(float(row[name]) for name in GROUP)
+        count, b, dz = sums.get(key, (0, 0.0, 0.0))
+        sums[key] = (count + 1, b + math.sqrt(x * x + y * y + z * z), dz + z)
+    return dict((key, (count, b / count, dz / count)) for key, (count, b, dz) in sums.items())
+
+
+def aggregate_cells(path, workers):
+    # small chunks so every worker gets several tasks
+    from mag_aggregate import aggregate
+    response = aggregate(path, GROUP, workers=workers, chunk_rows=64, chunk_bytes=2048)
+    stats, baseline = response.statistics((0.0, 0.0, 0.0))
+    return dict((tuple(float(value) for value in response.keys[i]),
+                 (int(stats['count'][i]), stats['b_mean'][i], stats['dz_mean'][i]))
+                for i in range(len(response.keys)))
+
+
+@pytest.mark.parametrize('result_format', FORMATS)
+def test_cells_match_rows(sim, tmp_path, monkeypatch, result_format):
+    monkeypatch.chdir(tmp_path)
+    path = scan(sim, result_format)
+    expected = row_cells(stored_rows(result_format, path))
+    assert len(expected) > 10
+    for workers in (1, 2):
+        found = aggregate_cells(path, workers)
+        assert sorted(found) == sorted(expected)
+        for key, (count, b_mean, dz_mean) in expected.items():
+            assert found[key][0] == count
+            assert found[key][1:] == pytest.approx((b_mean, dz_mean))
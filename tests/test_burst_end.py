@@ -0,0 +1,34 @@
+# samples record the end of their own burst, also when read while the field is still on
+
+
+def burst_scan_info(sim):
+    from mag_scan import make_scan_info
+    scan_info = make_scan_info()
+    scan_info.detector = None
+    scan_info.telemetry = None
+    return scan_info
+
+
+def test_reading_before_the_field_goes_off(sim):
+    from mag_scan import add_sample, make_sample, start_field, turn_off_field
+    scan_info = burst_scan_info(sim)
+    start_field(scan_info)
+    sim.scheduler.run_until(sim.clock.monotonic_ns() + 100000000)
+    turn_off_field(scan_info)
+    first_end_ns = scan_info.burst_end_ns
+    start_field(scan_info)
+    # read during the burst, before end_burst
+    add_sample(scan_info, make_sample(scan_info, (1, 2, 3)))
+    # taken before the field went off, added after
+    late = make_sample(scan_info, (4, 5, 6))
+    sim.scheduler.run_until(sim.clock.monotonic_ns() + 100000000)
+    turn_off_field(scan_info)
+    add_sample(scan_info, late)
+    # read once the field is off
+    add_sample(scan_info, make_sample(scan_info, (7, 8, 9)))
+    samples = list(scan_info.mag_samples)
+    assert len(samples) == 3
+    for sample in samples:
+        assert sample.burst_start_ns == scan_info.burst_start_ns
+        assert sample.burst_end_ns == scan_info.burst_end_ns
+        assert sample.burst_end_ns != first_end_ns
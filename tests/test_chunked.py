@@ -0,0 +1,80 @@
+# Chunked result file: commits, crash windows and resume
+
+from mag_chunked import ChunkedData, ChunkedStore, compact, create_chunked, truncate_chunked
+from mag_scan_info import MagSample
+
+
+def samples(first, count):
+    result = []
+    for point in range(first, first + count):
+        sample = MagSample(point, -point, 2 * point)
+        sample.f0 = 20000
+        sample.f1 = 20000 + point
+        sample.point = point
+        result.append(sample)
+    return result
+
+
+def points(path):
+    data = ChunkedData(path)
+    result = [sample.point for sample in data.samples()]
+    assert data.verify() == []
+    data.close()
+    return result
+
+
+def test_commit_after_checkpoint_keeps_checkpointed_rows(tmp_path):
+    # a crash after a later commit's fsync but before its checkpoint replace
+    path = str(tmp_path / 'mag_profile.chk')
+    create_chunked(path, 64)
+    store = ChunkedStore(path)
+    store.append(samples(0, 100))
+    checkpoint_length = store.sync()
+    store.append(samples(100, 50))
+    store.sync()
+    store.close()
+    truncate_chunked(path, checkpoint_length)
+    assert points(path) == list(range(100))
+
+
+def test_every_checkpoint_length_is_a_consistent_prefix(tmp_path):
+    path = str(tmp_path / 'mag_profile.chk')
+    create_chunked(path, 16)
+    store = ChunkedStore(path)
+    lengths = []
+    rows = 0
+    for count in (5, 7, 3, 20, 1, 40, 9):
+        store.append(samples(rows, count))
+        rows += count
+        lengths.append((store.sync(), rows))
+    store.close()
+    with open(path, 'rb') as fh:
+        data = fh.read()
+    for length, rows in lengths:
+        copy = str(tmp_path / 'copy.chk')
+        with open(copy, 'wb') as fh:
+            fh.write(data)
+        truncate_chunked(copy, length)
+        assert points(copy) == list(range(rows))
+
+
+def test_resume_continues_after_truncate(tmp_path):
+    path = str(tmp_path / 'mag_profile.chk')
+    create_chunked(path, 64)
+    store = ChunkedStore(path)
+    store.append(samples(0, 100))
+    checkpoint_length = store.sync()
+    store.append(samples(100, 50))
+    store.sync()
+    store.close()
+    truncate_chunked(path, checkpoint_length)
+    store = ChunkedStore(path)
+    store.append(samples(100, 200))
+    store.close()
+    assert points(path) == list(range(300))
+    compacted = str(tmp_path / 'compacted.chk')
+    assert compact(path, compacted) == 300
+    assert points(compacted) == list(range(300))
+    data = ChunkedData(compacted)
+    assert len(data.stored_chunks) == len(data.chunks)
+    data.close()
@@ -0,0 +1,48 @@
+import os
+
+from scan_coordinator import ScanCoordinator
+from scan_space import scan_space_3
+
+
+def coordinator(tmp_path, resume=False):
+    return ScanCoordinator(scan_space_3(100, 101, 1), output=str(tmp_path / 'merged.csv'), lease_size=100,
+                           resume=resume)
+
+
+def lease_rows(start, stop):
+    return ['row%d' % k for k in range(start, stop)]
+
+
+def test_resume_keeps_only_marked_leases(tmp_path):
+    first = coordinator(tmp_path)
+    for rig in ('a', 'b'):
+        lease = first.handle({'op': 'lease', 'rig': rig})
+        assert first.handle({'op': 'result', 'rig': rig, 'lease': lease['lease'],
+                             'rows': lease_rows(lease['start'], lease['stop'])}) == {'op': 'ok'}
+    complete_length = os.path.getsize(first.output)
+    # crash while lease 2 was written: some of its rows made it to disk, its marker only partly
+    fh = open(first.output, 'a')
+    fh.write('row200,c,2\nrow2')
+    fh.close()
+    fh = open(first.leases_path, 'a')
+    fh.write('2,99')
+    fh.close()
+    resumed = coordinator(tmp_path, resume=True)
+    assert resumed.completed == {0, 1}
+    assert resumed.done_points == 200
+    assert os.path.getsize(resumed.output) == complete_length
+    lease = resumed.handle({'op': 'lease', 'rig': 'c'})
+    assert lease['lease'] == 2
+    # a lease id in the rows is not enough, the lease is measured again
+    resumed.handle({'op': 'result', 'rig': 'c', 'lease': 2, 'rows': lease_rows(200, 300)})
+    lines = open(resumed.output).read().splitlines()[1:]
+    assert [line.split(',')[0] for line in lines] == lease_rows(0, 300)
+
+
+def test_duplicate_result_is_ignored(tmp_path):
+    scan = coordinator(tmp_path)
+    lease = scan.handle({'op': 'lease', 'rig': 'a'})
+    rows = lease_rows(lease['start'], lease['stop'])
+    scan.handle({'op': 'result', 'rig': 'a', 'lease': lease['lease'], 'rows': rows})
+    assert scan.handle({'op': 'result', 'rig': 'b', 'lease': lease['lease'], 'rows': rows})['duplicate']
+    assert len(open(scan.leases_path).read().splitlines()) == 1
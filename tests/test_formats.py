@@ -0,0 +1,98 @@
+# Every result format on the simulated rig: an interrupted scan, rows written
+# after its checkpoint, a resume, and a round trip through mag_profile.csv
+
+import argparse
+
+import pytest
+
+from mag_scan_info import MagSample, csv_row
+
+FORMATS = ['csv', 'columnar', 'chunked']
+STRAY_X = 12345     # field of the rows written after the checkpoint
+
+
+def read_rows(result_format):
+    # csv_row of every stored sample, in order
+    import mag_chunked
+    import mag_columnar
+    import mag_scan
+    if result_format == 'columnar':
+        return [csv_row(sample) for sample in mag_columnar.ColumnarData(mag_scan.COLUMNAR_DIR).samples()]
+    if result_format == 'chunked':
+        data = mag_chunked.ChunkedData(mag_scan.CHUNKED_FILE)
+        rows = [csv_row(sample) for sample in data.samples()]
+        assert data.verify() == []
+        data.close()
+        return rows
+    with open(mag_scan.DATA_FILE) as fh:
+        return [line.rstrip('\n') for line in fh][1:]
+
+
+def run(sim, result_format, resume, seconds):
+    import mag_scan
+    args = argparse.Namespace(resume=resume, format=result_format)
+    resume_state, scan_info = mag_scan.make_run(args)
+    sim.stop_after(seconds)
+    mag_scan.run_test_sequence(resume_state, scan_info, progress_interval=600.0)
+    return scan_info.scan_index
+
+
+def write_stray_rows(result_format, first_point, count):
+    # a commit that reached the disk without its checkpoint, as if the scan crashed then
+    import mag_scan
+    store = mag_scan.open_store(result_format)
+    stray = []
+    for point in range(first_point, first_point + count):
+        sample = MagSample(STRAY_X, 0, 0)
+        sample.point = point
+        stray.append(sample)
+    store.append(stray)
+    store.sync()
+    store.close()
+
+
+@pytest.mark.parametrize('result_format', FORMATS)
+def test_truncate_and_resume(sim, tmp_path, monkeypatch, result_format):
+    from mag_checkpoint import read_checkpoint
+    import mag_scan
+    monkeypatch.chdir(tmp_path)
+    first_stop = run(sim, result_format, False, 30.0)
+    assert first_stop > 0
+    checkpoint = read_checkpoint(mag_scan.CHECKPOINT_FILE)
+    assert checkpoint['scan_index'] == first_stop
+    first_rows = read_rows(result_format)
+    assert sorted(set(int(row.rsplit(',', 1)[1]) for row in first_rows)) == list(range(first_stop))
+    write_stray_rows(result_format, first_stop, 7)
+    second_stop = run(sim, result_format, True, 30.0)
+    assert second_stop > first_stop
+    rows = read_rows(result_format)
+    assert rows[:len(first_rows)] == first_rows
+    points = [int(row.rsplit(',', 1)[1]) for row in rows]
+    assert points == sorted(points)
+    assert sorted(set(points)) == list(range(second_stop))
+    assert not [row for row in rows if row.split(',')[5] == str(STRAY_X)]
+
+
+@pytest.mark.parametrize('result_format', ['columnar', 'chunked'])
+def test_csv_round_trip(sim, tmp_path, monkeypatch, result_format):
+    import mag_chunked
+    import mag_columnar
+    import mag_scan
+    monkeypatch.chdir(tmp_path)
+    run(sim, result_format, False, 20.0)
+    rows = read_rows(result_format)
+    module = mag_columnar if result_format == 'columnar' else mag_chunked
+    path = mag_scan.COLUMNAR_DIR if result_format == 'columnar' else mag_scan.CHUNKED_FILE
+    assert module.export_csv(path, 'exported.csv') == len(rows)
+    with open('exported.csv') as fh:
+        exported = [line.rstrip('\n') for line in fh][1:]
+    assert exported == rows
+    copy = 'copy' + path[path.index('.'):]
+    assert module.import_csv('exported.csv', copy) == len(rows)
+    if result_format == 'columnar':
+        copied = [csv_row(sample) for sample in mag_columnar.ColumnarData(copy).samples()]
+    else:
+        data = mag_chunked.ChunkedData(copy)
+        copied = [csv_row(sample) for sample in data.samples()]
+        data.close()
+    assert copied == rows
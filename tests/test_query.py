@@ -0,0 +1,87 @@
+# ScanIndex kept up to date batch by batch answers like a scan of every row
+
+import random
+
+from mag_columnar import ColumnarData, ColumnarStore, create_columnar, truncate_columnar
+from mag_query import INDEX_COLUMNS, ScanIndex, ScanQuery
+from mag_scan_info import MagSample
+
+ATTRIBUTES = {'freq_x': 'f0', 'freq_y': 'f1', 'freq_z': 'f2', 'clock1_phase': 'clock1_phase_offset',
+              'clock2_phase': 'clock2_phase_offset'}
+
+
+def random_samples(rng, first_point, count):
+    result = []
+    for point in range(first_point, first_point + count):
+        sample = MagSample(rng.randint(-50, 50), rng.randint(-50, 50), rng.randint(-50, 50))
+        sample.f0 = rng.randint(20000, 20020)
+        sample.f1 = rng.randint(20000, 40000)
+        sample.f2 = rng.choice((0, 100, 200))
+        sample.clock1_phase_offset = rng.randint(0, 180)
+        sample.clock2_phase_offset = rng.randint(0, 180)
+        sample.point = point
+        result.append(sample)
+    return result
+
+
+def brute_force(path, ranges):
+    rows = []
+    for row, sample in enumerate(ColumnarData(path).samples()):
+        if all(lo <= getattr(sample, ATTRIBUTES[name]) <= hi for name, (lo, hi) in ranges.items()):
+            rows.append(row)
+    return rows
+
+
+def check_queries(path, rng, queries=20):
+    query = ScanQuery(path, update=False)
+    try:
+        for i in range(queries):
+            ranges = {}
+            for name in rng.sample(INDEX_COLUMNS, rng.randint(1, 3)):
+                lo = {'freq_x': 20000, 'freq_y': 20000, 'freq_z': 0}.get(name, 0)
+                hi = {'freq_x': 20020, 'freq_y': 40000, 'freq_z': 200}.get(name, 180)
+                a, b = sorted((rng.randint(lo, hi), rng.randint(lo, hi)))
+                ranges[name] = (a, b)
+            assert query.find(ranges) == brute_force(path, ranges)
+    finally:
+        query.close()
+
+
+def test_incremental_index_matches_brute_force(tmp_path):
+    rng = random.Random(3)
+    path = str(tmp_path / 'mag_profile.col')
+    create_columnar(path)
+    store = ColumnarStore(path)
+    index = ScanIndex(path)
+    rows = 0
+    for count in (50, 10, 10, 200, 1, 37, 120, 5):
+        store.append(random_samples(rng, rows, count))
+        rows = store.sync()
+        assert index.update() == count
+        # runs are merged as they go, the number stays logarithmic
+        assert all(len(runs) <= rows.bit_length() for runs in index.state['runs'].values())
+        check_queries(path, rng)
+    store.close()
+    # reopened, nothing new to index
+    assert ScanIndex(path).update() == 0
+
+
+def test_index_rebuilt_after_truncate(tmp_path):
+    rng = random.Random(4)
+    path = str(tmp_path / 'mag_profile.col')
+    create_columnar(path)
+    store = ColumnarStore(path)
+    store.append(random_samples(rng, 0, 300))
+    store.sync()
+    store.close()
+    ScanIndex(path).update()
+    # resume cuts the result set back, then carries on
+    truncate_columnar(path, 120)
+    store = ColumnarStore(path)
+    store.append(random_samples(rng, 120, 80))
+    store.sync()
+    store.close()
+    index = ScanIndex(path)
+    assert index.update() == 200
+    assert index.state['indexed_rows'] == 200
+    check_queries(path, rng)
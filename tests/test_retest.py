@@ -0,0 +1,136 @@
+# RetestQueue outcomes and burst budget, and re-tests on the simulated rig
+
+import argparse
+import csv
+import json
+
+from mag_retest import (OUTCOME_CONFIRMED, OUTCOME_INCONCLUSIVE, OUTCOME_REJECTED, ROLE_CONTROL, ROLE_REPLICATE,
+                        Retest, RetestQueue)
+from mag_adaptive import BaselineTracker
+from mag_checkpoint import checkpoint_state, restore_state
+from mag_scan_info import ScanInfo
+from scan_space import scan_space_3
+
+
+def retest_queue(tmp_path, **options):
+    return RetestQueue(scan_space_3(20000, 20010, 1), str(tmp_path / 'mag_retest.csv'), report=lambda text: None,
+                       **options)
+
+
+def measured(replicates, controls):
+    retest = Retest(0, 5.0, 'test', '', len(replicates))
+    retest.bursts[ROLE_REPLICATE] = replicates
+    retest.bursts[ROLE_CONTROL] = controls
+    return retest
+
+
+def test_evaluate(tmp_path):
+    queue = retest_queue(tmp_path)
+    controls = [(100.0, 0.0, 0.0), (101.0, 1.0, 0.0), (99.0, -1.0, 1.0)]
+    # a clear difference on z
+    outcome, differences, statistics = queue.evaluate(measured([(100.0, 0.0, 20.0), (101.0, 0.0, 21.0),
+                                                                (100.0, 1.0, 19.0)], controls))
+    assert outcome == OUTCOME_CONFIRMED
+    assert round(differences[2], 2) == 19.67
+    # significant but below the effect size
+    outcome, differences, statistics = queue.evaluate(measured([(103.5, 0.0, 0.0), (104.5, 0.0, 0.0),
+                                                                (102.5, 0.0, 0.0)], controls))
+    assert outcome == OUTCOME_REJECTED
+    assert abs(statistics[0]) >= queue.t_limit
+    # large but noisy
+    outcome, differences, statistics = queue.evaluate(measured([(80.0, 0.0, 0.0), (140.0, 0.0, 0.0),
+                                                                (110.0, 0.0, 0.0)], controls))
+    assert outcome == OUTCOME_REJECTED
+    assert abs(differences[0]) >= queue.effect
+    outcome, differences, statistics = queue.evaluate(measured([(150.0, 0.0, 0.0)], controls))
+    assert outcome == OUTCOME_INCONCLUSIVE
+    assert differences is None
+    queue.close()
+
+
+def test_queue_keeps_the_strongest(tmp_path):
+    queue = retest_queue(tmp_path, max_queue=3)
+    for point, priority in enumerate((5.0, 1.0, 7.0, 3.0, 6.0)):
+        queue.flag(point, priority, 'test')
+    queue.flag(2, 9.0, 'again')    # already seen
+    assert queue.counts['flagged'] == 5
+    assert queue.counts['dropped'] == 2
+    assert sorted(retest.point for priority, sequence, retest in queue.heap) == [0, 2, 4]
+    queue.close()
+
+
+def test_checkpoint_keeps_the_queue(tmp_path):
+    scan_info = ScanInfo()
+    scan_info.scan_space = scan_space_3(20000, 20010, 1)
+    scan_info.baseline = BaselineTracker()
+    scan_info.baseline.add(1.0, 2.0, 3.0)
+    scan_info.retest = retest_queue(tmp_path)
+    for point, priority in enumerate((5.0, 1.0, 7.0)):
+        scan_info.retest.flag(point, priority, 'test')
+    scan_info.retest.next_step(ScanInfo())     # point 2 in progress
+    state = checkpoint_state(scan_info)
+    # the writer thread saves it later, the scan keeps going meanwhile
+    scan_info.baseline.add(100.0, 200.0, 300.0)
+    assert state['baseline']['mean'] == [1.0, 2.0, 3.0]
+    scan_info.retest.close()
+    resumed = ScanInfo()
+    resumed.scan_space = scan_info.scan_space
+    resumed.baseline = BaselineTracker()
+    restore_state(resumed, json.loads(json.dumps(state)))
+    queue = retest_queue(tmp_path)
+    queue.restore(resumed.retest_state)
+    assert [retest.point for priority, sequence, retest in sorted(queue.heap)] == [2, 0, 1]
+    queue.flag(1, 9.0, 'again')    # already seen
+    assert queue.pending() == 3
+    assert queue.counts['flagged'] == 0
+    queue.close()
+
+
+def test_budget(tmp_path):
+    # update_parameters' calls, flagging a point every other scan burst
+    queue = retest_queue(tmp_path, replicates=2, max_share=0.25)
+    scan_info = ScanInfo()
+    scan_bursts = 0
+    for point in range(200):
+        if point % 2 == 0:
+            queue.flag(1000 + point, 1.0, 'test')
+        while queue.next_step(scan_info):
+            # a re-test is only started within budget, then runs all of its bursts
+            assert queue.retest_bursts <= queue.max_share * queue.bursts + 2 * queue.replicates
+        scan_bursts += 1
+        assert queue.bursts - queue.retest_bursts == scan_bursts
+    assert queue.pending() > 0
+    # once the scan's points are done the rest is measured whatever the share
+    queue.scan_finished = True
+    while queue.next_step(scan_info):
+        pass
+    assert queue.pending() == 0 and not queue.active()
+    done = queue.counts[OUTCOME_INCONCLUSIVE]
+    assert done == queue.counts['flagged'] - queue.counts['dropped']
+    assert queue.retest_bursts == 2 * 2 * done
+    queue.close()
+    with open(str(tmp_path / 'mag_retest.csv')) as fh:
+        assert len(list(csv.DictReader(fh))) == done
+
+
+def test_anomaly_confirmed_on_the_rig(sim, tmp_path, monkeypatch):
+    from mag_sim import Anomaly
+    import mag_scan
+    monkeypatch.chdir(tmp_path)
+    sim.field_model.anomalies = [Anomaly(20000, 20004, width=2.0, amplitude=40.0, direction=(0.0, 0.0, 1.0))]
+    resume_state, scan_info = mag_scan.make_run(argparse.Namespace(resume=False, format='csv'))
+    scan_info.adaptive_dwell = True
+    scan_info.retest_anomalies = True
+    sim.stop_after(200.0)
+    mag_scan.run_test_sequence(resume_state, scan_info, progress_interval=600.0)
+    with open(mag_scan.RETEST_FILE) as fh:
+        outcomes = list(csv.DictReader(fh))
+    confirmed = [row for row in outcomes if row['outcome'] == OUTCOME_CONFIRMED]
+    assert confirmed
+    for row in confirmed:
+        assert abs(int(row['freq_z']) - 20004) <= 6
+        assert abs(float(row['diff_z'])) >= 4.0
+    # replicate and control readings are not scan results
+    with open(mag_scan.DATA_FILE) as fh:
+        points = [int(row['point']) for row in csv.DictReader(fh)]
+    assert points == sorted(points)
@@ -0,0 +1,50 @@
+# A scan step that raises stops the scan with the field off
+
+import argparse
+import time
+
+import pytest
+
+from mag_scheduler import DeadlineScheduler
+
+
+def test_error_stops_the_scheduler():
+    scheduler = DeadlineScheduler(spin_ns=0)
+    scheduler.start()
+    fired = []
+
+    def fail():
+        raise ValueError('step failed')
+
+    scheduler.call_after(0.0, fail)
+    scheduler.call_after(0.05, fired.append, [1])
+    scheduler.thread.join(2.0)
+    assert not scheduler.thread.is_alive()
+    assert not scheduler.running
+    with pytest.raises(ValueError):
+        scheduler.check()
+    time.sleep(0.1)
+    assert fired == []
+
+
+def test_scan_stops_when_end_burst_raises(sim, tmp_path, monkeypatch):
+    import mag_scan
+    monkeypatch.chdir(tmp_path)
+    end_burst = mag_scan.end_burst
+    calls = []
+
+    def failing_end_burst(scan_info):
+        calls.append(scan_info.scan_index)
+        if len(calls) == 3:
+            raise IOError('bus error ending the burst')
+        end_burst(scan_info)
+
+    monkeypatch.setattr(mag_scan, 'end_burst', failing_end_burst)
+    resume_state, scan_info = mag_scan.make_run(argparse.Namespace(resume=False, format='csv'))
+    sim.stop_after(3600.0)
+    start_ns = sim.clock.monotonic_ns()
+    with pytest.raises(IOError):
+        mag_scan.run_scan(scan_info, progress_interval=600.0)
+    # stopped right away, not at the next progress line, and with the coils off
+    assert sim.clock.monotonic_ns() - start_ns < 10 * 1e9
+    assert sim.drive() is None
@@ -0,0 +1,74 @@
+import time
+
+# the hardware modules import only once the sim fixture has installed the fake rig
+
+
+def settle(sim):
+    # let every active sensor finish a conversion
+    sim.scheduler.run_until(sim.clock.monotonic_ns() + 50000000)
+
+
+def test_direct_sensor_not_shadowed_by_mux(sim):
+    # scan_info.mag_sensor and the array share the default bus, the array has multiplexed sensors there too
+    from mag_sensor import MagneticSensor
+    from mag_sensor_array import MagneticSensorArray, SensorPosition
+    sim.add_array_sensor(-1, channel=0, offset=(1000.0, 0.0, 0.0))
+    sim.add_array_sensor(-1, channel=1, offset=(2000.0, 0.0, 0.0))
+    mag_sensor = MagneticSensor(busnum=-1)
+    array = MagneticSensorArray([SensorPosition('left', busnum=-1, channel=0),
+                                 SensorPosition('right', busnum=-1, channel=1),
+                                 SensorPosition('center', busnum=-1)])
+    settle(sim)
+    for burst in range(3):
+        readings = dict((reading.name, reading.field) for reading in array.readAll())
+        direct = mag_sensor.readMagneticField()
+        assert abs(readings['left'][0] - direct[0] - 1000) < 50
+        assert abs(readings['right'][0] - direct[0] - 2000) < 50
+        assert abs(readings['center'][0] - direct[0]) < 50
+        assert sim.bus.devices[(-1, 0x70)].channel is None
+        settle(sim)
+    array.close()
+
+
+def test_recovery_selects_its_channel(sim):
+    from mag_sensor_array import MagneticSensorArray, SensorPosition
+    sim.add_array_sensor(-1, channel=0)
+    sim.add_array_sensor(-1, channel=1)
+    devices = [sim.bus.muxed[(-1, channel, 0x0E)] for channel in (0, 1)]
+    array = MagneticSensorArray([SensorPosition('left', busnum=-1, channel=0),
+                                 SensorPosition('right', busnum=-1, channel=1)])
+    settle(sim)
+    # both reads fail and the sensors drop to standby, as after a brownout
+    sim.error_rate = 1.0
+    assert [reading.field for reading in array.readAll()] == [None, None]
+    sim.error_rate = 0.0
+    for device in devices:
+        device.active = False
+    sensors = array.buses[0].sensors
+    for step in range(1000):
+        if not any(sensor.recovering for sensor in sensors):
+            break
+        # virtual time for the recovery threads' back off
+        sim.scheduler.run_until(sim.clock.monotonic_ns() + 10000000)
+        time.sleep(0.001)
+    assert [sensor.recoveryCount for sensor in sensors] == [1, 1]
+    assert all(device.active for device in devices)
+    assert sim.bus.devices[(-1, 0x70)].channel is None
+    settle(sim)
+    assert all(reading.field is not None for reading in array.readAll())
+    array.close()
+
+
+def test_close_puts_each_sensor_in_standby(sim):
+    # the standby write is routed to each sensor's channel, not to whatever was selected last
+    from mag_sensor_array import MagneticSensorArray, SensorPosition
+    sim.add_array_sensor(-1, channel=0)
+    sim.add_array_sensor(-1, channel=1)
+    devices = [sim.bus.muxed[(-1, channel, 0x0E)] for channel in (0, 1)]
+    array = MagneticSensorArray([SensorPosition('left', busnum=-1, channel=0),
+                                 SensorPosition('right', busnum=-1, channel=1)])
+    settle(sim)
+    assert all(device.active for device in devices)
+    array.close()
+    assert not any(device.active for device in devices)
+    assert sim.bus.devices[(-1, 0x70)].channel is None
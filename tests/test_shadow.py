@@ -0,0 +1,29 @@
+# Register shadows must not keep a value the device never received
+
+
+def test_failed_si5351_write_is_written_again(sim):
+    from Si5351_clock import Si5351
+    si = Si5351()
+    si.setFrequency(clock=0, pll=0, targetFrequency=30000)
+    # the first register of the new frequency is lost on the bus
+    sim.write_failures = 1
+    si.setFrequency(clock=0, pll=0, targetFrequency=31000)
+    assert si.writeErrors == 1
+    # the next point at the same frequency rewrites it
+    si.setFrequency(clock=0, pll=0, targetFrequency=31000)
+    si.enableOutputs(True)
+    assert abs(sim.si.outputs()[0] - 31000) < 1.0
+    assert si.writeSummary().startswith('Si5351 writes:')
+
+
+def test_failed_phase_shifter_write_is_written_again(sim):
+    from PhaseShifter import PhaseShifter
+    shifter = PhaseShifter()
+    shifter.set_phase_count240(0)
+    sim.write_failures = 1
+    shifter.set_a(60)
+    assert sim.phase_shifter1.registers[0x12] == 0
+    assert shifter.write_errors == 1 and shifter.write_count == 2
+    shifter.set_a(60)
+    assert sim.phase_shifter1.registers[0x12] == 60
+    assert shifter.write_count == 3
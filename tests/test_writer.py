@@ -0,0 +1,76 @@
+# SampleWriter: group commit, checkpoints and store failures
+
+import json
+import time
+
+import pytest
+
+from mag_writer import SampleWriter
+
+
+class ListStore(object):
+    """Keeps appended batches in memory, fails with error after fail_after batches"""
+    def __init__(self, fail_after=None, error=OSError(28, 'No space left on device')):
+        self.batches = []
+        self.fail_after = fail_after
+        self.error = error
+        self.syncs = 0
+        self.closed = False
+
+    def append(self, samples):
+        if self.fail_after is not None and len(self.batches) >= self.fail_after:
+            raise self.error
+        self.batches.append(list(samples))
+
+    def sync(self):
+        self.syncs += 1
+        return sum(len(batch) for batch in self.batches)
+
+    def close(self):
+        self.closed = True
+
+
+def wait_for(condition, timeout=5.0):
+    end = time.monotonic() + timeout
+    while not condition() and time.monotonic() < end:
+        time.sleep(0.01)
+    assert condition()
+
+
+def test_everything_submitted_is_written_and_checkpointed(tmp_path):
+    checkpoint = str(tmp_path / 'checkpoint.json')
+    store = ListStore()
+    writer = SampleWriter(store, checkpoint, commit_interval=60.0, commit_rows=10)
+    for batch in range(25):
+        writer.submit([batch] * 3, {'scan_index': batch + 1})
+    writer.close()
+    assert [row for batch in store.batches for row in batch] == [batch for batch in range(25) for _ in range(3)]
+    assert store.closed
+    with open(checkpoint) as fh:
+        state = json.load(fh)
+    assert state == {'scan_index': 25, 'data_length': 75}
+
+
+def test_store_failure_is_raised_from_submit_and_close():
+    store = ListStore(fail_after=2)
+    writer = SampleWriter(store, commit_interval=60.0)
+    for batch in range(3):
+        writer.submit([batch])
+    wait_for(lambda: writer.error is not None)
+    with pytest.raises(OSError):
+        writer.submit([3])
+    with pytest.raises(OSError):
+        writer.close()
+    assert store.closed
+
+
+def test_store_failure_ends_backpressure_wait():
+    # a full queue no longer waits on, or grows behind, a writer that has died
+    store = ListStore(fail_after=0, error=ValueError('too many sensor names for the sensor column'))
+    writer = SampleWriter(store, max_batches=1, commit_interval=60.0)
+    with pytest.raises(ValueError):
+        for batch in range(100):
+            writer.submit([batch])
+    assert len(writer.queue) <= 1
+    with pytest.raises(ValueError):
+        writer.close()